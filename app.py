@@ -1,14 +1,44 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain
+from threading import Lock
 from dotenv import load_dotenv
 from csv import DictReader
+import click
 import sqlalchemy as sa
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, Response, abort, render_template, stream_template, request, flash,
+    redirect, send_file, session, g, get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_wtf.csrf import generate_csrf
 from sqlalchemy.exc import IntegrityError
-
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import archive
+import assets
+from breaker import DatabaseGuard, DatabaseUnavailable
+from cache import TaggedCache
+from compress import Compress
+from events import make_bus
+from export import Exports
+from graph import FollowChanges, FollowGraph
+from health import HealthChecks
+from images import ImageError, Thumbnails
+from profiler import Profiler
+from ratelimit import RateLimiter
+from shards import ShardRouter
+import notifications
+import readmodels
+from slowlog import SlowQueryLog
+import tags
+from tasks import TaskExecutor
 from forms import EditProfileForm, UserAddForm, LoginForm, MessageForm, CSRFProtectForm
-from models import db, connect_db, User, Message, Like, Follows
+from models import (
+    db, connect_db, User, Message, Like, Follows, Job, Recommendation,
+    Hashtag, Mention)
 
 load_dotenv()
 
@@ -24,10 +54,155 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# the cost of password hashes; tests turn it down to run faster
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Where `flask snapshot-graph` writes the follow graph for workers to share,
+# and how stale (in seconds) a worker's copy may get before it reloads.
+app.config['FOLLOW_GRAPH_PATH'] = os.environ.get('FOLLOW_GRAPH_PATH')
+# Changes arrive over the events bus, so the graph needn't be reloaded;
+# set a number of seconds to rebuild it that often anyway
+app.config['FOLLOW_GRAPH_MAX_AGE'] = None
+# The oldest a FOLLOW_GRAPH_PATH snapshot may be to be loaded
+app.config['FOLLOW_GRAPH_SNAPSHOT_MAX_AGE'] = 60
+app.config['USERS_PER_PAGE'] = 48
+app.config['MESSAGES_PER_PAGE'] = 20
+app.config['LIKERS_PER_PAGE'] = 24
+app.config['NOTIFICATIONS_PER_PAGE'] = 20
+# Older notifications than a user's newest this many are dropped
+app.config['NOTIFICATIONS_MAX'] = 200
+# Accounts with more messages (or likes, or follows) than this are purged in
+# the background.
+app.config['PURGE_THRESHOLD'] = 5000
+# Live feed updates and follow graph changes go through Postgres
+# LISTEN/NOTIFY so every worker sees them; 'local' keeps them in-process
+# (single worker, tests).
+app.config['EVENTS_BACKEND'] = os.environ.get(
+    'EVENTS_BACKEND',
+    'postgres'
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql')
+    else 'local')
+# Seconds between keep-alive comments on idle event streams.
+app.config['EVENTS_HEARTBEAT'] = 15
+# Token buckets as (requests, per seconds), by client IP and by user.
+# 'shared' buckets live in memory shared by every worker on the host.
+app.config['RATELIMIT_ENABLED'] = True
+app.config['RATELIMIT_STORAGE'] = os.environ.get('RATELIMIT_STORAGE', 'shared')
+app.config['RATELIMITS'] = {
+    'login': {'ip': (10, 60)},
+    'signup': {'ip': (5, 3600)},
+    'add_message': {'user': (30, 60), 'ip': (60, 60)},
+    'like_message': {'user': (60, 60), 'ip': (120, 60)},
+    'request_export': {'user': (3, 3600)},
+    'bulk_follow': {'user': (10, 3600)},
+}
+# How many proxies (load balancers) in front of the app set X-Forwarded-For
+# and -Proto: the client address the rate limits key on is the one the
+# outermost of them saw. 0 when clients connect to gunicorn directly.
+app.config['PROXY_HOPS'] = int(os.environ.get('PROXY_HOPS', 1))
+# Most users one bulk follow/unfollow request may name.
+app.config['BULK_FOLLOW_MAX'] = 5000
+# Output of `flask build-assets`, served from /assets/ with long-lived caching.
+app.config['ASSETS_DIR'] = os.environ.get(
+    'ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+# Long list pages are streamed in chunks of about this many characters, and
+# read from the database this many rows at a time.
+app.config['STREAM_CHUNK_SIZE'] = 16384
+app.config['STREAM_ROWS'] = 200
+# Users' data exports (see export.py).
+app.config['EXPORT_DIR'] = os.environ.get(
+    'EXPORT_DIR', os.path.join(app.instance_path, 'exports'))
+# Resized profile images (see images.py), and limits on their sources.
+app.config['THUMBNAIL_DIR'] = os.environ.get(
+    'THUMBNAIL_DIR', os.path.join(app.instance_path, 'thumbnails'))
+app.config['THUMBNAIL_MAX_BYTES'] = 10 * 1024 * 1024
+app.config['THUMBNAIL_FETCH_TIMEOUT'] = 5
+# How long (s) a fetched source is used, and browsers cache a thumbnail,
+# before checking again: the image at a URL can change.
+app.config['THUMBNAIL_MAX_AGE'] = 24 * 3600
+# Request profiling (see profiler.py): tokens for the X-Profile header last
+# PROFILE_TOKEN_MAX_AGE seconds; PROFILE_SAMPLE_RATE of other requests are
+# profiled at random. Stacks are sampled every PROFILE_INTERVAL seconds.
+# Only the newest PROFILE_MAX_FILES profiles are kept in PROFILE_DIR.
+app.config['PROFILE_DIR'] = os.environ.get(
+    'PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_TOKEN_MAX_AGE'] = 3600
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_INTERVAL'] = 0.005
+app.config['PROFILE_MAX_FILES'] = int(
+    os.environ.get('PROFILE_MAX_FILES', 200))
+
+# Statements slower than this (in ms; None to turn off) go to the slow log
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(
+    os.environ.get('SLOW_QUERY_THRESHOLD_MS', 250))
+app.config['SLOW_QUERY_STORE'] = os.environ.get(
+    'SLOW_QUERY_STORE', os.path.join(app.instance_path, 'slow_queries.db'))
+app.config['SLOW_QUERY_MAX_ENTRIES'] = 500
+app.config['SLOW_QUERY_EXPLAIN'] = True
+app.config['SLOW_QUERY_EXPLAIN_TIMEOUT_MS'] = 30000
+
+app.config['MESSAGE_ARCHIVE_DIR'] = os.environ.get(
+    'MESSAGE_ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+
+# Database URLs (space-separated) to spread messages and likes over by user;
+# none keeps them in the main database. Fixed once messages are written.
+app.config['MESSAGE_SHARDS'] = os.environ.get('MESSAGE_SHARDS', '').split()
+# How many requests a worker may have querying every shard at once: as
+# many as it serves at once, gunicorn's worker_connections under gevent.
+app.config['SHARD_CONCURRENT_REQUESTS'] = int(
+    os.environ.get('WORKER_CONNECTIONS', 1000))
+
+# Statement timeouts (ms; None for none) for requests, by endpoint, and the
+# circuit breaker that opens on repeated timeouts (see breaker.py).
+app.config['STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS', 5000))
+app.config['STATEMENT_TIMEOUTS'] = {
+    'homepage': 2000,
+    'show_user': 2000,
+    'show_new_messages': 1000,
+}
+app.config['DB_BREAKER_FAILURES'] = 5
+app.config['DB_BREAKER_RESET'] = 30
+# Last-known-good home feeds and profiles, served while the breaker is open:
+# how many to keep, for how long (s), and the largest page (chars) kept.
+app.config['DEGRADED_PAGES_MAX'] = 2000
+app.config['DEGRADED_PAGE_MAX_AGE'] = 24 * 3600
+app.config['DEGRADED_PAGE_MAX_SIZE'] = 1024 * 1024
+# How long /readyz waits on the database before calling the worker unready,
+# and whether an open circuit breaker makes it unready too. It doesn't by
+# default: every worker's breaker opens together, and pulling them all from
+# the load balancer would stop the remembered pages being served.
+app.config['READY_TIMEOUT'] = 2
+app.config['READY_FAIL_ON_BREAKER'] = (
+    os.environ.get('READY_FAIL_ON_BREAKER', '') == '1')
 toolbar = DebugToolbarExtension(app)
+profiler = Profiler(app)
 
 
 connect_db(app)
+tasks = TaskExecutor(app)
+warbles = make_bus(app)
+limiter = RateLimiter(app)
+static_assets = assets.Assets(app)
+app.wsgi_app = Compress(app.wsgi_app)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'],
+                        x_proto=app.config['PROXY_HOPS'])
+thumbnails = Thumbnails(app)
+# before the slow log, so statements it turns away aren't timed
+db_guard = DatabaseGuard(app)
+slow_queries = SlowQueryLog(app)
+message_archive = archive.MessageArchive(app)
+shards = ShardRouter(app, guard=db_guard)
+exports = Exports(app)
+# outermost, so health checks skip compression and every before_request hook
+app.wsgi_app = HealthChecks(
+    app.wsgi_app,
+    {'main': db.get_engine(app),
+     **{f"shard_{n}": engine for n, engine in enumerate(shards.engines)}},
+    breaker=db_guard.breaker,
+    ready_timeout=app.config['READY_TIMEOUT'],
+    fail_on_breaker=app.config['READY_FAIL_ON_BREAKER'])
+app.add_template_filter(tags.linkify, 'linkify')
 
 # Check if the database needs to be initialized
 engine = sa.create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
@@ -52,6 +227,8 @@ if not inspector.has_table("messages"):
         app.logger.info('Initialized the database!')
 else:
     app.logger.info('Database already contains the messages table.')
+# the check's own engine isn't used again (nor inherited by workers)
+engine.dispose()
 
 
 ##############################################################################
@@ -63,6 +240,9 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
+        # with the database down, fail (or fall back) without asking it
+        if not db_guard.available():
+            raise DatabaseUnavailable()
         g.user = User.query.get(session[CURR_USER_KEY])
 
     else:
@@ -75,6 +255,224 @@ def add_CSRFProtectForm_to_g():
     # this can be called in jinja without referring to it because it's global
 
 
+follow_graph = None
+follow_events = None
+follow_graph_lock = Lock()
+follow_graph_refresher = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='follow-graph')
+follow_graph_refresh = None
+follow_changes = FollowChanges(
+    keep=app.config['FOLLOW_GRAPH_SNAPSHOT_MAX_AGE'] + 60)
+
+# Follow changes reach every worker on the events bus, under this key, as
+# [follower_id, followed_ids, following]; NOTIFY payloads are limited to
+# 8000 bytes, so a bulk change goes out this many ids at a time
+FOLLOWS_KEY = 'follows'
+FOLLOWS_PER_EVENT = 500
+# How far behind ours the clock that stamped a snapshot file may be
+SNAPSHOT_CLOCK_SKEW = 5
+
+
+def get_follow_graph():
+    """This worker's follow graph, with other workers' follows applied as
+    they arrive.
+
+    Only the first call waits for a graph to be built; others find it
+    ready. One that missed changes, because this worker fell behind on the
+    bus, or that's older than FOLLOW_GRAPH_MAX_AGE (if set), goes on being
+    served while its replacement is built in the background.
+    """
+
+    global follow_graph, follow_events
+
+    with follow_graph_lock:
+        # a subscriber that fell behind has lost changes: the graph needs
+        # rebuilding from the database, which has them all
+        lost = follow_events is not None and follow_events.overflowed
+        if follow_events is None or lost:
+            if lost:
+                warbles.unsubscribe(follow_events)
+            follow_events = warbles.subscribe([FOLLOWS_KEY],
+                                              max_pending=10000)
+
+    while True:
+        change = follow_events.get(timeout=0)
+        if change is None:
+            break
+        apply_follow_change(*change)
+
+    if follow_graph is None:
+        with follow_graph_lock:
+            if follow_graph is None:
+                follow_graph = load_follow_graph()
+        return follow_graph
+
+    max_age = app.config['FOLLOW_GRAPH_MAX_AGE']
+    if lost or (max_age is not None and follow_graph.age > max_age):
+        refresh_follow_graph(from_db=lost)
+
+    return follow_graph
+
+
+def load_follow_graph(from_db=False):
+    """Build a follow graph, from a snapshot file no older than
+    FOLLOW_GRAPH_SNAPSHOT_MAX_AGE if there is one, or else by reading
+    `follows`, with the changes seen meanwhile replayed onto it.
+    """
+
+    started = time.time()
+    graph = None
+
+    path = app.config['FOLLOW_GRAPH_PATH']
+    if path and os.path.exists(path) and not from_db:
+        graph = FollowGraph.load(path)
+        if graph.age > app.config['FOLLOW_GRAPH_SNAPSHOT_MAX_AGE']:
+            graph = None
+        else:
+            started = graph.created_at
+
+    if graph is None:
+        graph = FollowGraph.from_db()
+
+    follow_changes.replay(graph, since=started - SNAPSHOT_CLOCK_SKEW)
+    return graph
+
+
+def refresh_follow_graph(from_db=False):
+    """Replace the follow graph in a background thread, unless that's
+    already under way.
+    """
+
+    global follow_graph_refresh
+
+    def refresh():
+        global follow_graph
+        with app.app_context():
+            try:
+                graph = load_follow_graph(from_db)
+            except Exception:
+                app.logger.exception("Could not refresh the follow graph")
+                return
+            finally:
+                db.session.remove()
+        with follow_graph_lock:
+            follow_graph = graph
+
+    with follow_graph_lock:
+        if follow_graph_refresh is None or follow_graph_refresh.done():
+            follow_graph_refresh = follow_graph_refresher.submit(refresh)
+
+
+followed_by_cache = TaggedCache(maxsize=50000)
+
+
+def follows_changed(follower_id, followed_ids, following):
+    """Update the follow graph and caches, in this worker and the others,
+    after `follower_id` has followed (following=True) or unfollowed
+    `followed_ids` and committed.
+    """
+
+    followed_ids = list(followed_ids)
+    apply_follow_change(follower_id, followed_ids, following)
+
+    try:
+        for start in range(0, len(followed_ids), FOLLOWS_PER_EVENT):
+            warbles.publish(FOLLOWS_KEY, [
+                follower_id,
+                followed_ids[start:start + FOLLOWS_PER_EVENT],
+                following,
+            ])
+    except Exception:
+        # committed already: other workers catch up when they reload
+        app.logger.exception("Could not publish follow changes")
+
+
+def follows_removed(edges):
+    """Like `follows_changed`, for (follower_id, followed_id) `edges`
+    removed together, as a deleted account's are.
+    """
+
+    by_follower = {}
+    for follower_id, followed_id in edges:
+        by_follower.setdefault(follower_id, []).append(followed_id)
+
+    for follower_id, followed_ids in by_follower.items():
+        follows_changed(follower_id, followed_ids, following=False)
+
+
+def apply_follow_change(follower_id, followed_ids, following):
+    """Apply a follow change from this worker or another to this worker's
+    graph (if loaded) and caches.
+    """
+
+    follow_changes.record(follower_id, followed_ids, following)
+    if follow_graph is not None:
+        follow_graph.update(follower_id, followed_ids, following)
+
+    # (viewer, profile) answers change when the viewer follows someone new
+    # or someone starts following the profile
+    followed_by_cache.invalidate(
+        ('viewer', follower_id),
+        *(('profile', followed_id) for followed_id in followed_ids))
+
+
+def followed_by_following(viewer_id, user_id, names=3):
+    """How many people `viewer_id` follows also follow `user_id`, and the
+    first few of them as (id, username) rows.
+    """
+
+    key = (viewer_id, user_id)
+    result = followed_by_cache.get(key)
+
+    if result is None:
+        ids = get_follow_graph().followed_by_following(viewer_id, user_id)
+        users = (db.session
+                 .query(User.id, User.username)
+                 .filter(User.id.in_(ids[:names]))
+                 .order_by(User.id)
+                 .all())
+
+        result = (len(ids), users)
+        followed_by_cache.set(
+            key, result, tags=[('viewer', viewer_id), ('profile', user_id)])
+
+    return result
+
+
+@app.context_processor
+def add_follow_graph():
+    """ Templates read follow counts from the graph, not ORM collections """
+    return {'follow_graph': get_follow_graph}
+
+
+def message_count(user_id):
+    """How many messages `user_id` has posted, counted where they're kept."""
+
+    if shards.enabled:
+        return shards.message_count(user_id)
+    return Message.query.filter_by(user_id=user_id).count()
+
+
+def likes_count(user_id):
+    """How many messages `user_id` has liked, counted where they're kept."""
+
+    if shards.enabled:
+        return shards.likes_count(user_id)
+    return Like.query.filter_by(user_id=user_id).count()
+
+
+@app.context_processor
+def add_message_counts():
+    """ Templates count messages and likes in whichever database has them """
+    return {'message_count': message_count, 'likes_count': likes_count}
+
+
+@app.context_processor
+def add_unread_notifications():
+    """ The navbar shows the unread count kept by notifications.py """
+    return {'unread_notifications': notifications.unread_count}
+
+
 def do_login(user):
     """Log in user."""
 
@@ -89,6 +487,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit('signup')
 def signup():
     """Handle user signup.
 
@@ -127,6 +526,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit('login')
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -183,12 +583,10 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = readmodels.search_users(
+        g.user.id, search, rows=app.config['STREAM_ROWS'])
 
-    return render_template('users/index.html', users=users)
+    return stream_page('users/index.html', users=started(users))
 
 
 @app.get('/users/<int:user_id>')
@@ -201,7 +599,145 @@ def show_user(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/show.html', user=user)
+    followed_by = None
+    if user.id != g.user.id:
+        followed_by = followed_by_following(g.user.id, user.id)
+
+    # the archive is files, read only when asked for: link to it instead
+    older_url = None
+    if shards.enabled:
+        messages = shards.user_messages(
+            user.id, g.user.id, rows=app.config['STREAM_ROWS'])
+    else:
+        messages = readmodels.user_messages(
+            user.id, g.user.id, rows=app.config['STREAM_ROWS'])
+        if message_archive.months():
+            older_url = f"/users/{user.id}/archive"
+
+    return stream_page('users/show.html',
+                       remember=True,
+                       user=user,
+                       messages=started(messages),
+                       followed_by=followed_by,
+                       older_url=older_url)
+
+
+@app.get('/users/<int:user_id>/archive')
+def show_archived_messages(user_id):
+    """Show a user's messages from the months moved to the archive."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.query.get_or_404(user_id)
+
+    messages = readmodels.archived_messages(
+        message_archive, user.id, rows=app.config['STREAM_ROWS'])
+
+    return stream_page('users/show.html',
+                       user=user,
+                       messages=started(messages),
+                       archived=True)
+
+
+# Ends a streamed page whose query failed after the 200 went out
+STREAM_CUT_SHORT = ('<div class="alert alert-danger">Warbler lost its database '
+                    'partway through this page. Try again shortly.</div>')
+
+
+def stream_page(template_name, remember=False, **context):
+    """Like render_template, but send the page while it renders.
+
+    Rows are rendered as the query yields them, so neither the first byte
+    nor the worker's memory waits on the full list. With `remember`, the
+    finished page is kept to serve if the database goes down.
+    """
+
+    # The session cookie goes out with the headers, before the template
+    # runs: take the flashed messages and CSRF token now so they're saved.
+    flashes = get_flashed_messages(with_categories=True)
+    generate_csrf()
+
+    # pages showing flashed messages aren't kept: they'd show them again
+    key = page_key() if remember and not flashes else None
+
+    chunks = stream_template(template_name, **context)
+    size = app.config['STREAM_CHUNK_SIZE']
+
+    # a copy of what's sent, if it's to be remembered and isn't too big
+    sent, room = [], app.config['DEGRADED_PAGE_MAX_SIZE']
+
+    def send(text):
+        nonlocal room
+        room -= len(text)
+        if key and room >= 0:
+            sent.append(text)
+        return text
+
+    def buffered():
+        # Jinja yields a string per template node; batch them up
+        nonlocal room
+        buffer, length = [], 0
+        try:
+            for chunk in chunks:
+                buffer.append(chunk)
+                length += len(chunk)
+                if length >= size:
+                    yield send(''.join(buffer))
+                    buffer, length = [], 0
+            yield send(''.join(buffer))
+        except (DatabaseUnavailable, sa.exc.OperationalError):
+            # the 200 has gone out: end the page saying it's cut short,
+            # and don't keep it
+            app.logger.exception(f"Database failed streaming {template_name}")
+            room = -1
+            yield ''.join(buffer) + STREAM_CUT_SHORT
+        finally:
+            chunks.close()
+
+        if key and room >= 0:
+            db_guard.remember(key, ''.join(sent))
+
+    return Response(buffered())
+
+
+def started(rows):
+    """`rows`, with its query already run. The database failing then
+    fails the request here, where the error handlers can still answer,
+    rather than halfway through a streamed 200.
+    """
+
+    rows = iter(rows)
+    for first in rows:
+        return chain([first], rows)
+    return iter(())
+
+
+def page_key():
+    """What this page is remembered under while the database is down: its
+    path and who's looking.
+    """
+
+    return (request.path, session.get(CURR_USER_KEY))
+
+
+def page_of_cards(get_cards, user_id):
+    """One page of user cards, continuing after the `after` query param.
+
+    Returns the cards and the id to continue after, or None on the last page.
+    """
+
+    per_page = app.config['USERS_PER_PAGE']
+    after = request.args.get('after', 0, type=int)
+
+    cards = get_cards(user_id, g.user.id, after=after, limit=per_page + 1)
+
+    if len(cards) > per_page:
+        cards = cards[:per_page]
+        return cards, cards[-1].id
+
+    return cards, None
 
 
 @app.get('/users/<int:user_id>/following')
@@ -213,7 +749,10 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_after = page_of_cards(readmodels.following, user_id)
+
+    return render_template(
+        'users/following.html', user=user, users=users, next_after=next_after)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -225,7 +764,10 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_after = page_of_cards(readmodels.followers, user_id)
+
+    return render_template(
+        'users/followers.html', user=user, users=users, next_after=next_after)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -243,8 +785,12 @@ def start_following(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    notifications.record(followed_user.id, notifications.FOLLOW, g.user.id,
+                         keep=app.config['NOTIFICATIONS_MAX'])
     db.session.commit()
 
+    follows_changed(g.user.id, [followed_user.id], following=True)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -264,9 +810,82 @@ def stop_following(follow_id):
     g.user.following.remove(followed_user)
     db.session.commit()
 
+    follows_changed(g.user.id, [follow_id], following=False)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.post('/users/following/bulk')
+@limiter.limit('bulk_follow')
+def bulk_follow():
+    """Follow and unfollow many users at once, for importing a follow list.
+
+    Takes JSON, {"follow": [...], "unfollow": [...]}, each a list of user
+    ids or usernames, and returns a JSON summary of what changed. (Being
+    JSON-only, it can't be posted from another site's form.)
+    """
+
+    if not g.user:
+        abort(401)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    follow = data.get('follow', [])
+    unfollow = data.get('unfollow', [])
+    if not isinstance(follow, list) or not isinstance(unfollow, list):
+        abort(400)
+    if len(follow) + len(unfollow) > app.config['BULK_FOLLOW_MAX']:
+        abort(413)
+
+    summary = change_follows(g.user.id, follow=follow, unfollow=unfollow)
+
+    follows_changed(g.user.id, summary['followed'], following=True)
+    follows_changed(g.user.id, summary['unfollowed'], following=False)
+
+    return summary
+
+
+def change_follows(follower_id, follow=(), unfollow=()):
+    """Have `follower_id` follow the users in `follow` and stop following
+    those in `unfollow` (ids or usernames), with one query to look them all
+    up and one statement for each change. Commits.
+
+    Returns what changed, as lists of user ids, and the targets that named
+    no one.
+    """
+
+    follow_ids, follow_missing = User.resolve(follow)
+    unfollow_ids, unfollow_missing = User.resolve(unfollow)
+
+    followed = Follows.add_many(follower_id, follow_ids)
+    unfollowed = Follows.remove_many(follower_id, unfollow_ids)
+
+    if followed:
+        tasks.defer(notify_followed, follower_id, followed)
+    db.session.commit()
+
+    return {
+        'followed': followed,
+        'already_following': sorted(set(follow_ids) - set(followed)
+                                    - {follower_id}),
+        'unfollowed': unfollowed,
+        'not_following': sorted(set(unfollow_ids) - set(unfollowed)),
+        'not_found': follow_missing + unfollow_missing,
+    }
+
+
+@tasks.task
+def notify_followed(follower_id, user_ids):
+    """Tell each of `user_ids` that `follower_id` followed them."""
+
+    for user_id in user_ids:
+        notifications.record(user_id, notifications.FOLLOW, follower_id,
+                             keep=app.config['NOTIFICATIONS_MAX'])
+    db.session.commit()
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -291,6 +910,18 @@ def profile():
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
 
+            try:
+                if form.image_file.data:
+                    user.image_url = thumbnails.store_upload(
+                        form.image_file.data)
+                if form.header_image_file.data:
+                    user.header_image_url = thumbnails.store_upload(
+                        form.header_image_file.data)
+            except ImageError as exc:
+                db.session.rollback()
+                flash(f"Couldn't use that image: {exc}", "danger")
+                return render_template("/users/edit.html", form=form)
+
             db.session.commit()
             flash("User Profile Updated")
             return redirect(f"/users/{g.user.id}")
@@ -316,17 +947,132 @@ def delete_user():
         return redirect("/")
 
     do_logout()
+    exports.remove(g.user.id)
+
+    if shards.enabled:
+        tasks.defer(purge_sharded_messages, g.user.id)
+    if message_archive.months():
+        tasks.defer(purge_archived_messages, g.user.id)
+
+    edges = []
+    if User.is_heavy(g.user.id, app.config['PURGE_THRESHOLD']):
+        tasks.defer(purge_user, g.user.id)
+    else:
+        edges = (db.session
+                 .query(Follows.user_following_id,
+                        Follows.user_being_followed_id)
+                 .filter((Follows.user_following_id == g.user.id)
+                         | (Follows.user_being_followed_id == g.user.id))
+                 .all())
+        db.session.delete(g.user)
 
-    db.session.delete(g.user)
     db.session.commit()
+    follows_removed(edges)
 
     return redirect("/signup")
 
 
+@app.get('/users/export')
+def show_export():
+    """Show the current user's data export, if any, and offer a new one."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('users/export.html',
+                           built_at=exports.built_at(g.user.id))
+
+
+@app.post('/users/export')
+@limiter.limit('request_export')
+def request_export():
+    """Start building the current user's data export in the background."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    tasks.defer(build_export, g.user.id)
+    db.session.commit()
+
+    flash("Your export is being prepared. Check back in a few minutes.",
+          "success")
+    return redirect("/users/export")
+
+
+@app.get('/users/export/download')
+def download_export():
+    """Send the current user's data export. Range requests resume an
+    interrupted download.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    built_at = exports.built_at(g.user.id)
+    if built_at is None:
+        abort(404)
+
+    response = send_file(
+        exports.path(g.user.id),
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name=f"warbler-{g.user.username}-{built_at:%Y%m%d}.zip",
+        conditional=True,
+        max_age=0)
+    response.cache_control.private = True
+    return response
+
+
+@tasks.task
+def build_export(user_id):
+    """Write `user_id`'s data export, streaming their rows to disk."""
+
+    rows = app.config['STREAM_ROWS']
+
+    if shards.enabled:
+        messages = shards.user_messages(user_id, user_id, rows=rows)
+        likes = shards.liked_messages(user_id, user_id, rows=rows)
+    else:
+        messages = readmodels.user_messages(user_id, user_id, rows=rows,
+                                            archive=message_archive)
+        likes = readmodels.liked_messages(user_id, user_id, rows=rows)
+
+    exports.build(user_id, messages=messages, likes=likes)
+    app.logger.info(f"Built data export for user #{user_id}")
+
+
+@tasks.task
+def purge_user(user_id):
+    """Delete a large account in batches, outside the request."""
+
+    User.purge(user_id, unfollowed=follows_removed)
+    app.logger.info(f"Purged user #{user_id}")
+
+
+@tasks.task
+def purge_sharded_messages(user_id):
+    """Delete a deleted user's messages and likes from the shards."""
+
+    shards.purge_user(user_id)
+
+
+@tasks.task
+def purge_archived_messages(user_id):
+    """Rewrite the archived months a deleted user posted in without them."""
+
+    months = message_archive.purge_user(user_id)
+    app.logger.info(f"Purged user #{user_id} from {len(months)} archived "
+                    f"months")
+
+
 ##############################################################################
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit('add_message')
 def add_message():
     """Add a message:
 
@@ -340,8 +1086,20 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        text = form.text.data
+        timestamp = datetime.utcnow()
+
+        if shards.enabled:
+            message_id = shards.add_message(g.user.id, text, timestamp)
+        else:
+            msg = Message(text=text, timestamp=timestamp)
+            g.user.messages.append(msg)
+            db.session.flush()
+            message_id = msg.id
+
+        tags.index_message(message_id, g.user.id, timestamp, text)
+
+        tasks.on_commit(announce_warble, g.user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -349,6 +1107,59 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+def announce_warble(user_id):
+    """Tell followers connected to /messages/stream about a new message."""
+
+    warbles.publish(user_id, user_id)
+
+
+@app.get('/messages/stream')
+def stream_new_messages():
+    """Server-sent events: a `warble` event each time someone the current
+    user follows posts a message.
+
+    Holds no database connection while open; under gevent workers each
+    idle stream costs a greenlet and a queue.
+    """
+
+    if not g.user:
+        abort(401)
+
+    following_ids = list(get_follow_graph().following(g.user.id))
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+
+    def events():
+        with warbles.subscribe(following_ids) as subscription:
+            yield "retry: 10000\n\n"
+
+            while True:
+                author_id = subscription.get(timeout=heartbeat)
+                if author_id is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: warble\ndata: {author_id}\n\n"
+
+    return Response(events(),
+                    mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@app.get('/messages/since')
+def show_new_messages():
+    """Feed items newer than the `after` timestamp, as an HTML fragment."""
+
+    if not g.user:
+        abort(401)
+
+    after = request.args.get('after', type=datetime.fromisoformat)
+    if after is None:
+        abort(400)
+
+    messages = home_feed(g.user.id, after=after)
+
+    return render_template('messages/_feed.html', messages=messages)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -357,8 +1168,43 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = get_message_or_404(message_id)
+
+    per_page = app.config['LIKERS_PER_PAGE']
+    after = request.args.get('after', 0, type=int)
+
+    if shards.enabled:
+        like_count = shards.like_count(message_id)
+        likers, next_after = shards.likers(message_id, after=after,
+                                           per_page=per_page)
+    else:
+        like_count = readmodels.like_count(message_id)
+        likers = readmodels.likers(message_id, after=after,
+                                   limit=per_page + 1)
+
+        next_after = None
+        if len(likers) > per_page:
+            likers = likers[:per_page]
+            next_after = likers[-1].id
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           like_count=like_count,
+                           likers=likers,
+                           next_after=next_after)
+
+
+def get_message_or_404(message_id):
+    """The message's row, as the current user sees it, wherever it's kept."""
+
+    if shards.enabled:
+        msg = shards.get_message(message_id, g.user.id)
+    else:
+        msg = readmodels.message(message_id, g.user.id)
+
+    if msg is None:
+        abort(404)
+    return msg
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -375,13 +1221,16 @@ def delete_message(message_id):
 
     # form = g.CSRFForm
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
     if g.user.id != msg.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
-    db.session.commit()
+    if shards.enabled:
+        shards.delete_message(message_id)
+    else:
+        Message.query.filter_by(id=message_id).delete()
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
@@ -389,6 +1238,7 @@ def delete_message(message_id):
 # Likes
 
 @app.post("/<int:msg_id>/like")
+@limiter.limit('like_message')
 def like_message(msg_id):
     """Like a message."""
 
@@ -396,12 +1246,20 @@ def like_message(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(msg_id)
+    msg = get_message_or_404(msg_id)
 
     if msg.user_id == g.user.id:
         flash("Cannot like your own message")
         return redirect(f"/messages/{msg_id}")
 
+    if shards.enabled:
+        if shards.like(msg_id, g.user.id):
+            notifications.record(msg.user_id, notifications.LIKE, g.user.id,
+                                 subject_id=msg_id,
+                                 keep=app.config['NOTIFICATIONS_MAX'])
+            db.session.commit()
+        return redirect(f"/messages/{msg_id}")
+
     like = Like(message_id = msg_id, user_id = g.user.id)
 
     # likes = g.user.likes
@@ -413,6 +1271,9 @@ def like_message(msg_id):
 
 
     db.session.add(like)
+    notifications.record(msg.user_id, notifications.LIKE, g.user.id,
+                         subject_id=msg_id,
+                         keep=app.config['NOTIFICATIONS_MAX'])
     db.session.commit()
 
     #how to return to same page that like is placed?
@@ -426,6 +1287,11 @@ def unlike_message(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if shards.enabled:
+        if not shards.unlike(msg_id, g.user.id):
+            abort(404)
+        return redirect("/")
+
     like = Like.query.get_or_404((g.user.id, msg_id))
 
     db.session.delete(like)
@@ -433,6 +1299,67 @@ def unlike_message(msg_id):
 
     return redirect("/")
 
+def page_of_messages(model, term):
+    """One page of the messages `model` (Hashtag or Mention) indexes under
+    `term`, continuing after the `before` query param.
+
+    Returns the rows and the message id to continue after, or None on the
+    last page.
+    """
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    before = request.args.get('before', type=int)
+
+    # whether there's more is the index's to say: rows for messages since
+    # deleted or archived would otherwise cut the paging short
+    page = db.session.execute(readmodels.index_page(
+        model, term, before, limit=per_page + 1)).all()
+    more = len(page) > per_page
+    page = page[:per_page]
+
+    if shards.enabled:
+        messages = shards.messages(
+            [message_id for message_id, _ in page], g.user.id)
+    else:
+        messages = readmodels.indexed_messages(page, g.user.id)
+
+    return messages, (page[-1].message_id if more else None)
+
+
+@app.get('/tags/<tag>')
+def show_tag(tag):
+    """Show messages tagged #tag, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    tag = tag.lower()
+    messages, next_before = page_of_messages(Hashtag, Hashtag.tag == tag)
+
+    return render_template('messages/index.html',
+                           title=f"#{tag}",
+                           messages=messages,
+                           next_before=next_before)
+
+
+@app.get('/mentions')
+def show_mentions():
+    """Show messages mentioning the current user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, next_before = page_of_messages(
+        Mention, Mention.user_id == g.user.id)
+
+    return render_template('messages/index.html',
+                           title=f"Mentions of @{g.user.username}",
+                           messages=messages,
+                           next_before=next_before)
+
+
 @app.get("/users/<int:user_id>/likes")
 def show_likes(user_id):
     """Show all likes for a user"""
@@ -442,15 +1369,71 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    msgs = user.likes
+    if shards.enabled:
+        msgs = shards.liked_messages(
+            user.id, g.user.id, rows=app.config['STREAM_ROWS'])
+    else:
+        msgs = readmodels.liked_messages(
+            user.id, g.user.id, rows=app.config['STREAM_ROWS'])
+
+    return stream_page("users/likes.html", messages = started(msgs))
+
+
+
+##############################################################################
+# Notifications
+
+
+@app.get('/notifications')
+def show_notifications():
+    """Show the current user's notifications, latest first.
+
+    Seeing the first page marks them all read.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    return render_template("users/likes.html", messages = msgs)
+    per_page = app.config['NOTIFICATIONS_PER_PAGE']
+    before = request.args.get('before', type=int)
 
+    rows = readmodels.notifications(g.user.id, before, limit=per_page + 1)
+
+    next_before = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_before = rows[-1].id
+
+    if before is None:
+        notifications.mark_read(g.user.id)
+        db.session.commit()
+
+    return render_template('notifications.html',
+                           notifications=rows,
+                           next_before=next_before)
 
 
 ##############################################################################
 # Homepage and error pages
 
+# Marks where, in base.html, a remembered copy of a page gets its banner
+DEGRADED_BANNER_MARK = '<!-- degraded banner -->'
+
+
+def home_feed(user_id, after=None, limit=100):
+    """Most recent messages by `user_id` and the people they follow,
+    optionally only those posted after the datetime `after`.
+    """
+
+    following_ids = list(get_follow_graph().following(user_id))
+    following_ids.append(user_id)
+
+    if shards.enabled:
+        return shards.feed(following_ids, user_id, after=after, limit=limit)
+
+    return readmodels.feed(following_ids, user_id, after=after, limit=limit)
+
 
 @app.get('/')
 def homepage():
@@ -462,22 +1445,236 @@ def homepage():
 
 # query from user and user.following and then get messages from all
     if g.user:
-        following_ids = [followed.id for followed in g.user.following]
-        following_ids.append(g.user.id)
+        messages = home_feed(g.user.id)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        suggestions = readmodels.suggestions(g.user.id)
 
-        return render_template('home.html', messages=messages)
+        page = render_template(
+            'home.html', messages=messages, suggestions=suggestions)
+        if not get_flashed_messages():
+            db_guard.remember(page_key(), page)
+        return page
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(DatabaseUnavailable)
+@app.errorhandler(sa.exc.OperationalError)
+def database_unavailable(e):
+    """With the database down or too slow, show the last good copy of the
+    page, if there is one, with a banner saying so; otherwise fail fast.
+    """
+
+    # don't let the templates ask the database again
+    g.user = None
+
+    remembered = db_guard.remembered(page_key())
+
+    if request.method == 'GET' and remembered:
+        saved_at, page = remembered
+        banner = render_template('_degraded.html', saved_at=saved_at)
+        return page.replace(DEGRADED_BANNER_MARK, banner, 1)
+
+    return (render_template('unavailable.html'), 503,
+            {'Retry-After': str(app.config['DB_BREAKER_RESET'])})
+
+
+##############################################################################
+# Batch jobs
+
+
+@app.cli.command('recommend')
+@click.option('--top', default=10, help="Suggestions to keep per user.")
+@click.option('--workers', default=1, help="Shards to compute in parallel.")
+def recommend_command(top, workers):
+    """Recompute "who to follow" suggestions from the follow graph."""
+
+    def refresh_shard(shard):
+        with app.app_context():
+            count = Recommendation.refresh(
+                top_n=top, shard=shard, shards=workers)
+            db.session.commit()
+            return count
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        total = sum(pool.map(refresh_shard, range(workers)))
+
+    click.echo(f"Wrote {total} suggestions.")
+
+
+@app.cli.command('index-messages')
+@click.option('--shard', default=0, help="Which share of messages to index.")
+@click.option('--shards', 'shard_count', default=1,
+              help="Processes sharing the work.")
+@click.option('--batch-size', default=1000, help="Messages per commit.")
+def index_messages_command(shard, shard_count, batch_size):
+    """Add existing messages' hashtags and mentions to the index.
+
+    To use N processes, start N of these with --shards N and each of
+    --shard 0 ... N-1.
+    """
+
+    if not 0 <= shard < shard_count:
+        raise click.UsageError("--shard must be from 0 to --shards - 1.")
+
+    count = tags.backfill(
+        shard=shard, shards=shard_count, batch_size=batch_size)
+    click.echo(f"Indexed {count} messages.")
+
+
+@app.cli.command('bulk-follow')
+@click.argument('username')
+@click.argument('targets', type=click.File(), default='-')
+@click.option('--unfollow', is_flag=True,
+              help="Unfollow the users listed instead.")
+def bulk_follow_command(username, targets, unfollow):
+    """Have USERNAME follow everyone listed in TARGETS (a file, or stdin),
+    one user id or username per line.
+    """
+
+    user = User.by_username(username)
+    if user is None:
+        raise click.UsageError(f"No user named {username}.")
+
+    listed = [line for line in targets.read().split() if line]
+    if unfollow:
+        summary = change_follows(user.id, unfollow=listed)
+    else:
+        summary = change_follows(user.id, follow=listed)
+    tasks.drain()
+
+    click.echo(", ".join(f"{len(ids)} {key.replace('_', ' ')}"
+                         for key, ids in summary.items()) + ".")
+    for target in summary['not_found']:
+        click.echo(f"Not found: {target}", err=True)
+
+
+@app.cli.command('snapshot-graph')
+@click.argument('path', default=lambda: app.config['FOLLOW_GRAPH_PATH'])
+def snapshot_graph_command(path):
+    """Write the follow graph to PATH for workers to memory-map."""
+
+    if not path:
+        raise click.UsageError("Pass a PATH or set FOLLOW_GRAPH_PATH.")
+
+    graph = FollowGraph.from_db()
+    graph.save(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    click.echo(f"Wrote follow graph to {path}.")
+
+
+@app.cli.command('purge-user')
+@click.argument('user_id', type=int)
+@click.option('--batch-size', default=10000, help="Rows deleted per commit.")
+def purge_user_command(user_id, batch_size):
+    """Delete USER_ID and everything they own in batches."""
+
+    User.purge(user_id, batch_size=batch_size, unfollowed=follows_removed)
+    message_archive.purge_user(user_id)
+    click.echo(f"Purged user #{user_id}.")
+
+
+@app.cli.command('run-jobs')
+@click.option('--limit', default=100, help="Most jobs to run.")
+def run_jobs_command(limit):
+    """Retry background tasks that are due, then report on the queue."""
+
+    ran = tasks.run_due_jobs(limit=limit)
+
+    waiting, failed = db.session.query(
+        db.func.count(Job.id).filter(Job.failed_at.is_(None)),
+        db.func.count(Job.id).filter(Job.failed_at.isnot(None)),
+    ).one()
+
+    click.echo(f"Ran {ran} jobs; {waiting} waiting, {failed} failed.")
+
+
+@app.cli.command('profile-token')
+def profile_token_command():
+    """Print an X-Profile header value that profiles the requests sending it."""
+
+    max_age = app.config['PROFILE_TOKEN_MAX_AGE']
+    click.echo(f"X-Profile: {profiler.token()}")
+    click.echo(f"(valid for {max_age}s; profiles go to "
+               f"{app.config['PROFILE_DIR']})", err=True)
+
+
+@app.cli.command('build-assets')
+@click.option('--offline', is_flag=True,
+              help="Use vendored files already in static/vendor.")
+def build_assets_command(offline):
+    """Vendor, bundle, fingerprint and precompress the static files."""
+
+    if not offline:
+        assets.vendor(app.static_folder)
+
+    manifest = assets.build(app.static_folder, app.config['ASSETS_DIR'])
+    static_assets.load()
+
+    click.echo(f"Built {len(manifest)} assets in {app.config['ASSETS_DIR']}"
+               f"{'' if assets.brotli else ' (no brotli; gzip only)'}.")
+
+
+@app.cli.command('partition-messages')
+@click.option('--ahead', default=3, help="Months to add partitions ahead.")
+def partition_messages_command(ahead):
+    """Partition messages by month, and add the coming months' partitions."""
+
+    if archive.partition_messages():
+        click.echo("Converted messages to a partitioned table.")
+
+    added = archive.ensure_partitions(ahead)
+    click.echo(f"Added {len(added)} partitions"
+               f"{': ' if added else '.'}"
+               f"{', '.join(f'{month:%Y-%m}' for month in added)}")
+
+
+@app.cli.command('archive-messages')
+@click.option('--keep-months', default=12,
+              help="Whole months of messages to keep in the database.")
+def archive_messages_command(keep_months):
+    """Move months of messages older than --keep-months to the archive."""
+
+    archived = message_archive.archive(keep_months)
+    click.echo(f"Archived {len(archived)} months to "
+               f"{app.config['MESSAGE_ARCHIVE_DIR']}"
+               f"{' (no pyarrow; as JSON lines)' if archive.pq is None else ''}.")
+
+
+@app.cli.command('create-shards')
+def create_shards_command():
+    """Create the message and like tables on each of MESSAGE_SHARDS."""
+
+    shards.create_all()
+    click.echo(f"Created tables on {len(shards.engines)} shards.")
+
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=10, help="Statements to list.")
+@click.option('--plans', is_flag=True, help="Show their query plans too.")
+@click.option('--reset', is_flag=True, help="Empty the log afterwards.")
+def slow_queries_command(top, plans, reset):
+    """List the slow statements that have taken the most time in total."""
+
+    for n, query in enumerate(slow_queries.store.top(top), 1):
+        mean_ms = query['total_ms'] / query['calls']
+        click.echo(f"#{n} {query['total_ms']:.0f}ms total, "
+                   f"{query['calls']} calls, {mean_ms:.0f}ms mean, "
+                   f"{query['max_ms']:.0f}ms max [{query['fingerprint']}]")
+        click.echo(f"    {query['statement']}")
+        click.echo(f"    params: {query['params']}")
+        if plans and query['plan']:
+            for line in query['plan'].splitlines():
+                click.echo(f"    | {line}")
+        click.echo()
+
+    if reset:
+        slow_queries.store.clear()
+        click.echo("Emptied the slow query log.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -487,10 +1684,12 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request but public ones (assets
+    and images) that set their own caching."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control.public:
+        response.cache_control.no_store = True
     return response
 
 @app.errorhandler(404)
@@ -0,0 +1,346 @@
+"""Monthly partitions of the messages table, and an archive for old ones.
+
+On Postgres, messages is partitioned by month on timestamp: one table per
+month, named messages_YYYY_MM, plus messages_default for anything no month
+covers yet. `flask partition-messages` creates the coming months (run it
+from cron), and converts an unpartitioned table left by an older version.
+
+`flask archive-messages` writes months older than --keep-months to
+MESSAGE_ARCHIVE_DIR, one file per month, then detaches and drops them.
+The files are Parquet if pyarrow is installed, else gzipped JSON lines,
+sorted by author so one user's messages are a short read. Profiles link
+to /users/<id>/archive, which reads a user's archived messages from
+there. Archived messages can't be opened or liked: their likes, tags and
+mentions go with the month. Deleting an account rewrites the months it
+posted in without its messages.
+"""
+
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import text
+
+from models import db, Message
+
+try:
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+PARTITION = re.compile(r"messages_(\d{4})_(\d{2})$")
+ARCHIVE_FILE = re.compile(r"messages_(\d{4})_(\d{2})\.(parquet|ndjson\.gz)$")
+COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+BATCH_SIZE = 10000
+
+
+def month_of(when):
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, n):
+    years, month_index = divmod(month.month - 1 + n, 12)
+    return datetime(month.year + years, month_index + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+##############################################################################
+# Partitions
+
+def is_partitioned():
+    return db.session.execute(text(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = 'messages'::regclass"
+    )).scalar()
+
+
+def partitions():
+    """The months that have a partition, oldest first."""
+
+    names = db.session.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'messages'::regclass
+    """)).scalars()
+
+    return sorted(datetime(int(match[1]), int(match[2]), 1)
+                  for match in map(PARTITION.match, names) if match)
+
+
+def add_partition(month):
+    """Give `month` a partition of its own, moving in any of its rows that
+    landed in messages_default. Doesn't commit.
+    """
+
+    name = partition_name(month)
+    start = f"'{month:%Y-%m-%d}'"
+    end = f"'{add_months(month, 1):%Y-%m-%d}'"
+
+    # Postgres won't create a partition over rows the default one holds, so
+    # fill the new table first and attach it once they're gone. The delete
+    # is on the partition itself, so the likes trigger on messages is quiet.
+    db.session.execute(text(f"""
+        CREATE TABLE {name}
+            (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+
+        WITH moved AS (
+            DELETE FROM messages_default
+            WHERE timestamp >= {start} AND timestamp < {end}
+            RETURNING *)
+        INSERT INTO {name} SELECT * FROM moved;
+
+        ALTER TABLE messages ATTACH PARTITION {name}
+            FOR VALUES FROM ({start}) TO ({end});
+    """))
+
+
+def ensure_partitions(ahead=3):
+    """Add partitions for this month, the `ahead` after it, and any month
+    with rows in messages_default. Commits; returns the months added.
+    """
+
+    this_month = month_of(datetime.utcnow())
+    wanted = {add_months(this_month, n) for n in range(ahead + 1)}
+    wanted.update(db.session.execute(text(
+        "SELECT DISTINCT date_trunc('month', timestamp) FROM messages_default"
+    )).scalars())
+
+    added = sorted(wanted - set(partitions()))
+    for month in added:
+        add_partition(month)
+        db.session.commit()
+
+    return added
+
+
+def partition_messages():
+    """Rebuild an unpartitioned messages table as a partitioned one, in one
+    transaction. Returns False if it was partitioned already.
+    """
+
+    if is_partitioned():
+        return False
+
+    db.session.execute(text("""
+        ALTER TABLE messages RENAME TO messages_unpartitioned;
+        ALTER TABLE messages_unpartitioned
+            RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+        ALTER INDEX IF EXISTS ix_messages_user_id
+            RENAME TO ix_messages_unpartitioned_user_id;
+        ALTER SEQUENCE messages_id_seq
+            RENAME TO messages_unpartitioned_id_seq;
+        ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+    """))
+
+    Message.__table__.create(db.session.connection())
+
+    months = db.session.execute(text(
+        "SELECT DISTINCT date_trunc('month', timestamp) "
+        "FROM messages_unpartitioned"
+    )).scalars()
+    for month in months:
+        add_partition(month)
+
+    db.session.execute(text("""
+        INSERT INTO messages (id, text, timestamp, user_id)
+        SELECT id, text, timestamp, user_id FROM messages_unpartitioned;
+
+        SELECT setval(pg_get_serial_sequence('messages', 'id'),
+                      coalesce(max(id), 0) + 1, false)
+        FROM messages;
+
+        DROP TABLE messages_unpartitioned;
+    """))
+    db.session.commit()
+
+    return True
+
+
+##############################################################################
+# Archive
+
+class MessageArchive:
+    """The archived months in MESSAGE_ARCHIVE_DIR."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def directory(self):
+        return self.app.config['MESSAGE_ARCHIVE_DIR']
+
+    def archive(self, keep_months=12, columnar=None):
+        """Archive every partition older than `keep_months` whole months,
+        committing after each. Returns the months archived.
+        """
+
+        if columnar is None:
+            columnar = pq is not None
+        cutoff = add_months(month_of(datetime.utcnow()), -keep_months)
+
+        # old rows still in messages_default go too, so first give them
+        # partitions of their own
+        ensure_partitions(ahead=0)
+        os.makedirs(self.directory, exist_ok=True)
+
+        archived = []
+        for month in partitions():
+            if month >= cutoff:
+                break
+
+            name = partition_name(month)
+            rows = db.session.execute(
+                text(f"SELECT {', '.join(COLUMNS)} FROM {name} "
+                     f"ORDER BY user_id, timestamp DESC")
+                .execution_options(yield_per=BATCH_SIZE))
+
+            if columnar:
+                self._write_parquet(month, rows)
+            else:
+                self._write_ndjson(month, rows)
+
+            # dropping the partition skips the delete trigger: the month's
+            # likes, tags and mentions go here
+            for table in ('likes', 'like_counts', 'hashtags', 'mentions'):
+                db.session.execute(text(
+                    f"DELETE FROM {table} "
+                    f"WHERE message_id IN (SELECT id FROM {name})"))
+            db.session.execute(text(
+                f"ALTER TABLE messages DETACH PARTITION {name}; "
+                f"DROP TABLE {name};"))
+            db.session.commit()
+            archived.append(month)
+
+        return archived
+
+    def months(self):
+        """(month, path) for each archived month, newest first."""
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        found = []
+        for name in os.listdir(self.directory):
+            match = ARCHIVE_FILE.match(name)
+            if match:
+                month = datetime(int(match[1]), int(match[2]), 1)
+                found.append((month, os.path.join(self.directory, name)))
+
+        return sorted(found, reverse=True)
+
+    def messages(self, user_id):
+        """Yield `user_id`'s archived messages as dicts, newest first,
+        reading one month's file at a time.
+        """
+
+        for month, path in self.months():
+            if path.endswith('.parquet'):
+                rows = pq.read_table(
+                    path, filters=[('user_id', '=', user_id)]).to_pylist()
+            else:
+                rows = self._read_ndjson(path, user_id)
+
+            yield from sorted(rows, key=lambda row: row['timestamp'],
+                              reverse=True)
+
+    def purge_user(self, user_id):
+        """Rewrite the archived months `user_id` posted in without their
+        messages. Returns the months rewritten.
+        """
+
+        purged = []
+        for month, path in self.months():
+            if path.endswith('.parquet'):
+                found = pq.read_table(
+                    path, filters=[('user_id', '=', user_id)]).num_rows
+            else:
+                found = next(self._read_ndjson(path, user_id), None)
+            if not found:
+                continue
+
+            if path.endswith('.parquet'):
+                self._purge_parquet(path, user_id)
+            else:
+                self._purge_ndjson(path, user_id)
+            purged.append(month)
+
+        return purged
+
+    def _write_parquet(self, month, rows):
+        schema = pyarrow.schema([
+            ('id', pyarrow.int32()),
+            ('text', pyarrow.string()),
+            ('timestamp', pyarrow.timestamp('us')),
+            ('user_id', pyarrow.int32()),
+        ])
+
+        path = os.path.join(self.directory, f"{partition_name(month)}.parquet")
+
+        # a row group per batch: readers skip the groups whose user_id range
+        # doesn't cover the user they want
+        with open(path + '.tmp', 'wb') as f:
+            with pq.ParquetWriter(f, schema, compression='zstd') as writer:
+                for batch in batched(rows, BATCH_SIZE):
+                    writer.write_table(pyarrow.Table.from_pylist(
+                        [row._asdict() for row in batch], schema))
+        os.replace(path + '.tmp', path)
+
+    def _write_ndjson(self, month, rows):
+        path = os.path.join(self.directory,
+                            f"{partition_name(month)}.ndjson.gz")
+
+        with gzip.open(path + '.tmp', 'wt') as f:
+            for row in rows:
+                record = row._asdict()
+                record['timestamp'] = record['timestamp'].isoformat()
+                f.write(json.dumps(record) + '\n')
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _purge_parquet(path, user_id):
+        source = pq.ParquetFile(path)
+        with open(path + '.tmp', 'wb') as f:
+            with pq.ParquetWriter(f, source.schema_arrow,
+                                  compression='zstd') as writer:
+                for batch in source.iter_batches(batch_size=BATCH_SIZE):
+                    others = pc.fill_null(
+                        pc.not_equal(batch.column('user_id'), user_id), True)
+                    writer.write_table(
+                        pyarrow.Table.from_batches([batch.filter(others)]))
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _purge_ndjson(path, user_id):
+        with gzip.open(path, 'rt') as source, \
+                gzip.open(path + '.tmp', 'wt') as f:
+            for line in source:
+                if json.loads(line)['user_id'] != user_id:
+                    f.write(line)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _read_ndjson(path, user_id):
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['user_id'] == user_id:
+                    record['timestamp'] = datetime.fromisoformat(
+                        record['timestamp'])
+                    yield record
+                elif record['user_id'] is not None \
+                        and record['user_id'] > user_id:
+                    # sorted by user_id: they're all behind us
+                    return
@@ -0,0 +1,266 @@
+"""Build and serve fingerprinted, precompressed static assets.
+
+`build` downloads the third-party CSS/JS the site uses into static/vendor,
+bundles and minifies it with our own stylesheets and scripts, writes every
+file under a content-hashed name with .gz (and, if the brotli package is
+installed, .br) variants, and records the names in a manifest. `Assets`
+serves those files with year-long immutable caching and gives templates
+`asset_url` to link them.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+from urllib.request import urlopen
+
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+VENDOR = {
+    'bootstrap.css':
+        'https://unpkg.com/bootstrap@5.2.3/dist/css/bootstrap.min.css',
+    'bootstrap-icons.css':
+        'https://unpkg.com/bootstrap-icons@1.10.3/font/bootstrap-icons.css',
+    'fonts/bootstrap-icons.woff2':
+        'https://unpkg.com/bootstrap-icons@1.10.3/font/fonts/bootstrap-icons.woff2',
+    'fonts/bootstrap-icons.woff':
+        'https://unpkg.com/bootstrap-icons@1.10.3/font/fonts/bootstrap-icons.woff',
+    'jquery.js': 'https://unpkg.com/jquery@3.6.4/dist/jquery.min.js',
+    # the bundle build of bootstrap includes popper
+    'bootstrap.js':
+        'https://unpkg.com/bootstrap@5.2.3/dist/js/bootstrap.bundle.min.js',
+    'axios.js': 'https://unpkg.com/axios@1.3.4/dist/axios.min.js',
+}
+
+BUNDLES = {
+    'app.css': [
+        'vendor/bootstrap.css',
+        'vendor/bootstrap-icons.css',
+        'stylesheets/style.css',
+    ],
+    'app.js': [
+        'vendor/jquery.js',
+        'vendor/bootstrap.js',
+        'vendor/axios.js',
+        'likes.js',
+    ],
+}
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+CSS_URL = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+def vendor(static_dir, sources=VENDOR, fetch=urlopen):
+    """Download `sources` into static/vendor, skipping files already there."""
+
+    for name, url in sources.items():
+        path = os.path.join(static_dir, 'vendor', name)
+        if os.path.exists(path):
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with fetch(url) as resp, open(f"{path}.tmp", 'wb') as f:
+            shutil.copyfileobj(resp, f)
+        os.replace(f"{path}.tmp", path)
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    return re.sub(r' ?([{};,]) ?', r'\1', css).strip()
+
+
+def minify_js(js):
+    """Drop comment-only lines, indentation and blank lines.
+
+    Deliberately timid: line breaks stay put, so automatic semicolon
+    insertion still sees what the author wrote.
+    """
+
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(
+        line for line in lines if line and not line.startswith('//'))
+
+
+def hashed_name(name, content):
+    root, ext = posixpath.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{root}.{digest}{ext}"
+
+
+def build(static_dir, out_dir, bundles=BUNDLES, prefix='/assets/'):
+    """Fingerprint and compress everything in `static_dir` into `out_dir`.
+
+    Returns the manifest: logical name (relative to static/) -> hashed name.
+    """
+
+    manifest = {}
+
+    def emit(name, content):
+        hashed = hashed_name(name, content)
+        write(os.path.join(out_dir, hashed), content)
+        manifest[name] = hashed
+
+    def rewrite_urls(source, css):
+        def replace(match):
+            ref = match.group(2).split('?')[0].split('#')[0]
+            if ref.startswith('/static/'):
+                name = ref[len('/static/'):]
+            elif re.match(r'^(/|[a-z]+:)', ref):
+                return match.group(0)
+            else:
+                name = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(source), ref))
+            if name not in manifest:
+                return match.group(0)
+            return f'url("{prefix}{manifest[name]}")'
+
+        return CSS_URL.sub(replace, css)
+
+    names = sources(static_dir, out_dir)
+
+    # images and fonts first, so stylesheets can point at their hashed names
+    for name in names:
+        if not name.endswith(('.css', '.js')):
+            with open(os.path.join(static_dir, name), 'rb') as f:
+                emit(name, f.read())
+
+    for name in names:
+        if name.endswith(('.css', '.js')):
+            emit(name, read_source(static_dir, name, rewrite_urls))
+
+    for bundle, parts in bundles.items():
+        separator = b'\n' if bundle.endswith('.css') else b';\n'
+        emit(bundle, separator.join(
+            read_source(static_dir, name, rewrite_urls) for name in parts))
+
+    write(os.path.join(out_dir, 'manifest.json'),
+          json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    return manifest
+
+
+def sources(static_dir, out_dir):
+    """Every file under `static_dir` except the build output, as
+    slash-separated names relative to `static_dir`.
+    """
+
+    out_dir = os.path.abspath(out_dir)
+    names = []
+
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if os.path.abspath(os.path.join(dirpath, d)) != out_dir)
+
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, filename), static_dir)
+            names.append(path.replace(os.sep, '/'))
+
+    return names
+
+
+def read_source(static_dir, name, rewrite_urls):
+    with open(os.path.join(static_dir, name), encoding='utf-8') as f:
+        text = f.read()
+
+    if name.endswith('.css'):
+        text = minify_css(rewrite_urls(name, text))
+    elif not name.endswith('.min.js') and not name.startswith('vendor/'):
+        text = minify_js(text)
+
+    return text.encode('utf-8')
+
+
+def write(path, content):
+    """Write `content` to `path`, plus precompressed copies if worthwhile."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+
+    # mtime=0 keeps rebuilds byte-for-byte identical
+    with open(f"{path}.gz", 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        with open(f"{path}.br", 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+class Assets:
+    """Serves built assets from /assets/ and adds `asset_url` to templates.
+
+    app.config['ASSETS_DIR'] is where `build` wrote its output. Without a
+    build (no manifest there), `asset_url` falls back to the plain /static/
+    files and `assets_built()` is false, so templates can keep their CDN
+    links in development.
+    """
+
+    def __init__(self, app):
+        self.out_dir = app.config['ASSETS_DIR']
+        self.manifest = {}
+        self.load()
+
+        app.add_url_rule('/assets/<path:filename>', 'serve_asset',
+                         self.serve)
+        app.add_template_global(self.asset_url, 'asset_url')
+        app.add_template_global(self.built, 'assets_built')
+
+    def load(self):
+        try:
+            with open(os.path.join(self.out_dir, 'manifest.json')) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def built(self):
+        return bool(self.manifest)
+
+    def asset_url(self, name):
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return url_for('static', filename=name)
+        return f"/assets/{hashed}"
+
+    def serve(self, filename):
+        """Send a fingerprinted file, precompressed if the client allows."""
+
+        path = os.path.abspath(os.path.join(self.out_dir, filename))
+        if (not path.startswith(os.path.abspath(self.out_dir) + os.sep)
+                or not os.path.isfile(path)):
+            abort(404)
+
+        accepted = request.accept_encodings
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[candidate] and os.path.isfile(path + suffix):
+                encoding = candidate
+                break
+
+        response = send_file(
+            path + ('.br' if encoding == 'br' else '.gz' if encoding else ''),
+            download_name=os.path.basename(path),
+            conditional=True,
+            max_age=ONE_YEAR,
+        )
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
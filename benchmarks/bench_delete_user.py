@@ -0,0 +1,87 @@
+"""Benchmark deleting a heavy account.
+
+Builds a user with N messages who has liked N messages, and whose messages
+have N likes, then times deleting them. Needs Postgres (rows are made with
+generate_series). Run from the repo root against a scratch database:
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_delete_user --rows 1000000 --mode purge
+
+--mode cascade times a single DELETE of the user relying on ON DELETE
+CASCADE; --mode purge times User.purge's batched deletes.
+"""
+
+import argparse
+import os
+import time
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+
+from app import app
+from models import db, User
+
+
+def make_heavy_user(rows):
+    """Create the heavy user and a fan of theirs; returns the user's id."""
+
+    user = User(username="heavy", email="heavy@bench", password="x")
+    fan = User(username="fan", email="fan@bench", password="x")
+    db.session.add_all([user, fan])
+    db.session.flush()
+
+    params = {"user_id": user.id, "fan_id": fan.id, "rows": rows}
+
+    db.session.execute(db.text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'warble ' || n, now() - n * interval '1 second', u
+        FROM generate_series(1, :rows) AS n,
+             (VALUES (:user_id), (:fan_id)) AS authors (u)
+    """), params)
+
+    # each of them likes every message the other wrote
+    db.session.execute(db.text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT CASE m.user_id WHEN :user_id THEN :fan_id ELSE :user_id END,
+               m.id
+        FROM messages m
+        WHERE m.user_id IN (:user_id, :fan_id)
+    """), params)
+
+    db.session.commit()
+    return user.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--mode", choices=["purge", "cascade"],
+                        default="purge")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        User.query.filter(User.username.in_(["heavy", "fan"])).delete()
+        db.session.commit()
+
+        start = time.perf_counter()
+        user_id = make_heavy_user(args.rows)
+        print(f"setup: {args.rows} messages + likes each way "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        if args.mode == "purge":
+            User.purge(user_id, batch_size=args.batch_size)
+        else:
+            db.session.delete(User.query.get(user_id))
+            db.session.commit()
+        elapsed = time.perf_counter() - start
+
+        print(f"{args.mode}: deleted user #{user_id} in {elapsed:.2f}s")
+
+        User.query.filter_by(username="fan").delete()
+        db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark the per-request cost of the rate limiter.
+
+Times RateLimiter.check() for a route with an IP and a user bucket, for
+each store. Run from the repo root:
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_ratelimit
+"""
+
+import argparse
+import os
+import time
+from types import SimpleNamespace
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+
+from flask import g
+
+from app import app
+from models import db
+from ratelimit import RateLimiter
+
+
+def bench(storage, requests):
+    app.config['RATELIMIT_STORAGE'] = storage
+    limiter = RateLimiter(app)
+    limiter.reset()
+
+    with app.test_request_context("/", environ_base={
+            "REMOTE_ADDR": "10.0.0.1"}):
+        g.user = SimpleNamespace(id=1)
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            limiter.check('bench')
+        elapsed = time.perf_counter() - start
+
+    return elapsed / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+
+    # a bucket big enough that nothing is refused mid-run
+    app.config['RATELIMITS'] = {
+        'bench': {'ip': (10 ** 9, 1), 'user': (10 ** 9, 1)}}
+
+    for storage in ("memory", "shared", "database"):
+        requests = args.requests if storage != "database" else 1000
+        print(f"{storage:>8}: {bench(storage, requests):8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Benchmark rendering list pages from ORM entities versus read models.
+
+Seeds --users users with --messages messages each, the viewer following
+--follows of them, then for the home feed and the full user list times
+loading and rendering the page both ways, and reports the peak memory
+allocated per request (tracemalloc). The "orm" side is the code these
+pages used before readmodels.py: full User/Message instances, with likes
+and follows checked through the viewer's relationships. Run from the repo
+root against a scratch database:
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_readmodels --users 5000
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+
+from flask import (
+    render_template, render_template_string, session, stream_template)
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+import readmodels
+
+ORM_FEED = """
+{% for msg in messages %}
+  <li class="list-group-item">
+    <a href="/users/{{ msg.user.id }}">
+      <img src="{{ thumbnail_url(msg.user.image_url, 'avatar') }}">
+    </a>
+    <a href="/users/{{ msg.user.id }}">@{{ msg.user.username }}</a>
+    <span>{{ msg.timestamp.strftime('%d %B %Y') }}</span>
+    <p>{{ msg.text }}</p>
+    {% if msg in g.user.likes %}
+    <form action="/{{msg.id}}/unlike" method="POST"></form>
+    {% else %}
+    <form action="/{{msg.id}}/like" method="POST"></form>
+    {% endif %}
+  </li>
+{% endfor %}
+"""
+
+ORM_USERS = """
+{% extends 'base.html' %}
+{% block content %}
+{% for user in users %}
+  <div class="card user-card">
+    <img src="{{ thumbnail_url(user.header_image_url, 'card-hero') }}">
+    <a href="/users/{{ user.id }}">
+      <img src="{{ thumbnail_url(user.image_url, 'card') }}">
+      <p>@{{ user.username }}</p>
+    </a>
+    {% if g.user.is_following(user) %}
+    <form method="POST" action="/users/stop-following/{{ user.id }}"></form>
+    {% else %}
+    <form method="POST" action="/users/follow/{{ user.id }}"></form>
+    {% endif %}
+    <p class="card-bio"> {{ user.bio }}</p>
+  </div>
+{% endfor %}
+{% endblock %}
+"""
+
+
+def seed(users, messages, follows):
+    """Create the users, their messages and the viewer; returns its id."""
+
+    db.session.execute(db.text("TRUNCATE users RESTART IDENTITY CASCADE"))
+    params = {"users": users, "messages": messages, "follows": follows}
+
+    db.session.execute(db.text("""
+        INSERT INTO users (email, username, image_url, header_image_url,
+                           bio, password)
+        SELECT 'u' || n || '@bench', 'user' || n,
+               '/static/images/default-pic.png',
+               '/static/images/warbler-hero.jpg',
+               repeat('A bio. ', 20), repeat('x', 60)
+        FROM generate_series(1, :users) AS n
+    """), params)
+
+    db.session.execute(db.text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'warble ' || n, now() - (n * :users + u) * interval '1 second',
+               u
+        FROM generate_series(1, :messages) AS n,
+             generate_series(1, :users) AS u
+    """), params)
+
+    # user 1 is the viewer: following the first --follows users and liking
+    # every other message of theirs
+    db.session.execute(db.text("""
+        INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT u, 1 FROM generate_series(2, :follows + 1) AS u
+    """), params)
+    db.session.execute(db.text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT 1, id FROM messages
+        WHERE user_id BETWEEN 2 AND :follows + 1 AND id % 2 = 0
+    """), params)
+
+    db.session.commit()
+    return 1
+
+
+def orm_feed(viewer_id):
+    following_ids = [u.id for u in User.query.get(viewer_id).following]
+    following_ids.append(viewer_id)
+
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(following_ids))
+                .order_by(Message.timestamp.desc())
+                .limit(100)
+                .all())
+
+    return render_template_string(ORM_FEED, messages=messages)
+
+
+def readmodel_feed(viewer_id):
+    following_ids = [u.id for u in User.query.get(viewer_id).following]
+    following_ids.append(viewer_id)
+
+    messages = readmodels.feed(following_ids, viewer_id)
+
+    return render_template('messages/_feed.html', messages=messages)
+
+
+def orm_users(viewer_id):
+    return render_template_string(ORM_USERS, users=User.query.all())
+
+
+def readmodel_users(viewer_id):
+    # consumed the way the streamed response is: chunk by chunk, unkept
+    users = readmodels.search_users(viewer_id)
+    for _chunk in stream_template('users/index.html', users=users):
+        pass
+
+
+def measure(page, viewer_id, repeat):
+    """Mean seconds per request and peak bytes allocated by one request."""
+
+    def request():
+        with app.test_request_context("/"):
+            session[CURR_USER_KEY] = viewer_id
+            app.preprocess_request()
+            page(viewer_id)
+            db.session.remove()
+
+    request()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        request()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    request()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--follows", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        viewer_id = seed(args.users, args.messages, args.follows)
+
+    pages = [
+        ("feed", orm_feed, readmodel_feed),
+        ("users", orm_users, readmodel_users),
+    ]
+
+    for name, orm_page, readmodel_page in pages:
+        for label, page in (("orm", orm_page), ("readmodel", readmodel_page)):
+            elapsed, peak = measure(page, viewer_id, args.repeat)
+            print(f"{name:>5} {label:>9}: {elapsed * 1000:8.1f} ms/request, "
+                  f"peak {peak / 1024 / 1024:7.2f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark the hot lookups as lambda statements versus built per call.
+
+For each statement every request runs -- loading g.user, authenticate's
+username lookup, the Like primary-key lookup and the home feed -- times
+the query as it was written before (built, and its cache key computed,
+on every call) against a lambda statement. Both run against the same
+small tables, so the difference is the Python-side cost of constructing
+the statement. Run from the repo
+root against a scratch database:
+
+    BENCH_DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_statements
+"""
+
+import argparse
+import os
+import time
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+
+from app import app
+from models import db, User, Message, Like
+import readmodels
+
+
+def seed():
+    db.session.execute(db.text("TRUNCATE users RESTART IDENTITY CASCADE"))
+
+    users = [User(username=f"user{n}", email=f"u{n}@bench", password="x")
+             for n in range(20)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    messages = [Message(text=f"warble {n}", user_id=users[n % 20].id)
+                for n in range(200)]
+    db.session.add_all(messages)
+    db.session.flush()
+
+    db.session.add_all(Like(user_id=users[0].id, message_id=message.id)
+                       for message in messages[::2])
+    db.session.commit()
+
+    return [user.id for user in users], messages[0].id
+
+
+def old_feed(author_ids, viewer_id, limit=100):
+    stmt = (readmodels.message_rows(viewer_id)
+            .where(Message.user_id.in_(author_ids))
+            .order_by(Message.timestamp.desc())
+            .limit(limit))
+    return readmodels.fetch(stmt, readmodels.MessageRow)
+
+
+# The primary-key lookups as lambda statements, to compare with Query.get
+# (which already caches its statement, so stays as it is in app.py).
+
+def lambda_user(user_id):
+    stmt = db.lambda_stmt(lambda: db.select(User).where(User.id == user_id))
+    return db.session.execute(stmt).scalar_one_or_none()
+
+
+def lambda_like(user_id, message_id):
+    stmt = db.lambda_stmt(lambda: db.select(Like).where(
+        Like.user_id == user_id, Like.message_id == message_id))
+    return db.session.execute(stmt).scalar_one_or_none()
+
+
+def timed(fn, calls):
+    fn()
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+        db.session.expunge_all()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        user_ids, message_id = seed()
+        viewer_id = user_ids[0]
+
+        cases = [
+            ("g.user",
+             lambda: User.query.get(viewer_id),
+             lambda: lambda_user(viewer_id)),
+            ("authenticate",
+             lambda: User.query.filter_by(username="user7").first(),
+             lambda: User.by_username("user7")),
+            ("like lookup",
+             lambda: Like.query.get((viewer_id, message_id)),
+             lambda: lambda_like(viewer_id, message_id)),
+            ("feed",
+             lambda: old_feed(user_ids[:10], viewer_id),
+             lambda: readmodels.feed(user_ids[:10], viewer_id)),
+        ]
+
+        for name, before, after in cases:
+            old_us = timed(before, args.calls)
+            new_us = timed(after, args.calls)
+            print(f"{name:>12}: {old_us:8.1f} us -> {new_us:8.1f} us per call"
+                  f" ({old_us - new_us:+.1f} us saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Keep a slow or unreachable database from taking every worker with it.
+
+Each request's statements run under a statement timeout, looked up by
+endpoint in STATEMENT_TIMEOUTS (STATEMENT_TIMEOUT_MS otherwise), so a
+stuck query ends long before gunicorn would kill the worker. Postgres
+enforces it; on other databases statements that overrun only count as
+failures.
+
+Timeouts, overruns and lost connections count against a circuit breaker.
+After DB_BREAKER_FAILURES of them in a row it opens: for DB_BREAKER_RESET
+seconds every statement (bar transaction control, so requests can still
+clean up) fails at once with DatabaseUnavailable, without waiting on the
+database. Then one request's statements are let through: if they
+succeed the breaker closes, if not it stays open for another period.
+
+Pages the app remembers are kept, compressed, as last-known-good copies
+to serve while the database is unavailable.
+"""
+
+import re
+import time
+import zlib
+from datetime import datetime
+from contextlib import contextmanager
+from threading import Lock, get_ident, local
+
+from flask import has_request_context, request
+from sqlalchemy import event, exc
+
+from cache import TaggedCache
+from models import db
+
+# let through even with the breaker open, so failed requests can clean up
+TRANSACTION_CONTROL = re.compile(
+    r"\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE)
+
+
+class DatabaseUnavailable(Exception):
+    """The circuit breaker is open: the database isn't being asked."""
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures. Once it's been open
+    `reset_after` seconds, one caller at a time is let through to try the
+    database: its success closes the breaker, its failure (or silence for
+    another `reset_after`) keeps it open.
+    """
+
+    def __init__(self, failures=5, reset_after=30):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._failed = 0
+        self._opened_at = None
+        self._prober = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        """Whether the breaker is open (or half-open, trying a call)."""
+
+        return self._opened_at is not None
+
+    def allow(self):
+        """Whether this caller may use the database now."""
+
+        if self._opened_at is None or self._prober == get_ident():
+            return True
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after:
+                return False
+
+            # half-open: this caller tries the database; everyone else
+            # keeps failing fast until it answers
+            self._opened_at = time.monotonic()
+            self._prober = get_ident()
+            return True
+
+    def success(self):
+        """Record a call that worked. Closes the breaker if it was the
+        call trying the database again.
+        """
+
+        if not self._failed and self._opened_at is None:
+            return
+
+        with self._lock:
+            # calls that started before the breaker opened prove nothing
+            if self._opened_at is not None and self._prober != get_ident():
+                return
+            self._failed = 0
+            self._opened_at = None
+            self._prober = None
+
+    def failure(self):
+        """Record a call that failed. Returns True if that opened the
+        breaker.
+        """
+
+        with self._lock:
+            self._failed += 1
+            if self._opened_at is None and self._failed < self.failures:
+                return False
+
+            opened = self._opened_at is None or self._prober == get_ident()
+            self._opened_at = time.monotonic()
+            self._prober = None
+            return opened
+
+    def reset(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._prober = None
+
+
+class DatabaseGuard:
+    """Statement timeouts and a circuit breaker on `app`'s engine (and any
+    others passed to `watch`), and the last-known-good pages to serve while
+    the breaker is open.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.breaker = CircuitBreaker(app.config['DB_BREAKER_FAILURES'],
+                                      app.config['DB_BREAKER_RESET'])
+        self.pages = TaggedCache(maxsize=app.config['DEGRADED_PAGES_MAX'],
+                                 ttl=app.config['DEGRADED_PAGE_MAX_AGE'])
+        self._local = local()
+
+        self.watch(db.get_engine(app))
+
+    def watch(self, *engines):
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before)
+            event.listen(engine, 'after_cursor_execute', self._after)
+            event.listen(engine, 'handle_error', self._error)
+            # rolling back undoes a SET made in the transaction
+            event.listen(engine, 'rollback', self._forget_timeout)
+            event.listen(engine, 'rollback_savepoint', self._forget_timeout)
+
+    def available(self):
+        """Whether this request may use the database (see
+        CircuitBreaker.allow).
+        """
+
+        return self.breaker.allow()
+
+    def timeout_ms(self):
+        """The statement timeout for the current request, or None outside
+        one (background tasks and commands run unbounded). Threads working
+        for a request get its timeout through `statement_timeout`.
+        """
+
+        timeout = getattr(self._local, 'timeout', None)
+        if timeout is not None:
+            return timeout
+
+        if not has_request_context():
+            return None
+
+        return self.app.config['STATEMENT_TIMEOUTS'].get(
+            request.endpoint, self.app.config['STATEMENT_TIMEOUT_MS'])
+
+    @contextmanager
+    def statement_timeout(self, timeout):
+        """Run this thread's statements under `timeout` (ms), as if for the
+        request that asked for it.
+        """
+
+        saved = getattr(self._local, 'timeout', None)
+        self._local.timeout = timeout
+        try:
+            yield
+        finally:
+            self._local.timeout = saved
+
+    def remember(self, key, html):
+        """Keep `html` to serve for `key` while the database is down."""
+
+        self.pages.set(key, (datetime.utcnow(),
+                             zlib.compress(html.encode(), 1)))
+
+    def remembered(self, key):
+        """The last page kept for `key`, as (saved at, html), or None."""
+
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+
+        saved_at, page = entry
+        return saved_at, zlib.decompress(page).decode()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if TRANSACTION_CONTROL.match(statement):
+            conn.info.setdefault('guard_started', []).append(None)
+            return
+
+        if not self.breaker.allow():
+            raise DatabaseUnavailable()
+
+        timeout = self.timeout_ms()
+        if (conn.dialect.name == 'postgresql'
+                and conn.info.get('statement_timeout') != timeout):
+            # on a cursor of its own: `cursor` may be a named one
+            setter = conn.connection.cursor()
+            try:
+                setter.execute(f"SET statement_timeout = {int(timeout or 0)}")
+            finally:
+                setter.close()
+            conn.info['statement_timeout'] = timeout
+
+        conn.info.setdefault('guard_started', []).append(
+            (time.perf_counter(), timeout))
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        entry = conn.info['guard_started'].pop()
+        if entry is None:
+            return
+
+        started, timeout = entry
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        if timeout and elapsed_ms > timeout:
+            self._failed(f"{elapsed_ms:.0f}ms statement")
+        else:
+            self.breaker.success()
+
+    def _error(self, context):
+        if isinstance(context.original_exception, DatabaseUnavailable):
+            return
+
+        if context.connection is not None:
+            started = context.connection.info.get('guard_started')
+            if started:
+                started.pop()
+
+        # timeouts and lost connections, not constraint violations
+        if (context.is_disconnect
+                or isinstance(context.sqlalchemy_exception,
+                              exc.OperationalError)):
+            self._failed(context.original_exception)
+
+    def _failed(self, reason):
+        if self.breaker.failure():
+            self.app.logger.warning(
+                f"Database circuit breaker opened ({reason}); retrying in "
+                f"{self.breaker.reset_after}s")
+
+    @staticmethod
+    def _forget_timeout(conn, *args):
+        conn.info.pop('statement_timeout', None)
@@ -0,0 +1,77 @@
+"""Small in-process caches."""
+
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+
+class TaggedCache:
+    """A bounded LRU cache whose entries can be dropped by tag.
+
+    Writers invalidate the tags they affect in their own process; entries
+    also expire after `ttl` seconds, which bounds how stale another
+    worker's copy can get.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_tag = defaultdict(set)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """The cached value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value, _tags = entry
+            if expires < time.monotonic():
+                self._discard(key)
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=()):
+        """Cache `value` under `key`, to be dropped when any of `tags` is."""
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of `tags`."""
+
+        with self._lock:
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
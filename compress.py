@@ -0,0 +1,152 @@
+"""On-the-fly gzip/brotli compression that keeps streamed responses streaming."""
+
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = (
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+)
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        # wbits=31: a gzip header and trailer rather than a bare zlib stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return (self._compressor.compress(data)
+                + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def chunk(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class Compress:
+    """WSGI middleware compressing text responses the client accepts.
+
+    Every chunk the app yields is compressed and flushed straight away, so
+    a page rendered with `stream_template` still reaches the browser a
+    piece at a time, and no worker holds a whole page in memory. Responses
+    that are already encoded (the precompressed /assets/), event streams
+    and anything shorter than `min_size` pass through untouched, as the
+    app's own iterable.
+
+    A compressed body isn't byte-for-byte the one its ETag was made for,
+    so a strong ETag is sent on as a weak one: still good for a
+    conditional GET. The CSRF tokens in pages are masked (forms.MaskedCSRF)
+    so that compressing them doesn't leak them.
+    """
+
+    encoders = {'br': BrotliEncoder, 'gzip': GzipEncoder}
+
+    def __init__(self, app, min_size=500, gzip_level=6, brotli_level=4):
+        self.app = app
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_level}
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        encoders = []
+        started = []
+
+        def start(status, headers, exc_info=None):
+            started.append(status)
+            if self.should_compress(status, headers):
+                headers = [weak_etag(name, value) for name, value in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', encoding))
+                vary(headers, 'Accept-Encoding')
+                encoders.append(self.encoders[encoding](self.levels[encoding]))
+
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, start)
+        if started and not encoders:
+            # Hand back the app's own iterable, so that a wsgi.file_wrapper
+            # (send_file) can still go out with sendfile. Apps that only
+            # call start_response once iterated are decided on the way.
+            return body
+        return self.compressed(body, encoders)
+
+    def negotiate(self, accept_encoding):
+        """The best encoding both sides support, or None."""
+
+        accepted = parse_accept_header(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding == 'br' and brotli is None:
+                continue
+            if accepted[encoding]:
+                return encoding
+        return None
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+
+        headers = {name.lower(): value for name, value in headers}
+        mimetype = headers.get('content-type', '').split(';')[0].strip()
+
+        return (mimetype in COMPRESSIBLE
+                and 'content-encoding' not in headers
+                and int(headers.get('content-length', self.min_size))
+                >= self.min_size)
+
+    @staticmethod
+    def compressed(body, encoders):
+        try:
+            for data in body:
+                if not encoders:
+                    yield data
+                elif data:
+                    yield encoders[0].chunk(data)
+
+            if encoders:
+                yield encoders[0].finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def weak_etag(name, value):
+    """A WSGI header, with an ETag's value made weak."""
+
+    if name.lower() == 'etag' and not value.startswith('W/'):
+        return name, f"W/{value}"
+    return name, value
+
+
+def vary(headers, field):
+    """Add `field` to the Vary header in a list of WSGI headers."""
+
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if field.lower() not in value.lower():
+                headers[i] = (name, f"{value}, {field}")
+            return
+    headers.append(('Vary', field))
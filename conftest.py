@@ -0,0 +1,150 @@
+"""pytest setup: a database per worker, and a transaction per test.
+
+Tests run against TEST_DATABASE_URL (postgresql:///warbler_test unless
+set; a sqlite:/// file works too, for quick local runs). Under
+pytest-xdist, `pytest -n auto`, each worker gets a fresh database of its
+own, named after the worker, e.g. warbler_test_gw0.
+
+Each test runs inside a transaction that's rolled back when it ends. The
+app's commits only release a SAVEPOINT, so nothing a test writes through
+db.session outlives it or shows up in another test.
+
+Password hashes use BCRYPT_LOG_ROUNDS=4 unless that's set: they check the
+same, and take a fraction of the time to make.
+"""
+
+import os
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+TEST_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler_test")
+
+
+def worker_database_url(url, worker):
+    """`url` with its database name suffixed by the xdist `worker`."""
+
+    url = make_url(url)
+    if not worker:
+        return str(url)
+
+    if url.get_backend_name() == 'sqlite':
+        root, ext = os.path.splitext(url.database)
+        return str(url.set(database=f"{root}_{worker}{ext}"))
+
+    return str(url.set(database=f"{url.database}_{worker}"))
+
+
+def create_database(url):
+    """Create `url`'s database and tables, dropping any left from an
+    earlier run. (With the tables there, the app won't load its seed data.)
+    """
+
+    from models import db
+
+    url = make_url(url)
+
+    if url.get_backend_name() == 'sqlite':
+        if url.database and os.path.exists(url.database):
+            os.remove(url.database)
+    else:
+        server = create_engine(url.set(database='postgres'),
+                               isolation_level='AUTOCOMMIT')
+        with server.connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{url.database}"'))
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+        server.dispose()
+
+    engine = create_engine(url)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+
+# Before any test module imports the app, which reads these
+worker = os.environ.get('PYTEST_XDIST_WORKER')
+os.environ['DATABASE_URL'] = worker_database_url(TEST_DATABASE_URL, worker)
+os.environ.setdefault('SECRET_KEY', "test")
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', "4")
+
+if worker or make_url(TEST_DATABASE_URL).get_backend_name() == 'sqlite':
+    create_database(os.environ['DATABASE_URL'])
+
+
+@pytest.fixture(scope='session')
+def engine():
+    from app import app
+    from models import db
+
+    engine = db.get_engine(app)
+
+    if engine.dialect.name == 'sqlite':
+        # task threads share the test's connection
+        @event.listens_for(engine, 'do_connect')
+        def any_thread(dialect, connection_record, cargs, cparams):
+            cparams['check_same_thread'] = False
+
+        # pysqlite starts and ends transactions on its own terms, which
+        # breaks SAVEPOINT; leave them to SQLAlchemy
+        @event.listens_for(engine, 'connect')
+        def no_pysqlite_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(conn):
+            conn.exec_driver_sql("BEGIN")
+
+        engine.dispose()
+
+    return engine
+
+
+@pytest.fixture(autouse=True)
+def rollback_transaction(engine):
+    """Bind db.session to one connection whose transaction is rolled back
+    after the test; each commit ends a SAVEPOINT and starts the next.
+    """
+
+    from models import db
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    savepoint = connection.begin_nested()
+
+    # configure db.session's factory rather than replace it, so listeners
+    # on it (tasks.py's commit hooks) still fire, and task threads share
+    # the test's connection too
+    factory = db.session.session_factory
+    options = dict(factory.kw)
+    db.session.remove()
+    factory.configure(bind=connection, binds={})
+
+    def restart_savepoint(session, session_transaction):
+        nonlocal savepoint
+        if not savepoint.is_active:
+            savepoint = connection.begin_nested()
+
+    event.listen(db.session, 'after_transaction_end', restart_savepoint)
+
+    yield
+
+    # tasks left queued would finish on this connection mid-way through
+    # the next test; they delete their jobs rows when done
+    from app import tasks
+    tasks.drain()
+
+    # nor should the follows it made live on in the app's follow graph
+    import app
+    app.follow_graph = None
+    app.follow_changes.clear()
+    if app.follow_events is not None:
+        app.warbles.unsubscribe(app.follow_events)
+        app.follow_events = None
+
+    event.remove(db.session, 'after_transaction_end', restart_savepoint)
+    db.session.remove()
+    factory.kw = options
+
+    transaction.rollback()
+    connection.close()
@@ -0,0 +1,166 @@
+"""Publish/subscribe for pushing live updates to connected browsers."""
+
+import json
+import select
+import time
+from collections import defaultdict
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+from models import db
+
+
+class Subscription:
+    """A queue of events for one connected client, filtered by key.
+
+    Use as a context manager so the client is unsubscribed when its
+    stream closes.
+    """
+
+    def __init__(self, bus, keys, max_pending=100):
+        self.bus = bus
+        self.keys = frozenset(keys)
+        self.overflowed = False
+        self._queue = Queue(maxsize=max_pending)
+
+    def get(self, timeout=None):
+        """The next event, or None if nothing arrives within `timeout`."""
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            # a client this far behind only needs to know there's more
+            self.overflowed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.bus.unsubscribe(self)
+
+
+class LocalBus:
+    """Delivers events to subscribers in this process.
+
+    Subscribers are indexed by key, so publishing costs one lookup however
+    many idle clients are connected.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = Lock()
+
+    def subscribe(self, keys, max_pending=100):
+        subscription = Subscription(self, keys, max_pending)
+
+        with self._lock:
+            for key in subscription.keys:
+                self._subscribers[key].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    def publish(self, key, event):
+        """Send `event` to everyone subscribed to `key`."""
+
+        self.deliver(key, event)
+
+    def deliver(self, key, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscribers.values()))
+
+
+class PostgresBus(LocalBus):
+    """Fans events out to every worker on every host via LISTEN/NOTIFY.
+
+    `publish` sends a NOTIFY; one listener thread per process receives
+    them all and delivers to the local subscribers.
+    """
+
+    def __init__(self, app, channel='warbler_events'):
+        super().__init__()
+        self.app = app
+        self.channel = channel
+        self._listener = None
+
+    def subscribe(self, keys, max_pending=100):
+        self._listen()
+        return super().subscribe(keys, max_pending)
+
+    def publish(self, key, event):
+        payload = json.dumps([key, event])
+        engine = db.get_engine(self.app)
+
+        with engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(db.select(db.func.pg_notify(self.channel, payload)))
+
+    def _listen(self):
+        if self._listener is not None:
+            return
+
+        with self._lock:
+            if self._listener is None:
+                self._listener = Thread(target=self._run, daemon=True)
+                self._listener.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen_forever()
+            except Exception:
+                self.app.logger.exception("Event listener lost; reconnecting")
+                time.sleep(5)
+
+    def _listen_forever(self):
+        # a connection of its own rather than one borrowed from the pool,
+        # which would go back to the pool still listening
+        engine = db.get_engine(self.app)
+        args, kwargs = engine.dialect.create_connect_args(engine.url)
+        conn = engine.dialect.connect(*args, **kwargs)
+
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN "{self.channel}"')
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    key, event = json.loads(notify.payload)
+                    self.deliver(key, event)
+        finally:
+            conn.close()
+
+
+def make_bus(app):
+    """The bus app.config['EVENTS_BACKEND'] asks for: 'postgres' or 'local'."""
+
+    if app.config['EVENTS_BACKEND'] == 'postgres':
+        return PostgresBus(app)
+
+    return LocalBus()
@@ -0,0 +1,127 @@
+"""Personal data exports: a zip of everything a user has put into Warbler.
+
+`Exports.build` writes the archive to EXPORT_DIR as it reads: every query
+streams from a server-side cursor STREAM_ROWS rows at a time, and each row
+goes straight into a deflated zip member as a line of JSON, so memory use
+is the same for an account with ten messages or ten million. The file is
+written under a temporary name and renamed into place when complete.
+
+Downloads are then a plain file for send_file, which honours Range and
+If-Range: a large export that drops halfway resumes where it stopped
+instead of starting over.
+
+The archive holds:
+
+    profile.json        the user's own profile (no password hash)
+    messages.ndjson     their messages, newest first, archived ones included
+    likes.ndjson        the messages they've liked
+    following.ndjson    who they follow
+    followers.ndjson    who follows them
+"""
+
+import json
+import os
+import tempfile
+import zipfile
+from datetime import datetime
+
+from models import db, User, Follows
+
+PROFILE_FIELDS = ['id', 'username', 'email', 'image_url',
+                  'header_image_url', 'bio', 'location']
+
+
+def json_line(record):
+    return (json.dumps(record, default=datetime.isoformat) + "\n").encode()
+
+
+class Exports:
+    """Builds and keeps users' data exports for `app`.
+
+    app.config['EXPORT_DIR'] is where they're kept; STREAM_ROWS is how many
+    rows each query reads at a time.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.dir = app.config['EXPORT_DIR']
+
+    def path(self, user_id):
+        return os.path.join(self.dir, f"{user_id}.zip")
+
+    def built_at(self, user_id):
+        """When `user_id`'s export was built, or None if there isn't one."""
+
+        try:
+            return datetime.utcfromtimestamp(
+                os.path.getmtime(self.path(user_id)))
+        except FileNotFoundError:
+            return None
+
+    def build(self, user_id, messages, likes):
+        """Write `user_id`'s export, with `messages` and `likes` the
+        MessageRows to include (wherever they're stored).
+        """
+
+        rows = self.app.config['STREAM_ROWS']
+        path = self.path(user_id)
+        os.makedirs(self.dir, exist_ok=True)
+
+        profile = db.session.execute(
+            db.select(*(getattr(User, field) for field in PROFILE_FIELDS))
+            .where(User.id == user_id)).one()
+
+        sections = [
+            ('messages.ndjson',
+             ({'id': m.id, 'text': m.text, 'timestamp': m.timestamp}
+              for m in messages)),
+            ('likes.ndjson',
+             ({'message_id': m.id, 'author': m.username, 'text': m.text,
+               'timestamp': m.timestamp}
+              for m in likes)),
+            ('following.ndjson',
+             self._follows(Follows.user_following_id, user_id,
+                           Follows.user_being_followed_id, rows)),
+            ('followers.ndjson',
+             self._follows(Follows.user_being_followed_id, user_id,
+                           Follows.user_following_id, rows)),
+        ]
+
+        # a name of its own: two builds for one user can run at once
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=f"{user_id}.",
+                                   suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f, \
+                    zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('profile.json', json.dumps(
+                    dict(zip(PROFILE_FIELDS, profile)), indent=2))
+
+                for name, records in sections:
+                    with archive.open(name, 'w', force_zip64=True) as member:
+                        for record in records:
+                            member.write(json_line(record))
+
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def remove(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _follows(side, user_id, other, rows):
+        """Stream the users on the `other` side of `user_id`'s follows."""
+
+        result = db.session.execute(
+            db.select(User.id, User.username)
+            .join(Follows, other == User.id)
+            .where(side == user_id)
+            .order_by(User.id)
+            .execution_options(yield_per=rows))
+
+        for id, username in result:
+            yield {'id': id, 'username': username}
@@ -1,15 +1,63 @@
+import base64
+import os
+
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from flask_wtf.file import FileAllowed, FileField
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.csrf.core import CSRF
+from wtforms.validators import DataRequired, Email, Length, ValidationError
+
+
+class MaskedCSRF(CSRF):
+    """Flask-WTF's CSRF token, XORed with a fresh random mask each time a
+    form is built.
+
+    Pages are compressed, and a compressed page's size gives away whether
+    text an attacker got echoed into it matches the token (BREACH). Masked,
+    the token is never the same twice, so there's nothing to match.
+    """
+
+    def setup_form(self, form):
+        self.meta = form.meta
+        return super().setup_form(form)
+
+    def generate_csrf_token(self, csrf_token_field):
+        token = generate_csrf(secret_key=self.meta.csrf_secret,
+                              token_key=self.meta.csrf_field_name).encode()
+        mask = os.urandom(len(token))
+        return base64.urlsafe_b64encode(mask + xor(mask, token)).decode()
+
+    def validate_csrf_token(self, form, field):
+        try:
+            masked = base64.urlsafe_b64decode(field.data or '')
+        except ValueError:
+            raise ValidationError("The CSRF token is invalid.")
+
+        half = len(masked) // 2
+        token = xor(masked[:half], masked[half:]).decode('ascii', 'replace')
+        validate_csrf(token, self.meta.csrf_secret,
+                      self.meta.csrf_time_limit, self.meta.csrf_field_name)
+
+
+def xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+class Form(FlaskForm):
+    """A FlaskForm with its CSRF token masked."""
+
+    class Meta:
+        csrf_class = MaskedCSRF
 
 
-class MessageForm(FlaskForm):
+class MessageForm(Form):
     """Form for adding/editing messages."""
 
     text = TextAreaField('text', validators=[DataRequired()])
 
 
-class UserAddForm(FlaskForm):
+class UserAddForm(Form):
     """Form for adding users."""
 
     username = StringField('Username', validators=[DataRequired()])
@@ -18,21 +66,25 @@ class UserAddForm(FlaskForm):
     image_url = StringField('(Optional) Image URL')
 
 
-class LoginForm(FlaskForm):
+class LoginForm(Form):
     """Login form."""
 
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[Length(min=6)])
 
-class EditProfileForm(FlaskForm):
+class EditProfileForm(Form):
     """Edit profile form"""
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     image_url = StringField('(Optional) Image URL')
     header_image_url = StringField('(Optional) Header Image URL')
+    image_file = FileField('(Optional) Upload Image', validators=[
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'], 'Images only')])
+    header_image_file = FileField('(Optional) Upload Header Image', validators=[
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'], 'Images only')])
     bio = StringField('bio')
     password = PasswordField('Password', validators=[Length(min=6)])
 
 
-class CSRFProtectForm(FlaskForm):
+class CSRFProtectForm(Form):
     """ Form for CSRF Protection """
\ No newline at end of file
@@ -0,0 +1,267 @@
+"""Read-optimized, in-memory snapshot of the follow graph."""
+
+import mmap
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+
+from models import db, Follows
+
+MAGIC = b'WFGRAPH1'
+HEADER = struct.Struct('<8sqqqq')
+
+
+def contains(ids, user_id):
+    """Is `user_id` in the sorted sequence `ids`? O(log n)."""
+
+    i = bisect_left(ids, user_id)
+    return i < len(ids) and ids[i] == user_id
+
+
+def intersect(xs, ys):
+    """Ids found in both sorted sequences, in order.
+
+    Walks the shorter sequence and binary-searches the longer one, so a
+    user following a handful of people against someone with 100k
+    followers costs a handful of lookups rather than 100k comparisons.
+    """
+
+    if len(xs) > len(ys):
+        xs, ys = ys, xs
+
+    found = []
+    lo = 0
+    for user_id in xs:
+        lo = bisect_left(ys, user_id, lo)
+        if lo == len(ys):
+            break
+        if ys[lo] == user_id:
+            found.append(user_id)
+
+    return found
+
+
+class FollowGraph:
+    """Sorted int32 neighbor arrays per user, in both directions.
+
+    Build one with `from_db` (or `from_edges`), or `load` a file written by
+    `save`; loaded graphs are memory-mapped so every worker on the box
+    shares the same pages. Follows made by this process are applied with
+    `add` / `remove`; a user's array is copied out of the map the first
+    time it changes.
+    """
+
+    def __init__(self, following=None, followers=None, created_at=None):
+        self._following = following or {}
+        self._followers = followers or {}
+        self._lock = Lock()
+        self.created_at = created_at or time.time()
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Build a graph from (follower_id, followed_id) pairs."""
+
+        following = {}
+        followers = {}
+
+        for follower_id, followed_id in edges:
+            following.setdefault(follower_id, []).append(followed_id)
+            followers.setdefault(followed_id, []).append(follower_id)
+
+        for adjacency in (following, followers):
+            for user_id, ids in adjacency.items():
+                adjacency[user_id] = array('i', sorted(ids))
+
+        return cls(following, followers)
+
+    @classmethod
+    def from_db(cls, batch_size=10000):
+        """Build a graph by streaming every row of `follows`."""
+
+        edges = (db.session
+                 .query(Follows.user_following_id,
+                        Follows.user_being_followed_id)
+                 .yield_per(batch_size))
+
+        return cls.from_edges(edges)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a graph written by `save`."""
+
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, *counts = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a follow graph snapshot")
+
+        view = memoryview(buf)
+        pos = HEADER.size
+        sections = []
+
+        for n_users, n_edges in zip(counts[::2], counts[1::2]):
+            offsets = view[pos:pos + 8 * (n_users + 1)].cast('q')
+            pos += 8 * (n_users + 1)
+            sections.append([offsets, n_users, n_edges])
+
+        adjacency = []
+        for offsets, n_users, n_edges in sections:
+            users = view[pos:pos + 4 * n_users].cast('i')
+            pos += 4 * n_users
+            targets = view[pos:pos + 4 * n_edges].cast('i')
+            pos += 4 * n_edges
+
+            adjacency.append({
+                user_id: targets[offsets[i]:offsets[i + 1]]
+                for i, user_id in enumerate(users)
+            })
+
+        created_at = struct.unpack_from('<d', buf, pos)[0]
+
+        return cls(*adjacency, created_at=created_at)
+
+    def save(self, path):
+        """Write the graph in a flat layout that `load` can memory-map."""
+
+        sections = []
+        for adjacency in (self._following, self._followers):
+            users = array('i', sorted(u for u, ids in adjacency.items() if ids))
+            offsets = array('q', [0])
+            targets = array('i')
+            for user_id in users:
+                targets.extend(adjacency[user_id])
+                offsets.append(len(targets))
+            sections.append((users, offsets, targets))
+
+        (out_users, out_offsets, out_targets), (in_users, in_offsets,
+                                                in_targets) = sections
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC,
+                                len(out_users), len(out_targets),
+                                len(in_users), len(in_targets)))
+            # offsets go first so the 8-byte arrays stay 8-byte aligned
+            out_offsets.tofile(f)
+            in_offsets.tofile(f)
+            for users, _offsets, targets in sections:
+                users.tofile(f)
+                targets.tofile(f)
+            f.write(struct.pack('<d', self.created_at))
+
+    @property
+    def age(self):
+        """Seconds since this snapshot was taken from the database."""
+
+        return time.time() - self.created_at
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._following.get(user_id, ())
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._followers.get(user_id, ())
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def followers_count(self, user_id):
+        return len(self.followers(user_id))
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        return contains(self.following(follower_id), followed_id)
+
+    def mutuals(self, user_id):
+        """Ids of users who follow `user_id` and are followed back."""
+
+        return intersect(self.following(user_id), self.followers(user_id))
+
+    def followed_by_following(self, viewer_id, user_id):
+        """Ids of people `viewer_id` follows who also follow `user_id`."""
+
+        return intersect(self.following(viewer_id), self.followers(user_id))
+
+    def update(self, follower_id, followed_ids, following):
+        """Record follows (following=True) or unfollows of `followed_ids`
+        by `follower_id`.
+        """
+
+        change = self.add if following else self.remove
+        for followed_id in followed_ids:
+            change(follower_id, followed_id)
+
+    def add(self, follower_id, followed_id):
+        """Record a new follow made after the snapshot was taken."""
+
+        with self._lock:
+            self._insert(self._following, follower_id, followed_id)
+            self._insert(self._followers, followed_id, follower_id)
+
+    def remove(self, follower_id, followed_id):
+        """Record an unfollow made after the snapshot was taken."""
+
+        with self._lock:
+            self._delete(self._following, follower_id, followed_id)
+            self._delete(self._followers, followed_id, follower_id)
+
+    @staticmethod
+    def _writable(adjacency, user_id):
+        ids = adjacency.get(user_id)
+        if not isinstance(ids, array):
+            ids = adjacency[user_id] = array('i', ids or ())
+        return ids
+
+    def _insert(self, adjacency, user_id, other_id):
+        ids = self._writable(adjacency, user_id)
+        i = bisect_left(ids, other_id)
+        if i == len(ids) or ids[i] != other_id:
+            ids.insert(i, other_id)
+
+    def _delete(self, adjacency, user_id, other_id):
+        ids = self._writable(adjacency, user_id)
+        i = bisect_left(ids, other_id)
+        if i < len(ids) and ids[i] == other_id:
+            del ids[i]
+
+
+class FollowChanges:
+    """Follows and unfollows seen in the last `keep` seconds, oldest first.
+
+    A snapshot loaded from file can predate them; `replay` brings it up to
+    date. Replaying a change the snapshot already has does no harm.
+    """
+
+    def __init__(self, keep=120):
+        self.keep = keep
+        self._changes = deque()
+        self._lock = Lock()
+
+    def record(self, follower_id, followed_ids, following):
+        now = time.time()
+
+        with self._lock:
+            self._changes.append((now, follower_id, followed_ids, following))
+            while self._changes and self._changes[0][0] < now - self.keep:
+                self._changes.popleft()
+
+    def clear(self):
+        with self._lock:
+            self._changes.clear()
+
+    def replay(self, graph, since):
+        """Apply to `graph` the changes seen since `since` (a timestamp)."""
+
+        with self._lock:
+            changes = [change for change in self._changes
+                       if change[0] >= since]
+
+        for _seen_at, follower_id, followed_ids, following in changes:
+            graph.update(follower_id, followed_ids, following)
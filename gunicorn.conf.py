@@ -0,0 +1,41 @@
+"""Gunicorn settings, read automatically by `gunicorn app:app`.
+
+The live feed keeps one idle /messages/stream connection open per browser,
+so workers are evented (gevent) rather than one-request-per-process.
+Set WORKER_CLASS=sync to go back to plain workers.
+"""
+
+import os
+
+worker_class = os.environ.get('WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Load the app before forking so workers share its rate limit buckets
+# (the 'shared' store is an mmap they inherit). The app is then built in
+# the master, so under gevent patch first: its locks, queues and sockets
+# must be gevent's, as they would be had each worker imported it.
+preload_app = True
+
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+    # let psycopg2 yield to other greenlets while it waits on Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_fork(server, worker):
+    """Drop the database connections the master opened while loading the
+    app (the seed check, anything else at import): a socket shared by two
+    processes carries both their queries. close=False leaves them open
+    for the master, which owns them.
+    """
+
+    from app import app, db, shards
+
+    db.get_engine(app).dispose(close=False)
+    for engine in shards.engines:
+        engine.dispose(close=False)
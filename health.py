@@ -0,0 +1,169 @@
+"""Endpoints for load balancers and autoscalers, answered before Flask.
+
+/healthz   200 whenever the worker can answer at all. No database, no
+           session, no before_request hooks: nothing but the process.
+/readyz    200 if the database answers `SELECT 1` within READY_TIMEOUT
+           seconds, 503 otherwise. With READY_FAIL_ON_BREAKER, also 503
+           while the circuit breaker (see breaker.py) is open; by default
+           a worker serving remembered pages stays in rotation.
+/stats     This worker's pid, uptime, request counts and each engine's
+           connection pool, as JSON.
+
+Counts are per worker and start again when gunicorn forks one.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import Lock
+
+from werkzeug.wsgi import ClosingIterator
+
+
+def pool_stats(pool):
+    """What `pool` has open and lent out, as far as its class keeps count."""
+
+    stats = {'class': type(pool).__name__}
+    for key, name in (('size', 'size'),
+                      ('checked_in', 'checkedin'),
+                      ('checked_out', 'checkedout'),
+                      ('overflow', 'overflow')):
+        # a method on QueuePool; SingletonThreadPool's size is an int
+        count = getattr(pool, name, None)
+        if callable(count):
+            stats[key] = count()
+        elif isinstance(count, int):
+            stats[key] = count
+    return stats
+
+
+class HealthChecks:
+    """WSGI middleware answering the health endpoints itself, and counting
+    every other request on its way to `app`.
+
+    `engines` maps names to the engines to report on; the readiness probe
+    uses the first. A probe that hasn't finished is shared by the requests
+    that arrive meanwhile, so a hung database ties up one thread at most.
+    `breaker` is reported in /stats, and fails /readyz only with
+    `fail_on_breaker`.
+    """
+
+    def __init__(self, app, engines, breaker=None, ready_timeout=2,
+                 fail_on_breaker=False):
+        self.app = app
+        self.engines = engines
+        self.breaker = breaker
+        self.ready_timeout = ready_timeout
+        self.fail_on_breaker = fail_on_breaker
+
+        self.paths = {'/healthz': self.healthz,
+                      '/readyz': self.readyz,
+                      '/stats': self.stats}
+
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def __call__(self, environ, start_response):
+        endpoint = self.paths.get(environ.get('PATH_INFO'))
+        if endpoint is not None:
+            status, body = endpoint()
+            start_response(status, [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body))),
+                ('Cache-Control', 'no-store'),
+            ])
+            return [body]
+
+        with self._lock:
+            self._in_flight += 1
+
+        def start(status, headers, exc_info=None):
+            key = f"{status[:1]}xx"
+            with self._lock:
+                self._responses[key] = self._responses.get(key, 0) + 1
+            return start_response(status, headers, exc_info)
+
+        try:
+            app_iter = self.app(environ, start)
+        except BaseException:
+            self._finished()
+            raise
+
+        # a streamed response is in flight until it's closed
+        return ClosingIterator(app_iter, self._finished)
+
+    def healthz(self):
+        return '200 OK', self._json({'status': 'ok'})
+
+    def readyz(self):
+        reason = self.unready_reason()
+        if reason:
+            return ('503 Service Unavailable',
+                    self._json({'status': 'unavailable', 'reason': reason}))
+        return '200 OK', self._json({'status': 'ready'})
+
+    def stats(self):
+        with self._lock:
+            requests = {'total': self._total,
+                        'in_flight': self._in_flight,
+                        **self._responses}
+
+        return '200 OK', self._json({
+            'pid': os.getpid(),
+            'uptime': round(time.monotonic() - self._started, 3),
+            'requests': requests,
+            'breaker_open': bool(self.breaker and self.breaker.is_open),
+            'pools': {name: pool_stats(engine.pool)
+                      for name, engine in self.engines.items()},
+        })
+
+    def unready_reason(self):
+        """Why this worker shouldn't get traffic, or None if it should."""
+
+        if (self.fail_on_breaker and self.breaker is not None
+                and self.breaker.is_open):
+            return "circuit breaker open"
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='readyz')
+            if self._probe is None or self._probe.done():
+                self._probe = self._executor.submit(self._ping)
+            probe = self._probe
+
+        try:
+            probe.result(timeout=self.ready_timeout)
+        except TimeoutError:
+            return f"database didn't answer within {self.ready_timeout}s"
+        except Exception as exc:
+            # the type only: messages can name hosts and users
+            return f"database error ({type(exc).__name__})"
+        return None
+
+    def _ping(self):
+        engine = next(iter(self.engines.values()))
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+
+    def _finished(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._total += 1
+
+    def _reset(self):
+        # the parent's probe thread and counts don't survive a fork; the
+        # executor waits for a first probe, by when gevent has patched
+        # threading in the worker
+        self._lock = Lock()
+        self._probe = None
+        self._executor = None
+        self._started = time.monotonic()
+        self._total = 0
+        self._in_flight = 0
+        self._responses = {}
+
+    @staticmethod
+    def _json(data):
+        return json.dumps(data).encode()
@@ -0,0 +1,408 @@
+"""Resized WebP copies of profile images, made on demand and kept on disk.
+
+Templates link images through `thumbnail_url(url, variant)`, which points
+at /images/<variant>/<token>: the token is the source URL signed with the
+app's secret key, so the endpoint only ever fetches URLs this site handed
+out. The source is fetched (or read, for uploads and /static/ files),
+kept under the hash of its contents, and resized and encoded as WebP once
+per content hash. Remote sources are fetched again once they're older
+than THUMBNAIL_MAX_AGE, which is also how long browsers may cache a
+thumbnail, so a changed image at the same URL shows up within a day.
+
+If the source can't be had, the default avatar or header is sent in its
+place, cached only briefly. Pillow is optional: without it,
+`thumbnail_url` returns the original URL and uploads are refused.
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import time
+from io import BytesIO
+from urllib.parse import urljoin, urlsplit
+
+from flask import abort, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.security import safe_join
+
+from models import DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+# name: ((width, height), crop to fill) -- twice the CSS size, for hi-dpi
+VARIANTS = {
+    'avatar': ((96, 96), True),
+    'card': ((140, 140), True),
+    'profile': ((400, 400), True),
+    'card-hero': ((600, 200), True),
+    'hero': ((1600, 400), True),
+}
+
+# what to send, for FALLBACK_MAX_AGE seconds, when a variant's source fails
+FALLBACKS = {
+    'avatar': DEFAULT_IMAGE_URL,
+    'card': DEFAULT_IMAGE_URL,
+    'profile': DEFAULT_IMAGE_URL,
+    'card-hero': DEFAULT_HEADER_IMAGE_URL,
+    'hero': DEFAULT_HEADER_IMAGE_URL,
+}
+FALLBACK_MAX_AGE = 300
+
+UPLOAD_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+ONE_YEAR = 365 * 24 * 60 * 60
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 3
+
+
+class ImageError(ValueError):
+    """A source image that can't be fetched, read or accepted."""
+
+
+def remaining(deadline):
+    """Seconds left until `deadline`; ImageError if there are none."""
+
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise ImageError("took too long to fetch")
+    return left
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to `address`, already checked, instead of looking the host
+    name up again: a second lookup could answer differently.
+    """
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """PinnedHTTPConnection over TLS, verifying the certificate against
+    the host name rather than the address.
+    """
+
+    def __init__(self, host, port, address, timeout):
+        self.tls = ssl.create_default_context()
+        super().__init__(host, port, timeout=timeout, context=self.tls)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port),
+                                        self.timeout)
+        self.sock = self.tls.wrap_socket(sock, server_hostname=self.host)
+
+
+class Thumbnails:
+    """Serves thumbnails and uploaded images for `app`.
+
+    app.config['THUMBNAIL_DIR'] is where originals, uploads and variants
+    are kept; THUMBNAIL_MAX_BYTES caps the size of a source image,
+    THUMBNAIL_FETCH_TIMEOUT how long fetching one may take, and
+    THUMBNAIL_MAX_AGE how long a fetched one is used before it's checked
+    again.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.dir = app.config['THUMBNAIL_DIR']
+        self.signer = URLSafeSerializer(app.secret_key, salt='thumbnail')
+
+        app.add_url_rule('/images/<variant>/<token>', 'thumbnail', self.serve)
+        app.add_url_rule('/images/uploads/<name>', 'uploaded_image',
+                         self.serve_upload)
+        app.add_template_global(self.thumbnail_url, 'thumbnail_url')
+
+    def thumbnail_url(self, url, variant):
+        """Where to get `url` resized as `variant`."""
+
+        if not url or Image is None:
+            return url
+
+        return url_for('thumbnail', variant=variant,
+                       token=self.signer.dumps(url))
+
+    def serve(self, variant, token):
+        """Send the `variant` thumbnail of the image `token` names.
+
+        If the source can't be had, send the default image's thumbnail
+        rather than a broken image. Never redirect to the source: anyone
+        can set their image URL to anywhere.
+        """
+
+        if variant not in VARIANTS or Image is None:
+            abort(404)
+
+        try:
+            url = self.signer.loads(token)
+        except BadSignature:
+            abort(404)
+
+        max_age = self.app.config['THUMBNAIL_MAX_AGE']
+        try:
+            path = self.variant_path(url, variant)
+        except (ImageError, OSError) as exc:
+            self.app.logger.warning(f"No thumbnail for {url}: {exc}")
+            path = self.variant_path(FALLBACKS[variant], variant)
+            max_age = FALLBACK_MAX_AGE
+
+        # the URL stays the same when the image behind it changes
+        response = send_file(path, mimetype='image/webp', conditional=True,
+                             max_age=max_age)
+        response.cache_control.public = True
+        return response
+
+    def variant_path(self, url, variant):
+        """The file holding the `variant` thumbnail of `url`, made if it
+        isn't there yet.
+        """
+
+        key, original = self.source(url)
+        path = os.path.join(self.dir, 'variants', variant, key[:2],
+                            f"{key}.webp")
+        if not os.path.exists(path):
+            with open(original, 'rb') as f:
+                self._write(path, self.render(f.read(), variant))
+        return path
+
+    def serve_upload(self, name):
+        path = safe_join(self.dir, 'uploads', name)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        # named by their contents, so they never change
+        response = send_file(path, max_age=ONE_YEAR)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def store_upload(self, file):
+        """Keep an uploaded image; returns the URL to use for it.
+
+        Uploads are named by the hash of their contents, so the same
+        picture uploaded twice is stored once.
+        """
+
+        data = file.read(self.app.config['THUMBNAIL_MAX_BYTES'] + 1)
+        image_format = self._check(data).format
+        if image_format not in UPLOAD_FORMATS:
+            raise ImageError(f"{image_format} images aren't accepted")
+
+        name = (f"{hashlib.sha256(data).hexdigest()}"
+                f".{UPLOAD_FORMATS[image_format]}")
+        path = os.path.join(self.dir, 'uploads', name)
+        if not os.path.exists(path):
+            self._write(path, data)
+
+        return url_for('uploaded_image', name=name)
+
+    def source(self, url):
+        """The content hash of the image at `url`, and the file its bytes
+        are in. Remote images are fetched when first seen and again once
+        THUMBNAIL_MAX_AGE has passed.
+        """
+
+        local = self._local_path(url)
+        if local is not None:
+            try:
+                with open(local, 'rb') as f:
+                    return content_key(f.read()), local
+            except OSError as exc:
+                raise ImageError(str(exc))
+
+        # url -> content hash; originals are stored by content, so a
+        # refetch never changes a file someone else is reading
+        key = url_key(url)
+        pointer = os.path.join(self.dir, 'sources', key[:2], key)
+
+        try:
+            age = time.time() - os.path.getmtime(pointer)
+        except OSError:
+            age = None
+
+        if age is None or age > self.app.config['THUMBNAIL_MAX_AGE']:
+            try:
+                data = self.fetch(url)
+            except ImageError:
+                if age is None:
+                    raise
+                # keep using the copy we have; try again another day
+                os.utime(pointer)
+            else:
+                digest = content_key(data)
+                self._write(self._original_path(digest), data)
+                self._write(pointer, digest.encode())
+
+        with open(pointer) as f:
+            digest = f.read()
+        return digest, self._original_path(digest)
+
+    def fetch(self, url):
+        """Download `url`, refusing non-http(s) URLs and private addresses,
+        which a user could otherwise use to probe our own network.
+
+        Redirects are followed, at most MAX_REDIRECTS of them, by checking
+        each hop the same way; every connection goes to the address that
+        was checked, so DNS answers that change between lookups don't get
+        past it either. The whole download, redirects included, must be
+        over within THUMBNAIL_FETCH_TIMEOUT seconds.
+        """
+
+        timeout = self.app.config['THUMBNAIL_FETCH_TIMEOUT']
+        deadline = time.monotonic() + timeout
+
+        for _hop in range(MAX_REDIRECTS + 1):
+            status, location, data = self._get(url, deadline)
+            if status not in REDIRECTS:
+                break
+            if not location:
+                raise ImageError(f"HTTP {status} without a Location")
+            url = urljoin(url, location)
+        else:
+            raise ImageError("too many redirects")
+
+        if status != 200:
+            raise ImageError(f"HTTP {status}")
+
+        self._check(data)
+        return data
+
+    def _get(self, url, deadline):
+        """GET `url` from the public address its host resolves to, by
+        `deadline` (a time.monotonic() value). Returns the status, the
+        Location header and the body.
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageError("not an http(s) URL")
+
+        https = parts.scheme == 'https'
+        try:
+            port = parts.port or (443 if https else 80)
+        except ValueError as exc:
+            raise ImageError(str(exc))
+
+        try:
+            addresses = socket.getaddrinfo(parts.hostname, port,
+                                           type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError) as exc:
+            raise ImageError(str(exc))
+
+        for *_rest, sockaddr in addresses:
+            if not ipaddress.ip_address(sockaddr[0]).is_global:
+                raise ImageError(f"{parts.hostname} is not a public address")
+
+        connection_class = (PinnedHTTPSConnection if https
+                            else PinnedHTTPConnection)
+        conn = connection_class(parts.hostname, port, addresses[0][4][0],
+                                timeout=remaining(deadline))
+
+        path = parts.path or '/'
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        try:
+            conn.request('GET', path, headers={'Accept': 'image/*'})
+            # a socket timeout bounds each read, which a source sending a
+            # byte at a time would never hit; each gets what's left of the
+            # deadline instead
+            self._settimeout(conn, remaining(deadline))
+            resp = conn.getresponse()
+
+            limit = self.app.config['THUMBNAIL_MAX_BYTES'] + 1
+            chunks, size = [], 0
+            while size < limit:
+                self._settimeout(conn, remaining(deadline))
+                chunk = resp.read1(min(64 * 1024, limit - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+
+            return resp.status, resp.getheader('Location'), b"".join(chunks)
+        except (OSError, http.client.HTTPException) as exc:
+            raise ImageError(str(exc))
+        finally:
+            conn.close()
+
+    def render(self, data, variant):
+        """`data` resized to `variant` and encoded as WebP."""
+
+        (width, height), crop = VARIANTS[variant]
+        image = self._check(data)
+
+        try:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            if crop:
+                image = ImageOps.fit(image, (width, height),
+                                     Image.Resampling.LANCZOS)
+            else:
+                image.thumbnail((width, height), Image.Resampling.LANCZOS)
+
+            out = BytesIO()
+            image.save(out, 'WEBP', quality=80, method=4)
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            raise ImageError(str(exc))
+
+        return out.getvalue()
+
+    def _check(self, data):
+        if Image is None:
+            raise ImageError("Pillow is not installed")
+
+        if len(data) > self.app.config['THUMBNAIL_MAX_BYTES']:
+            raise ImageError("image is too large")
+
+        try:
+            image = Image.open(BytesIO(data))
+            image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError,
+                Image.DecompressionBombError) as exc:
+            raise ImageError(f"not an image: {exc}")
+
+        # verify() leaves the image unusable; open a fresh one to work with
+        return Image.open(BytesIO(data))
+
+    def _original_path(self, digest):
+        return os.path.join(self.dir, 'originals', digest[:2], digest)
+
+    def _local_path(self, url):
+        if url.startswith('/static/'):
+            return safe_join(self.app.static_folder, url[len('/static/'):])
+        if url.startswith('/images/uploads/'):
+            return safe_join(self.dir, 'uploads', url[len('/images/uploads/'):])
+        return None
+
+    @staticmethod
+    def _settimeout(conn, timeout):
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -1,9 +1,14 @@
 """SQLAlchemy models for Warbler."""
 
+import sqlite3
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, PrimaryKeyConstraint, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -27,8 +32,59 @@ class Follows(db.Model):
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
+        index=True,
     )
 
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` `follower_id` already follows."""
+
+        return set(db.session.execute(
+            db.select(cls.user_being_followed_id)
+            .where(cls.user_following_id == follower_id,
+                   cls.user_being_followed_id.in_(user_ids))).scalars())
+
+    @classmethod
+    def add_many(cls, follower_id, user_ids):
+        """Have `follower_id` follow every user in `user_ids`, in one
+        INSERT ... SELECT. Returns the ids newly followed; doesn't commit.
+        """
+
+        new = sorted(set(user_ids) - {follower_id}
+                     - cls.followed_among(follower_id, user_ids))
+        if not new:
+            return []
+
+        engine = db.get_engine()
+        dialect = postgresql if engine.dialect.name == 'postgresql' else sqlite
+
+        # DO NOTHING: a follow made since the check above isn't an error
+        db.session.execute(
+            dialect.insert(cls)
+            .from_select(
+                ['user_following_id', 'user_being_followed_id'],
+                db.select(db.literal(follower_id), User.id)
+                .where(User.id.in_(new)))
+            .on_conflict_do_nothing())
+
+        return new
+
+    @classmethod
+    def remove_many(cls, follower_id, user_ids):
+        """Have `follower_id` stop following every user in `user_ids`, in
+        one DELETE. Returns the ids unfollowed; doesn't commit.
+        """
+
+        gone = sorted(cls.followed_among(follower_id, user_ids))
+        if gone:
+            (cls
+             .query
+             .filter(cls.user_following_id == follower_id,
+                     cls.user_being_followed_id.in_(gone))
+             .delete(synchronize_session=False))
+
+        return gone
+
 
 class User(db.Model):
     """User in the system."""
@@ -75,8 +131,18 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
-    likes = db.relationship('Message', secondary="likes", backref="users_liked")
+    # passive_deletes: deleting a user (or message) leaves these rows to the
+    # ON DELETE CASCADE foreign keys instead of loading them all first
+
+    messages = db.relationship('Message', backref="user", passive_deletes=True)
+    likes = db.relationship(
+        'Message',
+        secondary="likes",
+        primaryjoin="User.id == Like.user_id",
+        secondaryjoin="Message.id == foreign(Like.message_id)",
+        backref=db.backref("users_liked", passive_deletes=True),
+        passive_deletes=True,
+    )
     #backref like_messages
 
     followers = db.relationship(
@@ -84,7 +150,8 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        backref="following",
+        backref=db.backref("following", passive_deletes=True),
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -121,7 +188,7 @@ class User(db.Model):
         False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.by_username(username)
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -130,6 +197,116 @@ class User(db.Model):
 
         return False
 
+    @classmethod
+    def by_username(cls, username):
+        """The user named `username`, or None."""
+
+        # A lambda statement: SQLAlchemy builds it and works out its cache
+        # key once, then only pulls the new username out of the closure.
+        # (Primary-key lookups need no such help: Query.get already reuses
+        # a cached statement, after checking the identity map.)
+        stmt = db.lambda_stmt(
+            lambda: db.select(User).where(User.username == username))
+        return db.session.execute(stmt).scalar_one_or_none()
+
+    @classmethod
+    def resolve(cls, targets):
+        """Look up the users in `targets`, each an id (all digits) or a
+        username (with or without an @), in one query.
+
+        Returns the ids found, in the order given, and the targets that
+        matched no one.
+        """
+
+        keys = [str(target).strip().lstrip('@') for target in targets]
+        found = dict.fromkeys(str(int(key)) if key.isdigit() else key
+                              for key in keys if key)
+
+        numbers = {int(key) for key in found if key.isdigit()}
+        names = {key for key in found if not key.isdigit()}
+
+        for id, username in db.session.execute(
+                db.select(cls.id, cls.username)
+                .where(db.or_(cls.id.in_(numbers),
+                              cls.username.in_(names)))):
+            if id in numbers:
+                found[str(id)] = id
+            if username in names:
+                found[username] = id
+
+        ids = list(dict.fromkeys(id for id in found.values() if id))
+        missing = [key for key, id in found.items() if id is None]
+        return ids, missing
+
+    @classmethod
+    def purge(cls, user_id, batch_size=10000, unfollowed=None):
+        """Delete a user and everything they own, `batch_size` rows at a time.
+
+        Commits after every batch, so even an account with millions of
+        messages and likes never holds one long transaction open. Deleting
+        a batch of messages also cascades to the likes on them. Once each
+        batch of follows is gone, `unfollowed` (if given) is called with
+        their (follower_id, followed_id) pairs.
+        """
+
+        batches = [
+            (Like, Like.user_id == user_id, Like.message_id, None),
+            (Message, Message.user_id == user_id, Message.id, None),
+            (Follows,
+             Follows.user_being_followed_id == user_id,
+             Follows.user_following_id,
+             lambda follower_id: (follower_id, user_id)),
+            (Follows,
+             Follows.user_following_id == user_id,
+             Follows.user_being_followed_id,
+             lambda followed_id: (user_id, followed_id)),
+        ]
+
+        for model, owned, key, edge in batches:
+            while True:
+                # fetching the keys first keeps each DELETE a primary key
+                # lookup, rather than leaving the planner to join a subquery
+                keys = [k for k, in (db.session
+                                     .query(key)
+                                     .filter(owned)
+                                     .limit(batch_size))]
+                if not keys:
+                    break
+
+                (model
+                 .query
+                 .filter(owned, key.in_(keys))
+                 .delete(synchronize_session=False))
+                db.session.commit()
+
+                if edge is not None and unfollowed is not None:
+                    unfollowed([edge(k) for k in keys])
+
+        cls.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+    @classmethod
+    def is_heavy(cls, user_id, threshold):
+        """Does this user have more than `threshold` messages, likes,
+        follows or followers?
+
+        Stops reading after `threshold` rows of each instead of counting
+        them all.
+        """
+
+        owned = (Message.user_id,
+                 Like.user_id,
+                 Follows.user_following_id,
+                 Follows.user_being_followed_id)
+
+        return any((db.session
+                    .query(column)
+                    .filter(column == user_id)
+                    .offset(threshold)
+                    .limit(1)
+                    .first()) is not None
+                   for column in owned)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -146,9 +323,19 @@ class User(db.Model):
 
 
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    On Postgres the table is partitioned by month on timestamp (see
+    archive.py), so queries bounded by time only read the months they need,
+    and old months can be archived by detaching them whole.
+    """
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)',
+         'info': {'partition_key': 'timestamp'}},
+    )
 
     id = db.Column(
         db.Integer,
@@ -168,10 +355,83 @@ class Message(db.Model):
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='CASCADE')
+        db.ForeignKey('users.id', ondelete='CASCADE'),
     )
 
 
+@compiles(PrimaryKeyConstraint, 'postgresql')
+def partitioned_primary_key(constraint, compiler, **kw):
+    """A partitioned table's primary key has to include the partition key,
+    so on Postgres messages' is (id, timestamp). Everywhere else, including
+    the mapper, a message is known by its id alone.
+    """
+
+    key = constraint.table.info.get('partition_key')
+    if key is None:
+        return compiler.visit_primary_key_constraint(constraint, **kw)
+
+    columns = [column.name for column in constraint.columns] + [key]
+    return f"PRIMARY KEY ({', '.join(map(compiler.preparer.quote, columns))})"
+
+
+# Rows outside every monthly partition land here until `flask
+# partition-messages` gives their month a partition of its own.
+#
+# Nothing can reference a partitioned table by id alone, so likes.message_id
+# (and hashtags' and mentions') has no foreign key; the trigger does what
+# ON DELETE CASCADE would. It fires once per statement, not per row, so an
+# UPDATE that moves a message to another month's partition doesn't count as
+# deleting it. The function keeps the name it had when it deleted only
+# likes; the tables added since replace it as they're created, so databases
+# from before them get the new version too.
+
+delete_message_rows = DDL("""
+    CREATE OR REPLACE FUNCTION delete_message_likes() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM likes WHERE message_id IN (SELECT id FROM old_messages);
+        DELETE FROM hashtags WHERE message_id IN (SELECT id FROM old_messages);
+        DELETE FROM mentions WHERE message_id IN (SELECT id FROM old_messages);
+        DELETE FROM like_counts
+            WHERE message_id IN (SELECT id FROM old_messages);
+        RETURN NULL;
+    END $$;
+""").execute_if(dialect='postgresql')
+
+event.listen(Message.__table__, 'after_create', DDL("""
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+""").execute_if(dialect='postgresql'))
+
+event.listen(Message.__table__, 'after_create', delete_message_rows)
+
+event.listen(Message.__table__, 'after_create', DDL("""
+    CREATE TRIGGER messages_delete_likes AFTER DELETE ON messages
+        REFERENCING OLD TABLE AS old_messages
+        FOR EACH STATEMENT EXECUTE FUNCTION delete_message_likes();
+""").execute_if(dialect='postgresql'))
+
+# SQLite (for quick local test runs) has no partitions: a plain trigger
+event.listen(Message.__table__, 'after_create', DDL("""
+    CREATE TRIGGER messages_delete_likes AFTER DELETE ON messages
+    BEGIN
+        DELETE FROM likes WHERE message_id = OLD.id;
+        DELETE FROM hashtags WHERE message_id = OLD.id;
+        DELETE FROM mentions WHERE message_id = OLD.id;
+        DELETE FROM like_counts WHERE message_id = OLD.id;
+    END
+""").execute_if(dialect='sqlite'))
+
+
+@event.listens_for(Engine, 'connect')
+def enforce_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys, ON DELETE CASCADE included, unless
+    asked on every connection.
+    """
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -180,20 +440,25 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
 
 class Like(db.Model):
     """Likes"""
 
     __tablename__ = "likes"
+    __table_args__ = (
+        # a message's likers, in user id order, for its page
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    )
 
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
     )
+    # no foreign key: see delete_message_likes above
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete="cascade"),
         primary_key=True,
     )
 
@@ -201,3 +466,394 @@ class Like(db.Model):
 
    # likes = db.relationship('Like', secondary = "messages", backref="users")
 
+
+class LikeCount(db.Model):
+    """How many likes a message has, kept by triggers on likes so a
+    message's page needn't count them.
+    """
+
+    __tablename__ = "like_counts"
+
+    # no foreign key: see delete_message_likes above
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+LikeCount.__table__.add_is_dependent_on(Like.__table__)
+
+# Created with like_counts, so an older database gets the counts (and the
+# index on likes) when create_all adds the table. On Postgres the triggers
+# fire per statement, so a user's likes purged in batches of thousands are
+# a handful of grouped updates.
+
+event.listen(LikeCount.__table__, 'after_create', DDL("""
+    CREATE INDEX IF NOT EXISTS ix_likes_message_id_user_id
+        ON likes (message_id, user_id);
+
+    INSERT INTO like_counts (message_id, likes)
+        SELECT message_id, count(*) FROM likes GROUP BY message_id;
+
+    CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO like_counts (message_id, likes)
+                SELECT message_id, count(*) FROM new_likes
+                GROUP BY message_id ORDER BY message_id
+            ON CONFLICT (message_id)
+                DO UPDATE SET likes = like_counts.likes + excluded.likes;
+        ELSE
+            UPDATE like_counts SET likes = like_counts.likes - gone.likes
+                FROM (SELECT message_id, count(*) AS likes FROM old_likes
+                      GROUP BY message_id) AS gone
+                WHERE like_counts.message_id = gone.message_id;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE TRIGGER likes_count_insert AFTER INSERT ON likes
+        REFERENCING NEW TABLE AS new_likes
+        FOR EACH STATEMENT EXECUTE FUNCTION count_likes();
+
+    CREATE TRIGGER likes_count_delete AFTER DELETE ON likes
+        REFERENCING OLD TABLE AS old_likes
+        FOR EACH STATEMENT EXECUTE FUNCTION count_likes();
+""").execute_if(dialect='postgresql'))
+
+event.listen(LikeCount.__table__, 'after_create', DDL("""
+    CREATE TRIGGER likes_count_insert AFTER INSERT ON likes
+    BEGIN
+        INSERT INTO like_counts (message_id, likes) VALUES (NEW.message_id, 1)
+            ON CONFLICT (message_id) DO UPDATE SET likes = likes + 1;
+    END
+""").execute_if(dialect='sqlite'))
+
+event.listen(LikeCount.__table__, 'after_create', DDL("""
+    CREATE TRIGGER likes_count_delete AFTER DELETE ON likes
+    BEGIN
+        UPDATE like_counts SET likes = likes - 1
+            WHERE message_id = OLD.message_id;
+    END
+""").execute_if(dialect='sqlite'))
+
+event.listen(LikeCount.__table__, 'after_create', delete_message_rows)
+
+
+class Hashtag(db.Model):
+    """A #tag in a message; see tags.py.
+
+    Keyed by (tag, timestamp, message_id), so a tag's messages are one
+    index range, newest last.
+    """
+
+    __tablename__ = "hashtags"
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    # no foreign key: see delete_message_likes above
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message; see tags.py."""
+
+    __tablename__ = "mentions"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    # no foreign key: see delete_message_likes above
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        index=True,
+    )
+
+
+event.listen(Hashtag.__table__, 'after_create', delete_message_rows)
+event.listen(Mention.__table__, 'after_create', delete_message_rows)
+
+
+class Notification(db.Model):
+    """Likes on a user's message, or new followers, as one line on their
+    notifications page; see notifications.py.
+    """
+
+    __tablename__ = "notifications"
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_updated_at',
+                 'user_id', 'updated_at'),
+        # at most one unread group per subject, for the upsert to bump
+        db.Index('ix_notifications_unread_group',
+                 'user_id', 'kind', 'subject_id',
+                 unique=True,
+                 postgresql_where=db.text('NOT read'),
+                 sqlite_where=db.text('NOT read')),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    # 'like' or 'follow'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the liked message's id; 0 for follows
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # who did it most recently
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="set null"),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
+class NotificationActor(db.Model):
+    """Who's in an unread notification's group, so each counts once."""
+
+    __tablename__ = "notification_actors"
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+
+class NotificationCounter(db.Model):
+    """How many of a user's notifications are unread, kept up to date so
+    the navbar needn't count them.
+    """
+
+    __tablename__ = "notification_counters"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Job(db.Model):
+    """A background task waiting to be (re)tried; see tasks.py."""
+
+    __tablename__ = "jobs"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    task = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+
+class RateLimit(db.Model):
+    """A rate limit bucket, for RATELIMIT_STORAGE = 'database'."""
+
+    __tablename__ = "rate_limits"
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # when the bucket will be full again, in seconds since the epoch
+    tat = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A user suggested to follow, precomputed by `flask recommend`."""
+
+    __tablename__ = "recommendations"
+    __table_args__ = (
+        db.Index('ix_recommendations_user_id_rank', 'user_id', 'rank'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    @classmethod
+    def refresh(cls, top_n=10, shard=0, shards=1):
+        """Recompute suggestions for every user where user_id % shards == shard.
+
+        A candidate scores a point for every person the user follows who
+        follows them (friends of friends) and for every follower the user
+        shares with them. The whole graph walk runs as one INSERT ... SELECT
+        so nothing is loaded into Python; running several shards on separate
+        connections spreads the work across database cores.
+
+        Doesn't commit; returns the number of suggestions written.
+        """
+
+        mine = db.aliased(Follows)
+        theirs = db.aliased(Follows)
+
+        friends_of_friends = (
+            db.select(
+                mine.user_following_id.label('user_id'),
+                theirs.user_being_followed_id.label('candidate_id'))
+            .join(theirs,
+                  theirs.user_following_id == mine.user_being_followed_id))
+
+        shared_followers = (
+            db.select(
+                mine.user_being_followed_id.label('user_id'),
+                theirs.user_being_followed_id.label('candidate_id'))
+            .join(theirs,
+                  theirs.user_following_id == mine.user_following_id))
+
+        pairs = db.union_all(friends_of_friends, shared_followers).subquery()
+
+        already_following = db.exists().where(
+            Follows.user_following_id == pairs.c.user_id,
+            Follows.user_being_followed_id == pairs.c.candidate_id,
+        )
+
+        score = db.func.count().label('score')
+        scored = (
+            db.select(pairs.c.user_id, pairs.c.candidate_id, score)
+            .where(pairs.c.user_id != pairs.c.candidate_id)
+            .where(pairs.c.user_id % shards == shard)
+            .where(~already_following)
+            .group_by(pairs.c.user_id, pairs.c.candidate_id)
+            .subquery())
+
+        rank = db.func.row_number().over(
+            partition_by=scored.c.user_id,
+            order_by=(scored.c.score.desc(), scored.c.candidate_id),
+        ).label('rank')
+        ranked = db.select(scored, rank).subquery()
+
+        cls.query.filter(cls.user_id % shards == shard).delete(
+            synchronize_session=False)
+
+        result = db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'recommended_user_id', 'score', 'rank'],
+                db.select(ranked).where(ranked.c.rank <= top_n)))
+
+        return result.rowcount
+
@@ -0,0 +1,162 @@
+"""Notifications of likes on a user's messages and of new followers.
+
+Events are recorded as they happen, in the transaction that likes or
+follows, and aggregated on the way in: while a user hasn't read their
+notifications, every like on the same message (or every new follower)
+updates one row, bumping its count and latest actor, so "u2 and 41 others
+liked your warble" is one row however many likes it took. A unique index
+over unread rows means two likes at once can't start two rows, and
+notification_actors holds who's in each unread group, so someone who
+likes, unlikes and likes again counts once.
+
+The unread count in the navbar comes from notification_counters, bumped when
+a new row is started and zeroed when the user reads the page, rather than
+from counting rows. Each user keeps their newest `keep` rows; starting a
+new one drops any past that.
+"""
+
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Notification, NotificationActor, NotificationCounter
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+
+def _dialect():
+    """This database's dialect module, whose insert() has ON CONFLICT."""
+
+    engine = db.get_engine()
+    return postgresql if engine.dialect.name == 'postgresql' else sqlite
+
+
+def record(user_id, kind, actor_id, subject_id=0, keep=200):
+    """Tell `user_id` that `actor_id` liked their message `subject_id`
+    (kind LIKE) or followed them (kind FOLLOW). Doesn't commit.
+    """
+
+    if actor_id == user_id:
+        return
+
+    table = Notification.__table__
+    actors = NotificationActor.__table__
+    now = datetime.utcnow()
+    unread_group = (db.select(table.c.id)
+                    .where(table.c.user_id == user_id,
+                           table.c.kind == kind,
+                           table.c.subject_id == subject_id,
+                           db.not_(table.c.read)))
+
+    start = (_dialect().insert(table)
+             .values(user_id=user_id,
+                     kind=kind,
+                     subject_id=subject_id,
+                     actor_id=actor_id,
+                     actor_count=1,
+                     updated_at=now,
+                     read=False)
+             .on_conflict_do_nothing(
+                 index_elements=[table.c.user_id, table.c.kind,
+                                 table.c.subject_id],
+                 index_where=db.text('NOT read')))
+
+    group_id = db.session.execute(unread_group).scalar()
+
+    if group_id is None:
+        result = db.session.execute(start)
+        if result.rowcount:
+            db.session.execute(db.insert(actors).values(
+                notification_id=result.inserted_primary_key[0],
+                actor_id=actor_id))
+            _count_unread(user_id, 1 - _trim(user_id, keep))
+            return
+
+        # someone else started it between the two
+        group_id = db.session.execute(unread_group).scalar_one()
+
+    joined = db.session.execute(
+        _dialect().insert(actors)
+        .values(notification_id=group_id, actor_id=actor_id)
+        .on_conflict_do_nothing())
+
+    # an actor already in the group (a like, unlike and like again) is
+    # neither counted again nor moved to the top
+    if joined.rowcount:
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == group_id)
+            .values(actor_id=actor_id,
+                    actor_count=table.c.actor_count + 1,
+                    updated_at=now))
+
+
+def _trim(user_id, keep):
+    """Drop `user_id`'s notifications past the newest `keep`; returns how
+    many of those were unread.
+    """
+
+    stale = db.session.execute(
+        db.select(Notification.id, Notification.read)
+        .where(Notification.user_id == user_id)
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .offset(keep)).all()
+    if not stale:
+        return 0
+
+    stale_ids = [id for id, _ in stale]
+    (NotificationActor
+     .query
+     .filter(NotificationActor.notification_id.in_(stale_ids))
+     .delete(synchronize_session=False))
+    (Notification
+     .query
+     .filter(Notification.id.in_(stale_ids))
+     .delete(synchronize_session=False))
+
+    return sum(not read for _, read in stale)
+
+
+def _count_unread(user_id, change):
+    table = NotificationCounter.__table__
+
+    db.session.execute(
+        _dialect().insert(table)
+        .values(user_id=user_id, unread=max(change, 0))
+        .on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={'unread': table.c.unread + change}))
+
+
+def unread_count(user_id):
+    """How many of `user_id`'s notifications are unread."""
+
+    return db.session.execute(
+        db.select(NotificationCounter.unread)
+        .where(NotificationCounter.user_id == user_id)).scalar() or 0
+
+
+def mark_read(user_id):
+    """Mark all of `user_id`'s notifications read. Doesn't commit.
+
+    Further likes and follows start new rows rather than joining these.
+    """
+
+    (NotificationCounter
+     .query
+     .filter_by(user_id=user_id)
+     .update({'unread': 0}, synchronize_session=False))
+
+    # read groups take no new actors
+    unread = (db.select(Notification.id)
+              .where(Notification.user_id == user_id, ~Notification.read))
+    (NotificationActor
+     .query
+     .filter(NotificationActor.notification_id.in_(unread))
+     .delete(synchronize_session=False))
+
+    (Notification
+     .query
+     .filter(Notification.user_id == user_id, ~Notification.read)
+     .update({'read': True}, synchronize_session=False))
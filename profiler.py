@@ -0,0 +1,208 @@
+"""Opt-in sampling profiler for individual production requests.
+
+A request is profiled when it carries a valid X-Profile header (a token
+from `flask profile-token`, signed with the app's secret key) or, if
+PROFILE_SAMPLE_RATE is set, when it is picked at random. While any such
+request is running, one background thread looks at the profiled requests'
+stacks every PROFILE_INTERVAL seconds. When the response has been sent,
+the stacks are written to PROFILE_DIR in collapsed-stack format (one
+"outer;inner;leaf count" line per stack), ready for flamegraph.pl or
+speedscope, in a file named after the time, endpoint and duration. Only
+the newest PROFILE_MAX_FILES files are kept; older ones are deleted.
+
+Requests that aren't profiled pay for one header lookup.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import after_this_request, request
+from itsdangerous import BadSignature, TimestampSigner
+
+try:
+    from gevent import getcurrent
+    from gevent.monkey import get_original, is_module_patched
+except ImportError:
+    getcurrent = get_original = is_module_patched = None
+
+
+def os_threads():
+    """start_new_thread, get_ident and sleep as they were before any gevent
+    monkey-patching. The sampler has to be a real thread to see what a
+    busy worker is doing.
+    """
+
+    names = ('start_new_thread', 'get_ident')
+    if get_original is not None:
+        return (*get_original('_thread', names), get_original('time', 'sleep'))
+
+    import _thread
+    return _thread.start_new_thread, _thread.get_ident, time.sleep
+
+
+def running_greenlet():
+    """The greenlet serving this request in a gevent worker, or None where
+    each request has an OS thread to itself.
+
+    Many greenlets share a thread, so under gevent requests are told apart
+    by greenlet: a switched-out one keeps its stack in `gr_frame` (where
+    it's waiting), and the running one's is its thread's.
+    """
+
+    if is_module_patched is None or not is_module_patched('threading'):
+        return None
+    return getcurrent()
+
+
+def collapse(frame):
+    """`frame`'s stack as "module:function;..." from the outermost call."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Samples the stacks of the requests chosen for profiling."""
+
+    header = 'X-Profile'
+
+    def __init__(self, app):
+        self.app = app
+        self.signer = TimestampSigner(app.secret_key, salt='profile')
+
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampling = False
+
+        app.before_request(self._start)
+
+    def token(self):
+        """A value for the X-Profile header; see PROFILE_TOKEN_MAX_AGE."""
+
+        return self.signer.sign(uuid.uuid4().hex).decode()
+
+    def wanted(self):
+        """Should this request be profiled?"""
+
+        token = request.headers.get(self.header)
+        if token is not None:
+            try:
+                self.signer.unsign(
+                    token, max_age=self.app.config['PROFILE_TOKEN_MAX_AGE'])
+                return True
+            except BadSignature:
+                return False
+
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def _start(self):
+        if not self.wanted():
+            return
+
+        start_thread, get_ident, sleep = os_threads()
+        ident = get_ident()
+        greenlet = running_greenlet()
+        key = ident if greenlet is None else greenlet
+        samples = Counter()
+        started = time.perf_counter()
+        endpoint = request.endpoint or 'unknown'
+
+        with self._lock:
+            self._active[key] = (ident, greenlet, samples)
+            if not self._sampling:
+                self._sampling = True
+                start_thread(self._sample, (sleep,))
+
+        profile_id = uuid.uuid4().hex[:12]
+
+        def finish():
+            with self._lock:
+                self._active.pop(key, None)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._write(profile_id, endpoint, elapsed_ms, samples)
+
+        # on close, not in after_request, so streamed pages are covered too
+        @after_this_request
+        def tag(response):
+            response.headers['X-Profile-Id'] = profile_id
+            response.call_on_close(finish)
+            return response
+
+    def _sample(self, sleep):
+        interval = self.app.config['PROFILE_INTERVAL']
+
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampling = False
+                    return
+                active = list(self._active.items())
+
+            frames = sys._current_frames()
+            stacks, frame = {}, None
+            for key, (ident, greenlet, _samples) in active:
+                frame = greenlet.gr_frame if greenlet is not None else None
+                if frame is None:
+                    frame = frames.get(ident)
+                if frame is not None:
+                    stacks[key] = collapse(frame)
+            del frames, frame
+
+            # a request may have finished (and written its samples) since
+            with self._lock:
+                for key, stack in stacks.items():
+                    entry = self._active.get(key)
+                    if entry is not None:
+                        entry[2][stack] += 1
+
+            sleep(interval)
+
+    def _write(self, profile_id, endpoint, elapsed_ms, samples):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+
+        name = (f"{time.strftime('%Y%m%dT%H%M%S')}-{endpoint}"
+                f"-{elapsed_ms:.0f}ms-{profile_id}.collapsed")
+        with open(os.path.join(directory, name), 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self._prune(directory)
+
+        self.app.logger.info(
+            f"Profiled {endpoint} ({elapsed_ms:.0f}ms, "
+            f"{sum(samples.values())} samples) to {name}")
+
+    def _prune(self, directory):
+        """Delete the oldest profiles beyond PROFILE_MAX_FILES. Another
+        worker may be pruning the same directory, so files can vanish
+        under us.
+        """
+
+        def mtime(entry):
+            try:
+                return entry.stat().st_mtime
+            except FileNotFoundError:
+                return 0
+
+        with os.scandir(directory) as it:
+            profiles = [entry for entry in it
+                        if entry.name.endswith('.collapsed')]
+
+        excess = len(profiles) - self.app.config['PROFILE_MAX_FILES']
+        profiles.sort(key=lambda entry: (mtime(entry), entry.name))
+        for entry in profiles[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,246 @@
+"""Token-bucket rate limiting for expensive routes.
+
+Buckets are kept as GCRA ("generic cell rate algorithm") state: a single
+theoretical arrival time per key rather than a token count and a refill
+timestamp. It behaves exactly like a token bucket of `capacity` tokens
+refilled at `capacity / period` per second, and lets every store update a
+bucket with one compare-and-set.
+
+A request drawing on several buckets (per IP and per user, say) takes a
+token from each only if every one of them has a token to give: running
+one bucket dry never spends another's.
+"""
+
+import math
+import mmap
+import struct
+import time
+import zlib
+from functools import wraps
+from multiprocessing import Lock as ProcessLock
+from threading import Lock
+
+from flask import g, request
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.exceptions import TooManyRequests
+
+from models import db, RateLimit
+
+
+class MemoryStore:
+    """Buckets in a dict: per process, so limits multiply by worker count."""
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = Lock()
+
+    def hit(self, key, interval, tolerance, now):
+        """Take a token from `key`'s bucket.
+
+        Returns 0 if allowed, else how many seconds until a token is free.
+        """
+
+        return self.hit_all([(key, interval, tolerance)], now)
+
+    def hit_all(self, buckets, now):
+        """Take a token from each (key, interval, tolerance) bucket, or
+        from none of them. Returns 0 if allowed, else how many seconds
+        until every bucket has a token free.
+        """
+
+        with self._lock:
+            tats = {key: max(self._tats.get(key, now), now) + interval
+                    for key, interval, _tolerance in buckets}
+            wait = max(tats[key] - now - tolerance
+                       for key, _interval, tolerance in buckets)
+            if wait > 0:
+                return wait
+
+            self._tats.update(tats)
+            return 0
+
+    def reset(self):
+        with self._lock:
+            self._tats.clear()
+
+
+class SharedMemoryStore:
+    """Buckets in an anonymous shared mmap that forked workers inherit.
+
+    Create it before gunicorn forks (preload_app) and every worker on the
+    host shares the same limits. Keys hash into a fixed number of slots;
+    a slot holds a fingerprint of its key so unrelated keys only share a
+    bucket if both are active at once, which errs on the strict side.
+    """
+
+    SLOT = struct.Struct('<Id')
+
+    def __init__(self, slots=65536):
+        self.slots = slots
+        self._map = mmap.mmap(-1, slots * self.SLOT.size)
+        self._lock = ProcessLock()
+
+    def hit(self, key, interval, tolerance, now):
+        return self.hit_all([(key, interval, tolerance)], now)
+
+    def hit_all(self, buckets, now):
+        # slot offset -> (fingerprint, tat), as it will be if allowed
+        slots = {}
+        wait = 0
+
+        with self._lock:
+            for key, interval, tolerance in buckets:
+                digest = zlib.crc32(key.encode())
+                offset = (digest % self.slots) * self.SLOT.size
+
+                fingerprint, tat = slots.get(offset) or self.SLOT.unpack_from(
+                    self._map, offset)
+                if fingerprint != digest and tat <= now:
+                    tat = now
+
+                tat = max(tat, now) + interval
+                wait = max(wait, tat - now - tolerance)
+                slots[offset] = (digest, tat)
+
+            if wait > 0:
+                return wait
+
+            for offset, (digest, tat) in slots.items():
+                self.SLOT.pack_into(self._map, offset, digest, tat)
+            return 0
+
+    def reset(self):
+        with self._lock:
+            self._map[:] = bytes(len(self._map))
+
+
+class DatabaseStore:
+    """Buckets in the `rate_limits` table, shared by every host.
+
+    Each bucket takes one atomic INSERT ... ON CONFLICT DO UPDATE ... WHERE
+    that only takes a token if one is free, so a hit costs a round trip per
+    bucket rather than microseconds; use it when workers span machines.
+    A request's buckets are hit in one transaction, rolled back if any of
+    them is dry.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def hit(self, key, interval, tolerance, now):
+        return self.hit_all([(key, interval, tolerance)], now)
+
+    def hit_all(self, buckets, now):
+        engine = db.get_engine(self.app)
+        dialect = postgresql if engine.dialect.name == 'postgresql' else sqlite
+        table = RateLimit.__table__
+
+        with engine.connect() as conn:
+            transaction = conn.begin()
+
+            # in key order, so two requests locking the same rows can't
+            # each wait on the other
+            for key, interval, tolerance in sorted(buckets):
+                upsert = dialect.insert(table).values(key=key,
+                                                      tat=now + interval)
+                next_tat = db.func.greatest(table.c.tat, now) + interval
+                if dialect is sqlite:
+                    next_tat = db.func.max(table.c.tat, now) + interval
+
+                upsert = upsert.on_conflict_do_update(
+                    index_elements=[table.c.key],
+                    set_={'tat': next_tat},
+                    where=next_tat - now <= tolerance,
+                )
+                if not conn.execute(upsert).rowcount:
+                    transaction.rollback()
+                    return self._wait(conn, buckets, now)
+
+            transaction.commit()
+            return 0
+
+    @staticmethod
+    def _wait(conn, buckets, now):
+        table = RateLimit.__table__
+        tats = dict(conn.execute(
+            db.select(table.c.key, table.c.tat)
+            .where(table.c.key.in_([key for key, *_ in buckets]))).all())
+
+        # a request may have freed a token since; still, this one was refused
+        return max(1, *(max(tats.get(key, now), now) + interval - now
+                        - tolerance
+                        for key, interval, tolerance in buckets))
+
+    def reset(self):
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(db.delete(RateLimit.__table__))
+
+
+class RateLimiter:
+    """Per-route token buckets keyed by client IP and by logged-in user.
+
+    app.config['RATELIMITS'] maps a route name to the buckets it uses, e.g.
+    {'login': {'ip': (10, 60)}} allows 10 attempts per IP per minute.
+    app.config['RATELIMIT_STORAGE'] picks the store: 'memory', 'shared'
+    or 'database'.
+    """
+
+    stores = {
+        'memory': lambda app: MemoryStore(),
+        'shared': lambda app: SharedMemoryStore(),
+        'database': DatabaseStore,
+    }
+
+    def __init__(self, app):
+        self.app = app
+        self.store = self.stores[app.config['RATELIMIT_STORAGE']](app)
+
+    def limit(self, name, methods=('POST',)):
+        """Decorate a view so `methods` requests draw from `name`'s buckets
+        and get a 429 with Retry-After once they run dry.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def limited(*args, **kwargs):
+                if request.method in methods:
+                    self.check(name)
+                return view(*args, **kwargs)
+            return limited
+
+        return decorator
+
+    def check(self, name):
+        """Take a token from each of `name`'s buckets, or from none of them
+        and raise a 429.
+        """
+
+        if not self.app.config['RATELIMIT_ENABLED']:
+            return
+
+        buckets = []
+        for scope, (capacity, period) in self.app.config['RATELIMITS'].get(
+                name, {}).items():
+            client = self._client(scope)
+            if client is not None:
+                buckets.append(
+                    (f"{name}:{scope}:{client}", period / capacity, period))
+
+        if not buckets:
+            return
+
+        wait = self.store.hit_all(buckets, time.time())
+        if wait:
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+    def reset(self):
+        self.store.reset()
+
+    @staticmethod
+    def _client(scope):
+        if scope == 'ip':
+            # the client's, not the load balancer's, with PROXY_HOPS set
+            return request.remote_addr
+        if scope == 'user':
+            return g.user.id if g.get('user') else None
+        raise ValueError(f"Unknown rate limit scope {scope!r}")
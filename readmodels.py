@@ -0,0 +1,351 @@
+"""Read-only rows for the list pages.
+
+Pages that only show users and messages don't need ORM instances: the
+queries here select just the columns the templates use and return plain
+namedtuples, so there's no identity map, change tracking or password hash
+to pay for. Whether the viewer likes a message, or follows a user, comes
+back as a column of the same query.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain, islice
+
+from models import (
+    db, User, Message, Like, LikeCount, Follows, Hashtag, Mention,
+    Notification, Recommendation)
+
+# How far back the feed looks before it reads older months' partitions
+RECENT = timedelta(days=31)
+
+UserCard = namedtuple('UserCard', [
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'is_followed',
+])
+
+MessageRow = namedtuple('MessageRow', [
+    'id',
+    'text',
+    'timestamp',
+    'user_id',
+    'username',
+    'image_url',
+    'liked',
+])
+
+Liker = namedtuple('Liker', [
+    'id',
+    'username',
+    'image_url',
+])
+
+NotificationRow = namedtuple('NotificationRow', [
+    'id',
+    'kind',
+    'subject_id',
+    'actor_id',
+    'actor_username',
+    'actor_image_url',
+    'actor_count',
+    'updated_at',
+    'read',
+])
+
+
+def user_cards(viewer_id):
+    """Select the columns of a user card, and whether `viewer_id` follows
+    that user.
+    """
+
+    viewer = db.aliased(Follows)
+
+    return (db.select(User.id,
+                      User.username,
+                      User.image_url,
+                      User.header_image_url,
+                      User.bio,
+                      viewer.user_following_id.isnot(None))
+            .outerjoin(viewer, db.and_(
+                viewer.user_being_followed_id == User.id,
+                viewer.user_following_id == viewer_id)))
+
+
+def message_rows(viewer_id):
+    """Select messages with their authors, and whether `viewer_id` likes
+    each one.
+    """
+
+    viewer = db.aliased(Like)
+
+    return (db.select(Message.id,
+                      Message.text,
+                      Message.timestamp,
+                      Message.user_id,
+                      User.username,
+                      User.image_url,
+                      viewer.user_id.isnot(None))
+            .join(User, User.id == Message.user_id)
+            .outerjoin(viewer, db.and_(
+                viewer.message_id == Message.id,
+                viewer.user_id == viewer_id)))
+
+
+def fetch(stmt, dto):
+    return [dto._make(row) for row in db.session.execute(stmt)]
+
+
+def stream(stmt, dto, rows):
+    """Yield `stmt`'s results as `dto`s, reading `rows` at a time from a
+    server-side cursor. Nothing runs until the first row is asked for.
+    """
+
+    result = db.session.execute(stmt.execution_options(yield_per=rows))
+    for row in result:
+        yield dto._make(row)
+
+
+def search_users(viewer_id, search=None, rows=200):
+    """Stream cards for every user, or those whose name contains `search`."""
+
+    stmt = user_cards(viewer_id)
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+
+    return stream(stmt.order_by(User.id), UserCard, rows)
+
+
+def following(user_id, viewer_id, after=0, limit=None):
+    """Cards for users `user_id` follows, by id, starting after `after`."""
+
+    return fetch(user_cards(viewer_id)
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .where(Follows.user_following_id == user_id,
+                        User.id > after)
+                 .order_by(User.id)
+                 .limit(limit),
+                 UserCard)
+
+
+def followers(user_id, viewer_id, after=0, limit=None):
+    """Cards for users following `user_id`, by id, starting after `after`."""
+
+    return fetch(user_cards(viewer_id)
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .where(Follows.user_being_followed_id == user_id,
+                        User.id > after)
+                 .order_by(User.id)
+                 .limit(limit),
+                 UserCard)
+
+
+def suggestions(user_id, limit=5):
+    """Cards for `user_id`'s top suggestions (see models.Recommendation),
+    skipping anyone they've followed since.
+    """
+
+    already_following = db.exists().where(
+        Follows.user_following_id == user_id,
+        Follows.user_being_followed_id == Recommendation.recommended_user_id,
+    )
+
+    return fetch(user_cards(user_id)
+                 .join(Recommendation,
+                       Recommendation.recommended_user_id == User.id)
+                 .where(Recommendation.user_id == user_id,
+                        ~already_following)
+                 .order_by(Recommendation.rank)
+                 .limit(limit),
+                 UserCard)
+
+
+def message(message_id, viewer_id):
+    """The row for `message_id`, or None."""
+
+    rows = fetch(message_rows(viewer_id).where(Message.id == message_id),
+                 MessageRow)
+    return rows[0] if rows else None
+
+
+def feed(author_ids, viewer_id, after=None, limit=100):
+    """The newest messages by any of `author_ids`, optionally only those
+    posted after the datetime `after`.
+    """
+
+    if after is not None:
+        return _feed(author_ids, viewer_id, limit, newer_than=after)
+
+    # Bounded by time, the query only reads the last month or two of
+    # messages' partitions. Older ones are read only if that's not enough.
+    recent = datetime.utcnow() - RECENT
+    rows = _feed(author_ids, viewer_id, limit, newer_than=recent)
+    if len(rows) < limit:
+        rows += _feed(author_ids, viewer_id, limit - len(rows),
+                      older_than=recent)
+    return rows
+
+
+def _feed(author_ids, viewer_id, limit, newer_than=None, older_than=None):
+    # The feed query runs on every home page view, so it's a lambda
+    # statement: built and compiled once per shape, with only the
+    # parameter values taken from the closures on later calls.
+    stmt = db.lambda_stmt(lambda: message_rows(viewer_id))
+    stmt += lambda s: s.where(Message.user_id.in_(author_ids))
+    if newer_than is not None:
+        stmt += lambda s: s.where(Message.timestamp > newer_than)
+    if older_than is not None:
+        stmt += lambda s: s.where(Message.timestamp <= older_than)
+    stmt += lambda s: s.order_by(Message.timestamp.desc()).limit(limit)
+
+    return fetch(stmt, MessageRow)
+
+
+def user_messages(user_id, viewer_id, rows=200, archive=None):
+    """Stream `user_id`'s messages, newest first, going on to those in
+    `archive` (an archive.MessageArchive) once the live ones run out.
+    """
+
+    live = stream(message_rows(viewer_id)
+                  .where(Message.user_id == user_id)
+                  .order_by(Message.timestamp.desc()),
+                  MessageRow, rows)
+
+    if archive is None:
+        return live
+    return chain(live, archived_messages(archive, user_id, rows))
+
+
+def archived_messages(archive, user_id, rows=200):
+    """Yield `user_id`'s archived messages as MessageRows. Their likes
+    went with them, so none is liked.
+    """
+
+    messages = iter(archive.messages(user_id))
+    author = None
+
+    while batch := list(islice(messages, rows)):
+        if author is None:
+            author = db.session.execute(
+                db.select(User.username, User.image_url)
+                .where(User.id == user_id)).one()
+
+        for m in batch:
+            yield MessageRow(m['id'], m['text'], m['timestamp'], user_id,
+                             author.username, author.image_url, False)
+
+
+def like_count(message_id):
+    """How many likes `message_id` has, from its counter."""
+
+    return db.session.execute(
+        db.select(LikeCount.likes)
+        .where(LikeCount.message_id == message_id)).scalar() or 0
+
+
+def likers(message_id, after=0, limit=None):
+    """Users who like `message_id`, by id, starting after `after`.
+
+    Reads one range of the (message_id, user_id) index on likes, so a page
+    costs the same however many likes the message has.
+    """
+
+    return fetch(db.select(User.id, User.username, User.image_url)
+                 .join(Like, Like.user_id == User.id)
+                 .where(Like.message_id == message_id,
+                        Like.user_id > after)
+                 .order_by(Like.user_id)
+                 .limit(limit),
+                 Liker)
+
+
+def index_page(model, term, before=None, limit=20):
+    """Select (message_id, timestamp) for a page of `model`'s (Hashtag's or
+    Mention's) rows matching `term`, newest first, starting after the
+    message `before`.
+
+    Keyset pagination: the page starts where the index range does, or just
+    past `before`'s row, so a deep page costs what the first one does.
+    """
+
+    stmt = db.select(model.message_id, model.timestamp).where(term)
+
+    if before is not None:
+        cursor = db.session.execute(
+            db.select(model.timestamp, model.message_id)
+            .where(term, model.message_id == before)).one_or_none()
+        if cursor is not None:
+            stmt = stmt.where(db.tuple_(model.timestamp, model.message_id)
+                              < db.tuple_(*cursor))
+
+    return (stmt
+            .order_by(model.timestamp.desc(), model.message_id.desc())
+            .limit(limit))
+
+
+def indexed_messages(page, viewer_id):
+    """The rows for an `index_page`'s (message_id, timestamp) results, in
+    its order, leaving out messages that are gone.
+    """
+
+    if not page:
+        return []
+
+    # the timestamps too let Postgres go straight to the messages'
+    # partitions
+    found = {row.id: row for row in fetch(
+        message_rows(viewer_id)
+        .where(Message.id.in_([message_id for message_id, _ in page]),
+               Message.timestamp.in_({timestamp for _, timestamp in page})),
+        MessageRow)}
+
+    return [found[message_id] for message_id, _ in page
+            if message_id in found]
+
+
+def liked_messages(user_id, viewer_id, rows=200):
+    """Stream the messages `user_id` has liked."""
+
+    liker = db.aliased(Like)
+
+    return stream(message_rows(viewer_id)
+                  .join(liker, liker.message_id == Message.id)
+                  .where(liker.user_id == user_id)
+                  .order_by(Message.timestamp.desc()),
+                  MessageRow, rows)
+
+
+def notifications(user_id, before=None, limit=20):
+    """A page of `user_id`'s notifications, latest first, starting after
+    the notification `before`.
+    """
+
+    stmt = (db.select(Notification.id,
+                      Notification.kind,
+                      Notification.subject_id,
+                      Notification.actor_id,
+                      User.username,
+                      User.image_url,
+                      Notification.actor_count,
+                      Notification.updated_at,
+                      Notification.read)
+            .outerjoin(User, User.id == Notification.actor_id)
+            .where(Notification.user_id == user_id))
+
+    if before is not None:
+        cursor = db.session.execute(
+            db.select(Notification.updated_at, Notification.id)
+            .where(Notification.user_id == user_id,
+                   Notification.id == before)).one_or_none()
+        if cursor is not None:
+            stmt = stmt.where(
+                db.tuple_(Notification.updated_at, Notification.id)
+                < db.tuple_(*cursor))
+
+    return fetch(stmt
+                 .order_by(Notification.updated_at.desc(),
+                           Notification.id.desc())
+                 .limit(limit),
+                 NotificationRow)
@@ -0,0 +1,450 @@
+"""Messages and likes spread over several databases by user.
+
+With MESSAGE_SHARDS set to a list of database URLs, a user's messages, and
+the likes on them, live on shard `user_id % len(MESSAGE_SHARDS)`; users and
+follows stay in the main database. A message's id says which shard it's
+on: shard n stores local id k as message id k * len(MESSAGE_SHARDS) + n, so
+routes given only an id go straight to the right database. That's why the
+number of shards can't change once messages have been written.
+
+Reads that span users, like the home feed, ask every shard involved at
+once, each for its own newest `limit` rows, and merge the sorted answers.
+Rows come back as readmodels.MessageRow, with authors filled in from the
+main database, so templates can't tell the difference.
+"""
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User
+from readmodels import Liker, MessageRow
+import tags
+
+metadata = sa.MetaData()
+
+messages = sa.Table(
+    'messages', metadata,
+    sa.Column('local_id', sa.Integer, primary_key=True),
+    sa.Column('text', sa.String(140), nullable=False),
+    sa.Column('timestamp', sa.DateTime, nullable=False,
+              default=datetime.utcnow),
+    sa.Column('user_id', sa.Integer, nullable=False),
+    sa.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+likes = sa.Table(
+    'likes', metadata,
+    sa.Column('user_id', sa.Integer, primary_key=True),
+    sa.Column('message_local_id', sa.Integer,
+              sa.ForeignKey('messages.local_id', ondelete='CASCADE'),
+              primary_key=True),
+    sa.Index('ix_likes_message_local_id_user_id',
+             'message_local_id', 'user_id'),
+)
+
+# How many likes each message has, kept by triggers on likes as
+# like_counts is in the main database (see models.py), so a message's page
+# needn't count them. Created with the table, so an older shard gets the
+# counts when `flask create-shards` adds it.
+like_counts = sa.Table(
+    'like_counts', metadata,
+    sa.Column('message_local_id', sa.Integer,
+              sa.ForeignKey('messages.local_id', ondelete='CASCADE'),
+              primary_key=True),
+    sa.Column('likes', sa.Integer, nullable=False, default=0),
+)
+
+like_counts.add_is_dependent_on(likes)
+
+sa.event.listen(like_counts, 'after_create', sa.DDL("""
+    INSERT INTO like_counts (message_local_id, likes)
+        SELECT message_local_id, count(*) FROM likes
+        GROUP BY message_local_id;
+
+    CREATE OR REPLACE FUNCTION count_shard_likes() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO like_counts (message_local_id, likes)
+                SELECT message_local_id, count(*) FROM new_likes
+                GROUP BY message_local_id ORDER BY message_local_id
+            ON CONFLICT (message_local_id)
+                DO UPDATE SET likes = like_counts.likes + excluded.likes;
+        ELSE
+            UPDATE like_counts SET likes = like_counts.likes - gone.likes
+                FROM (SELECT message_local_id, count(*) AS likes
+                      FROM old_likes GROUP BY message_local_id) AS gone
+                WHERE like_counts.message_local_id = gone.message_local_id;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE TRIGGER likes_count_insert AFTER INSERT ON likes
+        REFERENCING NEW TABLE AS new_likes
+        FOR EACH STATEMENT EXECUTE FUNCTION count_shard_likes();
+
+    CREATE TRIGGER likes_count_delete AFTER DELETE ON likes
+        REFERENCING OLD TABLE AS old_likes
+        FOR EACH STATEMENT EXECUTE FUNCTION count_shard_likes();
+""").execute_if(dialect='postgresql'))
+
+# SQLite (for trying shards out) runs one statement at a time
+sa.event.listen(like_counts, 'after_create', sa.DDL("""
+    INSERT INTO like_counts (message_local_id, likes)
+        SELECT message_local_id, count(*) FROM likes
+        GROUP BY message_local_id
+""").execute_if(dialect='sqlite'))
+
+sa.event.listen(like_counts, 'after_create', sa.DDL("""
+    CREATE TRIGGER likes_count_insert AFTER INSERT ON likes
+    BEGIN
+        INSERT INTO like_counts (message_local_id, likes)
+            VALUES (NEW.message_local_id, 1)
+            ON CONFLICT (message_local_id) DO UPDATE SET likes = likes + 1;
+    END
+""").execute_if(dialect='sqlite'))
+
+sa.event.listen(like_counts, 'after_create', sa.DDL("""
+    CREATE TRIGGER likes_count_delete AFTER DELETE ON likes
+    BEGIN
+        UPDATE like_counts SET likes = likes - 1
+            WHERE message_local_id = OLD.message_local_id;
+    END
+""").execute_if(dialect='sqlite'))
+
+
+class ShardRouter:
+    """Sends message reads and writes to the shards in MESSAGE_SHARDS."""
+
+    def __init__(self, app, guard=None):
+        self.app = app
+        self.guard = guard
+        self.engines = [sa.create_engine(url)
+                        for url in app.config['MESSAGE_SHARDS']]
+        # every request the worker is serving may be fanning out at once;
+        # threads start only as they're needed (greenlets, under gevent)
+        self._pool = ThreadPoolExecutor(
+            max_workers=(len(self.engines) or 1)
+            * app.config['SHARD_CONCURRENT_REQUESTS'],
+            thread_name_prefix='shard')
+
+        if guard is not None:
+            guard.watch(*self.engines)
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def create_all(self):
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    def shard_of_user(self, user_id):
+        return user_id % len(self.engines)
+
+    def locate(self, message_id):
+        """(shard, local id) of `message_id`."""
+
+        return message_id % len(self.engines), message_id // len(self.engines)
+
+    ##########################################################################
+    # Writes
+
+    def add_message(self, user_id, text, timestamp=None):
+        """Store a message by `user_id`; returns its id."""
+
+        shard = self.shard_of_user(user_id)
+        with self.engines[shard].begin() as conn:
+            result = conn.execute(messages.insert().values(
+                user_id=user_id,
+                text=text,
+                timestamp=timestamp or datetime.utcnow()))
+            local_id = result.inserted_primary_key[0]
+
+        return local_id * len(self.engines) + shard
+
+    def delete_message(self, message_id):
+        shard, local_id = self.locate(message_id)
+
+        # (SQLite leaves foreign keys unenforced unless asked, so the likes
+        # go explicitly rather than by cascade)
+        with self.engines[shard].begin() as conn:
+            conn.execute(likes.delete().where(
+                likes.c.message_local_id == local_id))
+            conn.execute(like_counts.delete().where(
+                like_counts.c.message_local_id == local_id))
+            conn.execute(messages.delete().where(
+                messages.c.local_id == local_id))
+
+        # its tags and mentions are indexed in the main database
+        tags.unindex_messages([message_id])
+        db.session.commit()
+
+    def like(self, message_id, user_id):
+        """Add a like; returns whether it's new."""
+
+        shard, local_id = self.locate(message_id)
+
+        try:
+            with self.engines[shard].begin() as conn:
+                conn.execute(likes.insert().values(
+                    user_id=user_id, message_local_id=local_id))
+        except IntegrityError:
+            return False  # liked already
+
+        return True
+
+    def unlike(self, message_id, user_id):
+        """Remove a like; returns whether there was one."""
+
+        shard, local_id = self.locate(message_id)
+        with self.engines[shard].begin() as conn:
+            result = conn.execute(likes.delete().where(
+                likes.c.user_id == user_id,
+                likes.c.message_local_id == local_id))
+
+        return result.rowcount > 0
+
+    def purge_user(self, user_id):
+        """Delete `user_id`'s messages, and their likes everywhere."""
+
+        def purge(shard):
+            purged = []
+            with self.engines[shard].begin() as conn:
+                conn.execute(likes.delete().where(likes.c.user_id == user_id))
+
+                if shard == self.shard_of_user(user_id):
+                    theirs = (sa.select(messages.c.local_id)
+                              .where(messages.c.user_id == user_id))
+                    purged = [local_id * len(self.engines) + shard
+                              for local_id in conn.execute(theirs).scalars()]
+                    conn.execute(likes.delete().where(
+                        likes.c.message_local_id.in_(theirs)))
+                    conn.execute(like_counts.delete().where(
+                        like_counts.c.message_local_id.in_(theirs)))
+                    conn.execute(messages.delete().where(
+                        messages.c.user_id == user_id))
+            return purged
+
+        purged = [message_id
+                  for ids in self._scatter(purge, range(len(self.engines)))
+                  for message_id in ids]
+
+        # and their tags and mentions from the main database's index
+        for start in range(0, len(purged), 1000):
+            tags.unindex_messages(purged[start:start + 1000])
+        db.session.commit()
+
+    ##########################################################################
+    # Reads
+
+    def _rows(self, shard, viewer_id):
+        """Select a shard's messages under their global ids, and whether
+        `viewer_id` likes each one.
+        """
+
+        viewer = likes.alias('viewer')
+
+        return (sa.select(
+                    (messages.c.local_id * len(self.engines) + shard)
+                    .label('id'),
+                    messages.c.text,
+                    messages.c.timestamp,
+                    messages.c.user_id,
+                    viewer.c.user_id.isnot(None).label('liked'))
+                .outerjoin(viewer, sa.and_(
+                    viewer.c.message_local_id == messages.c.local_id,
+                    viewer.c.user_id == viewer_id)))
+
+    def _scatter(self, query, shards):
+        """`query(shard)` for each of `shards`, in parallel."""
+
+        shards = list(shards)
+        if len(shards) == 1:
+            return [query(shards[0])]
+
+        if self.guard is not None:
+            # pool threads aren't in the request: give them its timeout
+            timeout, unbounded = self.guard.timeout_ms(), query
+
+            def query(shard):
+                with self.guard.statement_timeout(timeout):
+                    return unbounded(shard)
+
+        return list(self._pool.map(query, shards))
+
+    def _with_authors(self, rows):
+        """`rows` as MessageRows, with usernames and images from the main
+        database.
+        """
+
+        rows = list(rows)
+        authors = dict(
+            (user_id, (username, image_url))
+            for user_id, username, image_url in db.session.execute(
+                db.select(User.id, User.username, User.image_url)
+                .where(User.id.in_({row.user_id for row in rows}))))
+
+        return [MessageRow(row.id, row.text, row.timestamp, row.user_id,
+                           *authors.get(row.user_id, (None, None)),
+                           bool(row.liked))
+                for row in rows]
+
+    def get_message(self, message_id, viewer_id):
+        """The MessageRow for `message_id`, or None."""
+
+        shard, local_id = self.locate(message_id)
+        with self.engines[shard].connect() as conn:
+            row = conn.execute(self._rows(shard, viewer_id).where(
+                messages.c.local_id == local_id)).one_or_none()
+
+        return self._with_authors([row])[0] if row else None
+
+    def messages(self, message_ids, viewer_id):
+        """MessageRows for `message_ids`, in that order, leaving out any
+        that are gone.
+        """
+
+        by_shard = {}
+        for message_id in message_ids:
+            shard, local_id = self.locate(message_id)
+            by_shard.setdefault(shard, []).append(local_id)
+
+        def fetch(shard):
+            with self.engines[shard].connect() as conn:
+                return conn.execute(self._rows(shard, viewer_id).where(
+                    messages.c.local_id.in_(by_shard[shard]))).all()
+
+        rows = {row.id: row
+                for rows in self._scatter(fetch, by_shard) for row in rows}
+        return self._with_authors(
+            rows[message_id] for message_id in message_ids
+            if message_id in rows)
+
+    def feed(self, author_ids, viewer_id, after=None, limit=100):
+        """The newest `limit` messages by any of `author_ids`, optionally only
+        those posted after the datetime `after`.
+        """
+
+        by_shard = {}
+        for author_id in author_ids:
+            by_shard.setdefault(self.shard_of_user(author_id), []).append(
+                author_id)
+
+        def newest(shard):
+            stmt = (self._rows(shard, viewer_id)
+                    .where(messages.c.user_id.in_(by_shard[shard]))
+                    .order_by(messages.c.timestamp.desc())
+                    .limit(limit))
+            if after is not None:
+                stmt = stmt.where(messages.c.timestamp > after)
+
+            with self.engines[shard].connect() as conn:
+                return conn.execute(stmt).all()
+
+        # each shard's rows are newest first, so a k-way merge needs only
+        # the first `limit` of them all
+        merged = heapq.merge(*self._scatter(newest, by_shard),
+                             key=lambda row: row.timestamp, reverse=True)
+        return self._with_authors(islice(merged, limit))
+
+    def user_messages(self, user_id, viewer_id, rows=200):
+        """Stream `user_id`'s messages, newest first, from their shard."""
+
+        shard = self.shard_of_user(user_id)
+        stmt = (self._rows(shard, viewer_id)
+                .where(messages.c.user_id == user_id)
+                .order_by(messages.c.timestamp.desc())
+                .execution_options(yield_per=rows))
+
+        with self.engines[shard].connect() as conn:
+            for batch in conn.execute(stmt).partitions():
+                yield from self._with_authors(batch)
+
+    def liked_messages(self, user_id, viewer_id, rows=200):
+        """Stream the messages `user_id` has liked, newest first, merged as
+        they're read from every shard.
+        """
+
+        def liked(shard):
+            liker = likes.alias('liker')
+            stmt = (self._rows(shard, viewer_id)
+                    .join(liker,
+                          liker.c.message_local_id == messages.c.local_id)
+                    .where(liker.c.user_id == user_id)
+                    .order_by(messages.c.timestamp.desc())
+                    .execution_options(yield_per=rows))
+
+            with self.engines[shard].connect() as conn:
+                for batch in conn.execute(stmt).partitions():
+                    yield from batch
+
+        merged = heapq.merge(*(liked(shard)
+                               for shard in range(len(self.engines))),
+                             key=lambda row: row.timestamp, reverse=True)
+
+        while True:
+            batch = list(islice(merged, rows))
+            if not batch:
+                return
+            yield from self._with_authors(batch)
+
+    def like_count(self, message_id):
+        """How many likes `message_id` has, from its shard's counter."""
+
+        shard, local_id = self.locate(message_id)
+        with self.engines[shard].connect() as conn:
+            return conn.execute(
+                sa.select(like_counts.c.likes)
+                .where(like_counts.c.message_local_id == local_id)
+            ).scalar() or 0
+
+    def likers(self, message_id, after=0, per_page=20):
+        """A page of the users who like `message_id`, by id, starting
+        after `after`, and the id to continue after, or None on the last
+        page.
+
+        The page is cut from the shard's likes, so likers whose accounts
+        are gone (and not yet purged from the shard) leave it short rather
+        than ending it early.
+        """
+
+        shard, local_id = self.locate(message_id)
+        with self.engines[shard].connect() as conn:
+            user_ids = conn.execute(
+                sa.select(likes.c.user_id)
+                .where(likes.c.message_local_id == local_id,
+                       likes.c.user_id > after)
+                .order_by(likes.c.user_id)
+                .limit(per_page + 1)).scalars().all()
+
+        more = len(user_ids) > per_page
+        user_ids = user_ids[:per_page]
+
+        likers = [Liker._make(row) for row in db.session.execute(
+            db.select(User.id, User.username, User.image_url)
+            .where(User.id.in_(user_ids))
+            .order_by(User.id))]
+
+        return likers, (user_ids[-1] if more else None)
+
+    def message_count(self, user_id):
+        shard = self.shard_of_user(user_id)
+        with self.engines[shard].connect() as conn:
+            return conn.execute(
+                sa.select(sa.func.count())
+                .where(messages.c.user_id == user_id)).scalar()
+
+    def likes_count(self, user_id):
+        def count(shard):
+            with self.engines[shard].connect() as conn:
+                return conn.execute(
+                    sa.select(sa.func.count())
+                    .where(likes.c.user_id == user_id)).scalar()
+
+        return sum(self._scatter(count, range(len(self.engines))))
@@ -0,0 +1,244 @@
+"""A log of slow SQL statements, with their query plans.
+
+Every statement the app's engine runs is timed. Those slower than
+SLOW_QUERY_THRESHOLD_MS are recorded by fingerprint -- the SQL with its
+parameters and IN-lists collapsed, so the feed query counts as one
+statement however many people you follow -- with call counts, total and
+worst time, one example's parameters (strings redacted) and, on Postgres,
+the EXPLAIN (ANALYZE, BUFFERS) plan of the first slow SELECT seen. Plans
+are made on a background thread and a connection of their own, so the
+request that was slow isn't made slower, and a failed EXPLAIN can't
+spoil its transaction.
+
+Records go to a small SQLite file (SLOW_QUERY_STORE), not the app's
+database, and only the SLOW_QUERY_MAX_ENTRIES statements with the most
+total time are kept. `flask slow-queries` prints the worst of them.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from threading import Lock
+
+from sqlalchemy import event
+
+from models import db
+
+PARAM = re.compile(r"%\(\w+\)s|\?|:\w+|\$\d+")
+NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+STRING = re.compile(r"'(?:[^']|'')*'")
+LIST = re.compile(r"\(\s*\?(\s*,\s*\?)*\s*\)")
+SPACE = re.compile(r"\s+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slow_queries (
+    fingerprint TEXT PRIMARY KEY,
+    statement TEXT NOT NULL,
+    params TEXT,
+    plan TEXT,
+    calls INTEGER NOT NULL,
+    total_ms REAL NOT NULL,
+    max_ms REAL NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+)
+"""
+
+
+def normalize(statement):
+    """`statement` with literals and parameters as ? and IN-lists as (...)."""
+
+    statement = STRING.sub('?', statement)
+    statement = PARAM.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = LIST.sub('(...)', statement)
+    return SPACE.sub(' ', statement).strip()
+
+
+def fingerprint(statement):
+    return hashlib.sha1(normalize(statement).encode()).hexdigest()[:16]
+
+
+def redact(value):
+    """A parameter value safe to store: strings and bytes become their
+    type and length, so passwords and email addresses never reach the log.
+    """
+
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) > 5:
+            return f"<{len(value)} items>"
+        return [redact(item) for item in value]
+    if isinstance(value, (str, bytes, memoryview)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return f"<{type(value).__name__}>"
+
+
+class SlowQueryStore:
+    """The SQLite file slow statements are recorded in."""
+
+    def __init__(self, path, max_entries=500):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._ready = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn.execute(SCHEMA)
+            self._ready = True
+        return conn
+
+    def record(self, key, statement, params, plan, elapsed_ms):
+        now = time.time()
+
+        with self._lock, self.connect() as conn:
+            conn.execute("""
+                INSERT INTO slow_queries
+                    (fingerprint, statement, params, plan, calls, total_ms,
+                     max_ms, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)
+                ON CONFLICT (fingerprint) DO UPDATE SET
+                    params = excluded.params,
+                    plan = coalesce(plan, excluded.plan),
+                    calls = calls + 1,
+                    total_ms = total_ms + excluded.total_ms,
+                    max_ms = max(max_ms, excluded.max_ms),
+                    last_seen = excluded.last_seen
+            """, (key, statement, json.dumps(params, default=str), plan,
+                  elapsed_ms, elapsed_ms, now, now))
+
+            conn.execute("""
+                DELETE FROM slow_queries WHERE fingerprint NOT IN (
+                    SELECT fingerprint FROM slow_queries
+                    ORDER BY total_ms DESC LIMIT ?)
+            """, (self.max_entries,))
+
+    def set_plan(self, key, plan):
+        with self._lock, self.connect() as conn:
+            conn.execute(
+                "UPDATE slow_queries SET plan = coalesce(plan, ?) "
+                "WHERE fingerprint = ?", (plan, key))
+
+    def has_plan(self, key):
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT plan IS NOT NULL FROM slow_queries "
+                "WHERE fingerprint = ?", (key,)).fetchone()
+        return bool(row and row[0])
+
+    def top(self, limit=10):
+        """The statements with the most total time, worst first, as dicts."""
+
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM slow_queries ORDER BY total_ms DESC LIMIT ?",
+                (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def clear(self):
+        with self._lock, self.connect() as conn:
+            conn.execute("DELETE FROM slow_queries")
+
+
+class SlowQueryLog:
+    """Times every statement on `app`'s engine and records the slow ones."""
+
+    def __init__(self, app):
+        self.app = app
+        self.store = SlowQueryStore(app.config['SLOW_QUERY_STORE'],
+                                    app.config['SLOW_QUERY_MAX_ENTRIES'])
+        self._explained = set()
+        self._explainer = ThreadPoolExecutor(max_workers=1,
+                                             thread_name_prefix='explain')
+        self._pending = []
+
+        self.engine = db.get_engine(app)
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+
+    def drain(self):
+        """Wait for the plans asked for so far (for tests)."""
+
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed_ms = (time.perf_counter()
+                      - conn.info['query_started'].pop()) * 1000
+
+        threshold = self.app.config['SLOW_QUERY_THRESHOLD_MS']
+        if threshold is None or elapsed_ms < threshold:
+            return
+
+        try:
+            key = fingerprint(statement)
+            self.store.record(key, normalize(statement), redact(parameters),
+                              None, elapsed_ms)
+
+            if not executemany and self._wants_plan(conn, statement, key):
+                self._explained.add(key)
+                params = (dict(parameters) if isinstance(parameters, dict)
+                          else tuple(parameters or ()))
+                self._pending = [future for future in self._pending
+                                 if not future.done()]
+                self._pending.append(self._explainer.submit(
+                    self._record_plan, key, statement, params))
+        except Exception:
+            # never let the log break the query it's logging
+            self.app.logger.exception("Could not record slow query")
+
+    def _wants_plan(self, conn, statement, key):
+        if (not self.app.config['SLOW_QUERY_EXPLAIN']
+                or conn.dialect.name != 'postgresql'
+                or key in self._explained):
+            return False
+
+        # EXPLAIN ANALYZE runs the statement again: only ever for reads
+        words = statement.lstrip().split(None, 1)
+        if not words or words[0].upper() != 'SELECT':
+            return False
+
+        if self.store.has_plan(key):
+            self._explained.add(key)
+            return False
+        return True
+
+    def _record_plan(self, key, statement, parameters):
+        try:
+            self.store.set_plan(key, self._explain(statement, parameters))
+        except Exception:
+            self.app.logger.exception("Could not explain slow query")
+
+    def _explain(self, statement, parameters):
+        # straight on the DBAPI connection, so this isn't timed too; the
+        # transaction is rolled back when the connection goes back
+        timeout = int(self.app.config['SLOW_QUERY_EXPLAIN_TIMEOUT_MS'])
+        with self.engine.connect() as conn:
+            cursor = conn.connection.cursor()
+            try:
+                cursor.execute(f"SET LOCAL statement_timeout = {timeout}")
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}",
+                               parameters)
+                return '\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.close()
@@ -0,0 +1,35 @@
+"use strict";
+
+// Live "new warbles" notice for the home feed: the server pushes an event
+// whenever someone we follow posts, and we fetch only what we're missing.
+
+const $messages = $("#messages");
+const $newWarbles = $("#new-warbles");
+let unseen = 0;
+
+function countNewWarble() {
+  unseen += 1;
+  $newWarbles.text(`${unseen} new warble${unseen === 1 ? "" : "s"}`).show();
+}
+
+async function showNewWarbles(evt) {
+  evt.preventDefault();
+
+  const resp = await axios.get("/messages/since", {
+    params: { after: $messages.attr("data-newest") || "1970-01-01T00:00:00" },
+  });
+
+  $messages.prepend(resp.data);
+
+  const newest = $messages.children("[data-timestamp]").first();
+  if (newest.length) {
+    $messages.attr("data-newest", newest.attr("data-timestamp"));
+  }
+
+  unseen = 0;
+  $newWarbles.hide();
+}
+
+const source = new EventSource("/messages/stream");
+source.addEventListener("warble", countNewWarble);
+$newWarbles.on("click", showNewWarbles);
@@ -0,0 +1,132 @@
+"""Hashtags and @mentions, indexed as messages are written.
+
+Each #tag in a message is a row in `hashtags`, and each @username that names
+a user is a row in `mentions`, keyed by the tag (or mentioned user) and the
+message's timestamp. /tags/<tag> and a user's mentions page read one range
+of that index, newest first, a page at a time: they never look at
+messages.text.
+
+Tags are matched case-insensitively and stored lowercased; mentions must
+name a user exactly, and keep pointing at them if they change their
+username. Messages from before the index are added by `flask
+index-messages`, which several processes can share (see `backfill`).
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+from models import db, User, Message, Hashtag, Mention
+
+# A '#' or '@' that doesn't follow a word character, so email addresses and
+# things like "C#" aren't taken for tags or mentions
+TAG = re.compile(r"(?<!\w)#(\w+)")
+MENTION = re.compile(r"(?<!\w)@(\w+)")
+
+
+def parse(text):
+    """The (lowercased) tags and the usernames mentioned in `text`."""
+
+    tags = {tag.lower() for tag in TAG.findall(text)}
+    usernames = set(MENTION.findall(text))
+    return tags, usernames
+
+
+def index_rows(messages):
+    """Hashtag and Mention rows for `messages`, (id, author id, timestamp,
+    text) tuples, looking up every username they mention at once.
+    """
+
+    parsed = [(message, *parse(message[3])) for message in messages]
+
+    usernames = set().union(*(names for _, _, names in parsed))
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session.execute(
+            db.select(User.username, User.id)
+            .where(User.username.in_(usernames))).all())
+
+    rows = []
+    for (message_id, author_id, timestamp, _), tags, names in parsed:
+        rows += [Hashtag(tag=tag, timestamp=timestamp, message_id=message_id)
+                 for tag in tags]
+        rows += [Mention(user_id=user_ids[name], timestamp=timestamp,
+                         message_id=message_id)
+                 for name in names
+                 if name in user_ids and user_ids[name] != author_id]
+
+    return rows
+
+
+def index_message(message_id, author_id, timestamp, text):
+    """Add a new message's tags and mentions to the session. Doesn't commit."""
+
+    db.session.add_all(index_rows([(message_id, author_id, timestamp, text)]))
+
+
+def unindex_messages(message_ids):
+    """Remove messages' tags and mentions from the index. Doesn't commit.
+
+    Deleting from `messages` does this by trigger; this is for messages
+    that leave the main database some other way (sharded or archived).
+    """
+
+    for model in (Hashtag, Mention):
+        (model
+         .query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+
+def backfill(shard=0, shards=1, batch_size=1000):
+    """(Re)index every message where id % shards == shard.
+
+    Reads messages by id, `batch_size` at a time, and commits each batch's
+    index rows before reading the next, so any number of processes, each
+    with its own `shard`, can run at once and an interrupted run can simply
+    be started again. Returns the number of messages read.
+    """
+
+    done = 0
+    after = 0
+
+    while True:
+        batch = db.session.execute(
+            db.select(Message.id, Message.user_id, Message.timestamp,
+                      Message.text)
+            .where(Message.id > after, Message.id % shards == shard)
+            .order_by(Message.id)
+            .limit(batch_size)).all()
+        if not batch:
+            break
+
+        ids = [message_id for message_id, *_ in batch]
+        for model in Hashtag, Mention:
+            (model
+             .query
+             .filter(model.message_id.in_(ids))
+             .delete(synchronize_session=False))
+
+        db.session.add_all(index_rows(batch))
+        db.session.commit()
+
+        done += len(batch)
+        after = ids[-1]
+
+    return done
+
+
+def linkify(text):
+    """`text`, escaped, with its tags linked to their pages."""
+
+    # (matched before escaping: "&#39;" isn't a tag)
+    parts = []
+    end = 0
+    for match in TAG.finditer(text):
+        parts.append(escape(text[end:match.start()]))
+        parts.append(Markup('<a href="/tags/{0}">#{1}</a>').format(
+            match[1].lower(), match[1]))
+        end = match.end()
+    parts.append(escape(text[end:]))
+
+    return Markup('').join(parts)
@@ -0,0 +1,312 @@
+"""Side work that runs in the background once a transaction commits."""
+
+import time
+import traceback
+from datetime import datetime, timedelta
+from queue import Queue, Full, Empty
+from threading import Lock, Thread
+
+from sqlalchemy import event
+
+from models import db, Job
+
+
+class TaskExecutor:
+    """A bounded queue drained by a small pool of worker threads.
+
+    Register functions with `@executor.task`, then call `executor.defer`
+    during a request: the task is queued only once `db.session` commits,
+    and is dropped if it rolls back. Task arguments must be JSON-safe.
+
+    `defer` also writes the task to the `jobs` table, in the caller's
+    transaction, and the row is deleted once the task has run. A task
+    still queued when the process dies is run by another worker once its
+    lease is up. One that raises is retried with exponential backoff by
+    whichever worker next finds it due. Nothing needs a broker, and a task
+    may run more than once but isn't lost.
+
+    `on_commit` is for best-effort work too small to be worth saving: it
+    runs in the committing thread, straight after the commit.
+    """
+
+    def __init__(self, app=None, workers=2, max_queue=1000, max_attempts=5,
+                 retry_delay=10, poll_interval=10, lease=300):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+        self._tasks = {}
+        self._info_key = ('deferred_tasks', id(self))
+        self._hooks_key = ('commit_hooks', id(self))
+        self._queue = Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'overflowed': 0,
+            'wait_ms_total': 0.0,
+            'run_ms_total': 0.0,
+            'run_ms_max': 0.0,
+        }
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['tasks'] = self
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    def task(self, fn):
+        """Register `fn` so it can be deferred and retried by name."""
+
+        self._tasks[fn.__name__] = fn
+        return fn
+
+    def defer(self, fn, *args):
+        """Run `fn(*args)` in the background after the session commits."""
+
+        if self._tasks.get(fn.__name__) is not fn:
+            raise ValueError(f"{fn.__name__} is not a registered task")
+
+        # leased to this process until it's had time to run it from memory
+        job_id = db.session.execute(db.insert(Job).values(
+            task=fn.__name__,
+            args=list(args),
+            attempts=0,
+            run_at=datetime.utcnow() + timedelta(seconds=self.lease),
+        )).inserted_primary_key[0]
+
+        db.session().info.setdefault(self._info_key, []).append(
+            (fn.__name__, list(args), job_id))
+
+    def submit(self, name, args, job_id=None):
+        """Queue a task now, or park it in `jobs` if the queue is full.
+        `job_id` is its row in `jobs`, if it has one already.
+        """
+
+        self._start()
+
+        with self._lock:
+            self._stats['submitted'] += 1
+
+        try:
+            self._queue.put_nowait((name, args, job_id, time.perf_counter()))
+        except Full:
+            with self._lock:
+                self._stats['overflowed'] += 1
+            if job_id is None:
+                self._save_job(name, args, attempts=0, error="queue full")
+            else:
+                self._release_job(job_id, error="queue full")
+
+    def drain(self):
+        """Block until every queued task has finished."""
+
+        self._queue.join()
+
+    def run_due_jobs(self, limit=100):
+        """Run up to `limit` jobs whose retry time has come.
+
+        Returns the number of jobs run. Each job is claimed with SKIP
+        LOCKED and leased for `lease` seconds just before it runs, one at
+        a time, so several processes can share the table, a crashed run is
+        picked up again, and a job never waits out its lease in a batch.
+        """
+
+        ran = 0
+        with self.app.app_context():
+            while ran < limit:
+                claimed = self._claim_job()
+                if claimed is None:
+                    break
+
+                job_id, name, args, attempts = claimed
+                job = Job.query.filter_by(id=job_id)
+                try:
+                    self._run(name, args)
+                except Exception:
+                    db.session.rollback()
+                    attempts += 1
+                    job.update({
+                        'attempts': attempts,
+                        'last_error': traceback.format_exc(),
+                        'run_at': self._next_run(attempts),
+                        'failed_at': (datetime.utcnow()
+                                      if attempts >= self.max_attempts
+                                      else None),
+                    })
+                else:
+                    job.delete()
+                db.session.commit()
+                ran += 1
+
+        return ran
+
+    def stats(self):
+        """Queue depth and latency counters for this process."""
+
+        with self._lock:
+            stats = dict(self._stats)
+
+        finished = stats['completed'] + stats['failed']
+        stats['queue_depth'] = self._queue.qsize()
+        stats['wait_ms_avg'] = stats['wait_ms_total'] / finished if finished else 0
+        stats['run_ms_avg'] = stats['run_ms_total'] / finished if finished else 0
+
+        return stats
+
+    def on_commit(self, fn, *args):
+        """Call `fn(*args)` as soon as the session commits, in the
+        committing thread, or never if it rolls back.
+
+        Nothing is saved to `jobs`, so this is for quick work that may be
+        lost with the process, like a notice to connected browsers, which
+        isn't worth two writes to make durable.
+        """
+
+        db.session().info.setdefault(self._hooks_key, []).append((fn, args))
+
+    def _after_commit(self, session):
+        for fn, args in session.info.pop(self._hooks_key, ()):
+            try:
+                fn(*args)
+            except Exception:
+                # committed already: there's no one to tell
+                self.app.logger.exception(f"{fn.__name__} failed on commit")
+
+        for name, args, job_id in session.info.pop(self._info_key, ()):
+            self.submit(name, args, job_id)
+
+    def _after_rollback(self, session):
+        session.info.pop(self._hooks_key, None)
+        session.info.pop(self._info_key, None)
+
+    def _start(self):
+        if self._threads:
+            return
+
+        with self._lock:
+            if not self._threads:
+                self._threads = [Thread(target=self._work, daemon=True)
+                                 for _ in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                name, args, job_id, queued_at = self._queue.get(
+                    timeout=self.poll_interval)
+            except Empty:
+                self._poll_jobs()
+                continue
+
+            started = time.perf_counter()
+            ok = False
+            try:
+                with self.app.app_context():
+                    try:
+                        self._run(name, args)
+                    except Exception:
+                        self.app.logger.exception(
+                            f"Task {name} failed; will retry")
+                        self._retry_later(name, args, job_id,
+                                          traceback.format_exc())
+                    else:
+                        ok = True
+                        self._finish_job(job_id)
+            except Exception:
+                # the task's row is still leased, and runs again when it's up
+                self.app.logger.exception(f"Could not update task {name}")
+            finally:
+                self._record(queued_at, started, ok)
+                self._queue.task_done()
+
+    def _poll_jobs(self):
+        try:
+            self.run_due_jobs()
+        except Exception:
+            self.app.logger.exception("Could not run due jobs")
+
+    def _run(self, name, args):
+        self._tasks[name](*args)
+
+    def _record(self, queued_at, started, ok):
+        finished = time.perf_counter()
+        run_ms = (finished - started) * 1000
+
+        with self._lock:
+            self._stats['completed' if ok else 'failed'] += 1
+            self._stats['wait_ms_total'] += (started - queued_at) * 1000
+            self._stats['run_ms_total'] += run_ms
+            self._stats['run_ms_max'] = max(self._stats['run_ms_max'], run_ms)
+
+    def _next_run(self, attempts):
+        return datetime.utcnow() + timedelta(
+            seconds=self.retry_delay * 2 ** (attempts - 1))
+
+    def _claim_job(self):
+        job = (Job
+               .query
+               .filter(Job.failed_at.is_(None),
+                       Job.run_at <= datetime.utcnow())
+               .order_by(Job.run_at)
+               .limit(1)
+               .with_for_update(skip_locked=True)
+               .first())
+        if job is None:
+            db.session.commit()
+            return None
+
+        claimed = (job.id, job.task, job.args, job.attempts)
+        job.run_at = datetime.utcnow() + timedelta(seconds=self.lease)
+        db.session.commit()
+        return claimed
+
+    def _finish_job(self, job_id):
+        if job_id is not None:
+            Job.query.filter_by(id=job_id).delete()
+            db.session.commit()
+
+    def _retry_later(self, name, args, job_id, error):
+        db.session.rollback()
+
+        if job_id is None:
+            self._save_job(name, args, attempts=1, error=error)
+            return
+
+        Job.query.filter_by(id=job_id).update({
+            'attempts': 1,
+            'last_error': error,
+            'run_at': self._next_run(1),
+        })
+        db.session.commit()
+
+    def _release_job(self, job_id, error):
+        # like _save_job, after the session's commit: its own connection
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(db.update(Job)
+                         .where(Job.id == job_id)
+                         .values(run_at=datetime.utcnow(), last_error=error))
+
+    def _save_job(self, name, args, attempts, error):
+        run_at = self._next_run(attempts) if attempts else datetime.utcnow()
+
+        # its own connection: this runs after the session's commit, or in a
+        # worker whose session may be mid-failure
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(db.insert(Job).values(
+                task=name,
+                args=args,
+                attempts=attempts,
+                run_at=run_at,
+                last_error=error,
+            ))
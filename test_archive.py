@@ -0,0 +1,187 @@
+""" Message partition and archive tests """
+
+import os
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from sqlalchemy import text
+
+from models import db, User, Message, Like
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, message_archive, tasks, CURR_USER_KEY
+import archive
+import readmodels
+
+db.create_all()
+
+ON_POSTGRES = db.get_engine(app).dialect.name == 'postgresql'
+
+OLD = datetime(2001, 3, 15)
+
+
+def rows_in(table):
+    return db.session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+
+@skipUnless(ON_POSTGRES, "messages are partitioned only on Postgres")
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        archive.ensure_partitions(ahead=1)
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        old = Message(text="old", user_id=u2.id, timestamp=OLD)
+        new = Message(text="new", user_id=u2.id)
+        db.session.add_all([old, new])
+        db.session.flush()
+
+        db.session.add(Like(user_id=u1.id, message_id=old.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.old_id = old.id
+        self.new_id = new.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.tmp.name
+
+    def tearDown(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.execute(text("DROP TABLE IF EXISTS messages_2001_03"))
+        db.session.commit()
+        self.tmp.cleanup()
+
+    def test_partitions(self):
+        """ Test old rows move from the default partition to their month's """
+        self.assertEqual(rows_in("messages_default"), 1)
+
+        added = archive.ensure_partitions(ahead=0)
+
+        self.assertIn(datetime(2001, 3, 1), added)
+        self.assertEqual(rows_in("messages_default"), 0)
+        self.assertEqual(rows_in("messages_2001_03"), 1)
+        self.assertEqual(Message.query.get(self.old_id).text, "old")
+        self.assertEqual(archive.ensure_partitions(ahead=0), [])
+
+    def test_likes_follow_messages(self):
+        """ Test deleting a message deletes its likes, moving it doesn't """
+        Message.query.get(self.old_id).timestamp = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(Like.query.count(), 1)
+
+        Message.query.filter_by(id=self.old_id).delete()
+        db.session.commit()
+        self.assertEqual(Like.query.count(), 0)
+
+    def check_archived(self, suffix):
+        self.assertEqual(message_archive.archive(keep_months=12),
+                         [datetime(2001, 3, 1)])
+
+        self.assertEqual(os.listdir(self.tmp.name),
+                         [f"messages_2001_03.{suffix}"])
+        self.assertNotIn(datetime(2001, 3, 1), archive.partitions())
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertEqual(Like.query.count(), 0)
+
+        rows = list(readmodels.user_messages(
+            self.u2_id, self.u1_id, rows=1, archive=message_archive))
+
+        self.assertEqual([(row.id, row.text, row.liked) for row in rows],
+                         [(self.new_id, "new", False),
+                          (self.old_id, "old", False)])
+        self.assertEqual(rows[1].timestamp, OLD)
+        self.assertEqual(rows[1].username, "u2")
+
+        self.assertEqual(list(message_archive.messages(self.u1_id)), [])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            profile = c.get(f"/users/{self.u2_id}").text
+            self.assertNotIn("<p>old</p>", profile)
+            self.assertIn(f'href="/users/{self.u2_id}/archive"', profile)
+
+            older = c.get(f"/users/{self.u2_id}/archive").text
+            self.assertIn("<p>old</p>", older)
+            self.assertNotIn("<p>new</p>", older)
+            self.assertNotIn(f"/messages/{self.old_id}", older)
+            self.assertNotIn(f"/{self.old_id}/like", older)
+
+    def test_archive_parquet(self):
+        """ Test old months are archived to Parquet and read back """
+        self.check_archived("parquet")
+
+    def test_archive_ndjson(self):
+        """ Test the archive falls back to JSON lines without pyarrow """
+        with patch.object(archive, "pq", None):
+            self.check_archived("ndjson.gz")
+
+    def test_feed_reads_older_months(self):
+        """ Test the feed goes past the recent partitions when it's short """
+        rows = readmodels.feed([self.u2_id], self.u1_id)
+        self.assertEqual([row.text for row in rows], ["new", "old"])
+
+        rows = readmodels.feed([self.u2_id], self.u1_id, limit=1)
+        self.assertEqual([row.text for row in rows], ["new"])
+
+
+Row = namedtuple('Row', archive.COLUMNS)
+
+
+class ArchivePurgeTestCase(TestCase):
+    """ Test deleted accounts are removed from the archive files """
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(app.config.__setitem__, 'MESSAGE_ARCHIVE_DIR',
+                        app.config['MESSAGE_ARCHIVE_DIR'])
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.tmp.name
+
+        for month, n in ((datetime(2001, 3, 1), 1), (datetime(2001, 4, 1), 3)):
+            rows = sorted((Row(n + i, f"m{n + i}", month, user_id)
+                           for i, user_id in enumerate([u1.id, u2.id])),
+                          key=lambda row: row.user_id)
+            message_archive._write_ndjson(month, rows)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_purge_user(self):
+        """ Test a user's messages go from every month, others' stay """
+        self.assertEqual(message_archive.purge_user(self.u1_id),
+                         [datetime(2001, 4, 1), datetime(2001, 3, 1)])
+        self.assertEqual(message_archive.purge_user(self.u1_id), [])
+
+        self.assertEqual(list(message_archive.messages(self.u1_id)), [])
+        self.assertEqual([m['text'] for m in
+                          message_archive.messages(self.u2_id)],
+                         ["m4", "m2"])
+
+    def test_deleted_account(self):
+        """ Test deleting an account purges it from the archive """
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post("/users/delete")
+        tasks.drain()
+
+        self.assertEqual(list(message_archive.messages(self.u2_id)), [])
+        self.assertEqual(len(list(message_archive.messages(self.u1_id))), 2)
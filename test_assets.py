@@ -0,0 +1,156 @@
+""" Static asset pipeline tests """
+
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, static_assets
+import assets
+
+db.create_all()
+
+
+def write_file(root, name, content):
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class AssetBuildTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.static = os.path.join(self.tmp.name, 'static')
+        self.out = os.path.join(self.static, 'dist')
+
+        # stand-ins for what `assets.vendor` would download
+        write_file(self.static, 'vendor/lib.css',
+                   b'@font-face { src: url("./fonts/icons.woff2?abc") }')
+        write_file(self.static, 'vendor/fonts/icons.woff2', b'font')
+        write_file(self.static, 'vendor/lib.js', b'var lib = 1')
+        write_file(self.static, 'site.css',
+                   b'/* header */\nnav {\n  background: url(/static/bg.png);\n}\n')
+        write_file(self.static, 'site.js', b'// like things\n  like();\n\n')
+        write_file(self.static, 'bg.png', b'png')
+
+        self.bundles = {
+            'app.css': ['vendor/lib.css', 'site.css'],
+            'app.js': ['vendor/lib.js', 'site.js'],
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.out, name), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """ Test files are hashed, bundled, rewritten and precompressed """
+        manifest = assets.build(self.static, self.out, bundles=self.bundles)
+
+        self.assertRegex(manifest['bg.png'], r'^bg\.[0-9a-f]{12}\.png$')
+        self.assertNotIn('dist/manifest.json', manifest)
+
+        css = self.read(manifest['app.css']).decode()
+        self.assertIn(f'url("/assets/{manifest["vendor/fonts/icons.woff2"]}")',
+                      css)
+        self.assertIn(f'url("/assets/{manifest["bg.png"]}")', css)
+        self.assertNotIn('header', css)
+        self.assertIn('nav{background:', css)
+
+        js = self.read(manifest['app.js'])
+        self.assertEqual(js, b'var lib = 1;\nlike();')
+        self.assertEqual(gzip.decompress(self.read(manifest['app.js'] + '.gz')),
+                         js)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.out, manifest['bg.png'] + '.gz')))
+
+        with open(os.path.join(self.out, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+    def test_build_is_reproducible(self):
+        """ Test rebuilding unchanged files gives identical output """
+        first = assets.build(self.static, self.out, bundles=self.bundles)
+        gz = self.read(first['app.css'] + '.gz')
+
+        self.assertEqual(
+            assets.build(self.static, self.out, bundles=self.bundles), first)
+        self.assertEqual(self.read(first['app.css'] + '.gz'), gz)
+
+    def test_content_change_changes_name(self):
+        """ Test editing a file gives it a new fingerprint """
+        first = assets.build(self.static, self.out, bundles=self.bundles)
+        write_file(self.static, 'site.js', b'unlike();')
+        second = assets.build(self.static, self.out, bundles=self.bundles)
+
+        self.assertNotEqual(first['app.js'], second['app.js'])
+        self.assertEqual(first['bg.png'], second['bg.png'])
+
+
+class AssetViewTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = self.tmp.name
+        self.saved_dir = static_assets.out_dir
+
+        static_assets.out_dir = self.out
+        assets.write(os.path.join(self.out, 'app.0123456789ab.js'),
+                     b'like();' * 100)
+        with open(os.path.join(self.out, 'manifest.json'), 'w') as f:
+            json.dump({'app.js': 'app.0123456789ab.js'}, f)
+        static_assets.load()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        static_assets.out_dir = self.saved_dir
+        static_assets.load()
+        self.tmp.cleanup()
+
+    def test_serve_gzip(self):
+        """ Test a gzip-capable client gets the precompressed file """
+        resp = self.client.get('/assets/app.0123456789ab.js',
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', resp.content_type)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.data), b'like();' * 100)
+
+        cache_control = resp.headers['Cache-Control']
+        self.assertIn('immutable', cache_control)
+        self.assertIn('max-age=31536000', cache_control)
+        self.assertNotIn('no-store', cache_control)
+
+    def test_serve_identity(self):
+        """ Test a client without gzip gets the plain file """
+        resp = self.client.get('/assets/app.0123456789ab.js',
+                               headers={'Accept-Encoding': 'identity'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b'like();' * 100)
+
+    def test_serve_missing(self):
+        """ Test unknown and escaping paths 404 """
+        self.assertEqual(
+            self.client.get('/assets/nope.js').status_code, 404)
+        self.assertEqual(
+            self.client.get('/assets/../app.py').status_code, 404)
+
+    def test_pages_link_built_assets(self):
+        """ Test pages use the bundle once assets are built """
+        resp = self.client.get('/signup')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn('src="/assets/app.0123456789ab.js"', html)
+        self.assertNotIn('unpkg.com/axios', html)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
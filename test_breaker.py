@@ -0,0 +1,229 @@
+""" Circuit breaker and degraded-mode tests """
+
+import os
+import time
+from contextlib import contextmanager
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from models import db, User, Message
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, db_guard, CURR_USER_KEY
+from breaker import CircuitBreaker
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@contextmanager
+def slow_database(delay):
+    """ Stand in for a struggling database: each statement waits `delay`
+    seconds before it's sent """
+
+    engine = db.get_engine(app)
+
+    def stall(*args):
+        time.sleep(delay)
+
+    event.listen(engine, 'before_cursor_execute', stall)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', stall)
+
+
+@contextmanager
+def failing_statements(pattern):
+    """ Stand in for statements being cancelled: those containing
+    `pattern` fail as Postgres fails one that overruns its timeout """
+
+    engine = db.get_engine(app)
+
+    def cancel(conn, cursor, statement, *args):
+        if pattern in statement:
+            raise sa.exc.OperationalError(
+                statement, None,
+                Exception("canceling statement due to statement timeout"))
+
+    event.listen(engine, 'before_cursor_execute', cancel)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', cancel)
+
+
+class CircuitBreakerTestCase(TestCase):
+    """ Test the breaker on its own """
+    def setUp(self):
+        self.breaker = CircuitBreaker(failures=2, reset_after=30)
+
+    def test_opens_after_consecutive_failures(self):
+        """ Test only failures in a row open the breaker """
+        self.breaker.failure()
+        self.breaker.success()
+        self.assertFalse(self.breaker.failure())
+        self.assertFalse(self.breaker.is_open)
+
+        self.assertTrue(self.breaker.failure())
+        self.assertTrue(self.breaker.is_open)
+
+    def test_retries_after_reset(self):
+        """ Test one call is let through after `reset_after`, closing the
+        breaker on success and reopening it on failure """
+        now = time.monotonic()
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+
+        with patch('breaker.time.monotonic', return_value=now + 31):
+            self.assertTrue(self.breaker.allow())
+            self.assertTrue(self.breaker.failure())
+            self.assertFalse(self.breaker.allow())
+
+        with patch('breaker.time.monotonic', return_value=now + 62):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertFalse(self.breaker.failure())
+
+    def test_single_probe(self):
+        """ Test other callers keep failing fast while one tries """
+        now = time.monotonic()
+        self.breaker.failure()
+        self.breaker.failure()
+        others = []
+
+        def other():
+            others.append(self.breaker.allow())
+            self.breaker.success()
+
+        with patch('breaker.time.monotonic', return_value=now + 31):
+            self.assertTrue(self.breaker.allow())
+            thread = Thread(target=other)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(others, [False])
+        self.assertTrue(self.breaker.is_open)
+
+
+class DegradedModeTestCase(TestCase):
+    """ Test pages served and refused while the database is down """
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        db.session.add(Message(text="remember me", user_id=u1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db_guard.breaker.reset()
+        db_guard.pages.clear()
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_slow_database_trips_breaker(self):
+        """ Test statements overrunning their timeout open the breaker """
+        with self.client as c:
+            self.login(c)
+
+            with slow_database(0.01), patch.dict(app.config, {
+                    'STATEMENT_TIMEOUT_MS': 1, 'STATEMENT_TIMEOUTS': {}}):
+                c.get("/")
+
+            self.assertTrue(db_guard.breaker.is_open)
+
+            resp = c.get(f"/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("trouble reaching its database", resp.text)
+
+    def test_serves_last_good_pages(self):
+        """ Test the home feed and profiles come from their last render """
+        with self.client as c:
+            self.login(c)
+            self.assertNotIn("copy of the page", c.get("/").text)
+            c.get(f"/users/{self.u1_id}").get_data()
+
+            for n in range(app.config['DB_BREAKER_FAILURES']):
+                db_guard.breaker.failure()
+
+            for url in ("/", f"/users/{self.u1_id}"):
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("remember me", resp.text)
+                self.assertIn("copy of the page", resp.text)
+
+    def test_writes_fail_fast(self):
+        """ Test posting is refused without asking the database """
+        with self.client as c:
+            self.login(c)
+            for n in range(app.config['DB_BREAKER_FAILURES']):
+                db_guard.breaker.failure()
+
+            with slow_database(2):
+                started = time.monotonic()
+                resp = c.post("/messages/new", data={"text": "hello"})
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "30")
+            self.assertLess(time.monotonic() - started, 1)
+
+        db_guard.breaker.reset()
+        self.assertEqual(Message.query.filter_by(text="hello").count(), 0)
+
+    def test_recovers(self):
+        """ Test the breaker closes once the database answers again """
+        now = time.monotonic()
+
+        with self.client as c:
+            self.login(c)
+            for n in range(app.config['DB_BREAKER_FAILURES']):
+                db_guard.breaker.failure()
+
+            with patch('breaker.time.monotonic', return_value=now + 31):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("copy of the page", resp.text)
+            self.assertFalse(db_guard.breaker.is_open)
+
+    def test_streamed_profile_query_fails(self):
+        """ Test a profile whose message query fails is answered from its
+        last good copy, not sent as a broken page """
+        with self.client as c:
+            self.login(c)
+            c.get(f"/users/{self.u1_id}").get_data()
+
+            with failing_statements("FROM messages"):
+                resp = c.get(f"/users/{self.u1_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("remember me", resp.text)
+            self.assertIn("copy of the page", resp.text)
+
+    def test_streamed_profile_without_copy(self):
+        """ Test a failing profile with nothing remembered is a 503 """
+        with self.client as c:
+            self.login(c)
+
+            with failing_statements("FROM messages"):
+                resp = c.get(f"/users/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("trouble reaching its database", resp.text)
@@ -0,0 +1,158 @@
+""" Bulk follow/unfollow tests """
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Follows, Notification
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import (app, tasks, warbles, get_follow_graph, follows_removed,
+                 CURR_USER_KEY, FOLLOWS_KEY)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BulkFollowTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+                 for n in range(6)]
+        db.session.flush()
+
+        db.session.add(Follows(user_being_followed_id=users[1].id,
+                               user_following_id=users[0].id))
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def following(self, user_id):
+        return Follows.followed_among(user_id, self.user_ids)
+
+    def post(self, c, **kwargs):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+        return c.post("/users/following/bulk", **kwargs)
+
+    def test_follow_and_unfollow(self):
+        """ Test ids and usernames are followed and a summary returned """
+        me, u1, u2, u3, u4, u5 = self.user_ids
+
+        with self.client as c:
+            resp = self.post(c, json={
+                "follow": [u2, "@u3", "u3", str(u1), "u0", "nobody", 999999],
+                "unfollow": ["u4"],
+            })
+            tasks.drain()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {
+            "followed": sorted([u2, u3]),
+            "already_following": [u1],
+            "unfollowed": [],
+            "not_following": [u4],
+            "not_found": ["nobody", "999999"],
+        })
+        self.assertEqual(self.following(me), {u1, u2, u3})
+        self.assertEqual(
+            sorted(n.user_id for n in Notification.query.all()),
+            sorted([u2, u3]))
+
+        with self.client as c:
+            resp = self.post(c, json={"unfollow": [u1, "u2", "u5"]})
+
+        self.assertEqual(resp.json["unfollowed"], sorted([u1, u2]))
+        self.assertEqual(resp.json["not_following"], [u5])
+        self.assertEqual(self.following(me), {u3})
+
+    def test_rejected(self):
+        """ Test forms, oversized lists and anonymous users are refused """
+        app.config['BULK_FOLLOW_MAX'] = 2
+        self.addCleanup(app.config.__setitem__, 'BULK_FOLLOW_MAX', 5000)
+
+        with self.client as c:
+            self.assertEqual(
+                self.post(c, json={"follow": ["u1", "u2", "u3"]}).status_code, 413)
+            self.assertEqual(
+                self.post(c, data={"follow": "u2"}).status_code, 400)
+            self.assertEqual(
+                self.post(c, json={"follow": "u2"}).status_code, 400)
+
+        resp = app.test_client().post("/users/following/bulk",
+                                      json={"follow": ["u2"]})
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(self.following(self.user_ids[0]),
+                         {self.user_ids[1]})
+
+    def test_cli(self):
+        """ Test the bulk-follow command reads targets from a file """
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["bulk-follow", "u0"],
+                               input="u2\nu3\nghost\n")
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 followed", result.output)
+        self.assertIn("Not found: ghost", result.output)
+
+        result = runner.invoke(args=["bulk-follow", "u0", "--unfollow"],
+                               input="u1 u2")
+        self.assertIn("2 unfollowed", result.output)
+        self.assertEqual(self.following(self.user_ids[0]),
+                         {self.user_ids[3]})
+
+    def test_changes_from_other_workers(self):
+        """ Test follows published by another worker reach this worker's
+        graph, and outlive it reloading an older snapshot """
+        me, u1, u2, u3, u4, u5 = self.user_ids
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "follows.graph")
+
+        with patch.dict(app.config, {'FOLLOW_GRAPH_PATH': path}), \
+                patch("app.follow_graph", None):
+            get_follow_graph().save(path)
+
+            # as published by another worker's bulk follow
+            warbles.publish(FOLLOWS_KEY, [u2, [me, u3], True])
+            self.assertTrue(get_follow_graph().is_following(u2, me))
+
+            with patch("app.follow_graph", None):
+                graph = get_follow_graph()
+
+            self.assertEqual(list(graph.following(u2)), [me, u3])
+
+    def test_deleted_accounts_leave_graph(self):
+        """ Test deleting an account, whole or in batches, removes its
+        follows both ways from the graph """
+        me, u1, u2, u3, u4, u5 = self.user_ids
+        for follower_id, followed_id in ((u1, me), (u2, me), (u2, u1),
+                                         (u3, u2), (u2, u3)):
+            db.session.add(Follows(user_following_id=follower_id,
+                                   user_being_followed_id=followed_id))
+        db.session.commit()
+        graph = get_follow_graph()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+            c.post("/users/delete")
+
+        self.assertEqual(list(graph.following(u1)), [])
+        self.assertEqual(list(graph.following(u2)), [u1, u3])
+        self.assertEqual(list(graph.followers(u1)), [u2])
+
+        User.purge(u2, batch_size=1, unfollowed=follows_removed)
+
+        self.assertEqual(list(graph.following(u2)), [])
+        self.assertEqual(list(graph.followers(u1)), [])
+        self.assertEqual(list(graph.following(u3)), [])
+        self.assertIs(get_follow_graph(), graph)
@@ -0,0 +1,42 @@
+""" Cache tests """
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import TaggedCache
+
+
+class TaggedCacheTestCase(TestCase):
+    """ Test the tagged LRU cache """
+    def setUp(self):
+        self.cache = TaggedCache(maxsize=2, ttl=10)
+
+    def test_get_set(self):
+        """ Test values come back until evicted """
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.assertEqual(self.cache.get("a"), 1)
+
+        self.cache.set("c", 3)
+
+        # "b" was least recently used
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalidate(self):
+        """ Test invalidating a tag drops only the entries carrying it """
+        self.cache.set("a", 1, tags=["x"])
+        self.cache.set("b", 2, tags=["y"])
+
+        self.cache.invalidate("x", "z")
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+
+    def test_expiry(self):
+        """ Test entries expire after the ttl """
+        with patch("cache.time.monotonic", return_value=100):
+            self.cache.set("a", 1)
+        with patch("cache.time.monotonic", return_value=111):
+            self.assertEqual(self.cache.get("a", "gone"), "gone")
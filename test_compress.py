@@ -0,0 +1,134 @@
+""" Response compression tests """
+
+import os
+import zlib
+from unittest import TestCase
+from unittest.mock import patch
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import FileWrapper
+
+from compress import Compress
+from forms import CSRFProtectForm
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app
+
+
+def streaming_app(chunks, **headers):
+    headers.setdefault('content_type', 'text/html; charset=utf-8')
+    return Response(iter(chunks), **headers)
+
+
+class CompressTestCase(TestCase):
+    """ Test the compression middleware """
+    def get(self, app, accept='gzip', **kwargs):
+        client = Client(Compress(app, min_size=10))
+        return client.get('/', headers={'Accept-Encoding': accept}, **kwargs)
+
+    def test_streamed_chunks_compressed_separately(self):
+        """ Test every chunk can be decompressed as soon as it arrives """
+        chunks = [b"<p>first</p>" * 50, b"<p>second</p>" * 50]
+        resp = self.get(streaming_app(chunks), buffered=False)
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', resp.headers)
+
+        decompressor = zlib.decompressobj(31)
+        body = iter(resp.response)
+        self.assertEqual(decompressor.decompress(next(body)), chunks[0])
+        self.assertEqual(decompressor.decompress(next(body)), chunks[1])
+
+        rest = b"".join(body)
+        self.assertEqual(decompressor.decompress(rest), b"")
+        self.assertTrue(decompressor.eof)
+        resp.close()
+
+    def test_not_accepted(self):
+        """ Test clients that don't ask for gzip get the plain body """
+        resp = self.get(streaming_app([b"x" * 100]), accept='identity')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b"x" * 100)
+
+    def test_skipped_responses(self):
+        """ Test small, binary and already-encoded responses pass through """
+        small = Response(b"tiny", content_type='text/html')
+        image = Response(b"x" * 100, content_type='image/png')
+        encoded = Response(b"x" * 100, content_type='text/css',
+                           headers={'Content-Encoding': 'br'})
+        events = streaming_app([b"data: 1\n\n" * 10],
+                               content_type='text/event-stream')
+
+        for app in (small, image, encoded, events):
+            resp = self.get(app)
+            self.assertNotEqual(resp.headers.get('Content-Encoding'), 'gzip')
+
+    def test_skipped_body_not_wrapped(self):
+        """ Test a file sent uncompressed keeps its wsgi.file_wrapper """
+        environ = EnvironBuilder(headers={'Accept-Encoding': 'gzip'}
+                                 ).get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+
+        with open(__file__, 'rb') as f:
+            def app(environ, start_response):
+                start_response('200 OK', [('Content-Type', 'application/zip')])
+                return environ['wsgi.file_wrapper'](f)
+
+            body = Compress(app, min_size=10)(environ, lambda *args: None)
+            self.assertIsInstance(body, FileWrapper)
+            body.close()
+
+    def test_lazy_start_response(self):
+        """ Test apps calling start_response when iterated get compressed """
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield b"x" * 100
+
+        resp = self.get(app)
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(resp.data, 31), b"x" * 100)
+
+    def test_vary_merged(self):
+        """ Test an existing Vary header is extended, not replaced """
+        resp = self.get(streaming_app([b"x" * 100], headers={'Vary': 'Cookie'}))
+
+        self.assertEqual(resp.headers['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_etag_weakened(self):
+        """ Test a strong ETag is kept as a weak one, and a weak one as is """
+        strong = streaming_app([b"x" * 100], headers={'ETag': '"abc"'})
+        weak = streaming_app([b"x" * 100], headers={'ETag': 'W/"abc"'})
+
+        self.assertEqual(self.get(strong).headers['ETag'], 'W/"abc"')
+        self.assertEqual(self.get(weak).headers['ETag'], 'W/"abc"')
+        self.assertEqual(self.get(strong, accept='identity').headers['ETag'],
+                         '"abc"')
+
+
+class MaskedCSRFTestCase(TestCase):
+    """ Test CSRF tokens differ on every page but still validate """
+    def setUp(self):
+        patcher = patch.dict(app.config, {'WTF_CSRF_ENABLED': True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_masked_tokens_validate(self):
+        """ Test two forms' tokens differ, and either one is accepted """
+        with app.test_request_context("/"):
+            tokens = [CSRFProtectForm().csrf_token.current_token
+                      for n in range(2)]
+            self.assertNotEqual(tokens[0], tokens[1])
+
+            for token in tokens:
+                form = CSRFProtectForm(MultiDict({'csrf_token': token}))
+                self.assertTrue(form.validate())
+
+            for token in ("garbage!", tokens[0][:-4], ""):
+                form = CSRFProtectForm(MultiDict({'csrf_token': token}))
+                self.assertFalse(form.validate())
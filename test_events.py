@@ -0,0 +1,32 @@
+""" Event bus tests """
+
+from unittest import TestCase
+
+from events import LocalBus
+
+
+class LocalBusTestCase(TestCase):
+    """ Test in-process publish/subscribe """
+    def setUp(self):
+        self.bus = LocalBus()
+
+    def test_publish(self):
+        """ Test subscribers only get events for their keys """
+        with self.bus.subscribe([1, 2]) as sub, self.bus.subscribe([3]) as other:
+            self.bus.publish(2, "hello")
+
+            self.assertEqual(sub.get(timeout=0), "hello")
+            self.assertIsNone(sub.get(timeout=0))
+            self.assertIsNone(other.get(timeout=0))
+            self.assertEqual(self.bus.subscriber_count(), 2)
+
+        self.assertEqual(self.bus.subscriber_count(), 0)
+
+    def test_slow_subscriber(self):
+        """ Test a subscriber that falls behind doesn't block publishers """
+        with self.bus.subscribe([1]) as sub:
+            for i in range(500):
+                self.bus.publish(1, i)
+
+            self.assertEqual(sub.get(timeout=0), 0)
+            self.assertTrue(sub.overflowed)
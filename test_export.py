@@ -0,0 +1,138 @@
+""" Data export tests """
+
+import json
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Like, Follows
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, exports, tasks, build_export, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def read_lines(archive, name):
+    return [json.loads(line) for line in archive.read(name).splitlines()]
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"m{n}", user_id=u1.id) for n in range(5)]
+        theirs = Message(text="theirs", user_id=u2.id)
+        db.session.add_all(messages + [theirs])
+        db.session.flush()
+
+        db.session.add_all([
+            Like(user_id=u1.id, message_id=theirs.id),
+            Follows(user_being_followed_id=u2.id, user_following_id=u1.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.theirs_id = theirs.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        patcher = patch.object(exports, "dir", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_archive_contents(self):
+        """ Test the export holds the profile, messages, likes and follows """
+        app.config['STREAM_ROWS'] = 2
+        self.addCleanup(app.config.__setitem__, 'STREAM_ROWS', 200)
+
+        build_export(self.u1_id)
+
+        with zipfile.ZipFile(exports.path(self.u1_id)) as archive:
+            self.assertEqual(archive.namelist(), [
+                'profile.json', 'messages.ndjson', 'likes.ndjson',
+                'following.ndjson', 'followers.ndjson'])
+
+            profile = json.loads(archive.read('profile.json'))
+            self.assertEqual(profile['username'], "u1")
+            self.assertNotIn('password', profile)
+
+            self.assertEqual(
+                sorted(m['text']
+                       for m in read_lines(archive, 'messages.ndjson')),
+                [f"m{n}" for n in range(5)])
+            [like] = read_lines(archive, 'likes.ndjson')
+            self.assertEqual((like['message_id'], like['author']),
+                             (self.theirs_id, "u2"))
+            self.assertEqual(read_lines(archive, 'following.ndjson'),
+                             [{'id': self.u2_id, 'username': "u2"}])
+            self.assertEqual(read_lines(archive, 'followers.ndjson'), [])
+
+        self.assertEqual(os.listdir(self.tmp.name), [f"{self.u1_id}.zip"])
+
+    def test_overlapping_builds(self):
+        """ Test a build starting while another is writing doesn't share
+        its temporary file """
+        def likes():
+            exports.build(self.u1_id, messages=[], likes=[])
+            yield from ()
+
+        exports.build(self.u1_id, messages=[], likes=likes())
+
+        with zipfile.ZipFile(exports.path(self.u1_id)) as archive:
+            self.assertIsNone(archive.testzip())
+        self.assertEqual(os.listdir(self.tmp.name), [f"{self.u1_id}.zip"])
+
+    def test_download_resumes(self):
+        """ Test an export is built in the background and downloads resume """
+        with self.client as c:
+            self.login(c)
+            self.assertEqual(c.get("/users/export/download").status_code,
+                             404)
+
+            c.post("/users/export")
+            tasks.drain()
+
+            self.assertIn("Download", c.get("/users/export")
+                          .get_data(as_text=True))
+
+            resp = c.get("/users/export/download")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("attachment", resp.headers['Content-Disposition'])
+            whole = resp.get_data()
+
+            resp = c.get("/users/export/download",
+                         headers={"Range": "bytes=100-",
+                                  "If-Range": resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.get_data(), whole[100:])
+
+    def test_removed_with_user(self):
+        """ Test deleting an account deletes its export """
+        build_export(self.u1_id)
+
+        with self.client as c:
+            self.login(c)
+            c.post("/users/delete")
+
+        self.assertIsNone(exports.built_at(self.u1_id))
@@ -0,0 +1,78 @@
+""" Follow graph tests """
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from graph import FollowChanges, FollowGraph, intersect
+
+
+class FollowGraphTestCase(TestCase):
+    """ Test the in-memory follow graph """
+    def setUp(self):
+        """ Build a small graph: 1 and 2 follow each other, 3 follows both """
+        self.graph = FollowGraph.from_edges(
+            [(1, 2), (2, 1), (3, 1), (3, 2), (1, 4)])
+
+    def test_neighbors(self):
+        """ Test that neighbor lists come back sorted in both directions """
+        self.assertEqual(list(self.graph.following(1)), [2, 4])
+        self.assertEqual(list(self.graph.followers(2)), [1, 3])
+        self.assertEqual(list(self.graph.following(99)), [])
+        self.assertEqual(self.graph.following_count(3), 2)
+        self.assertEqual(self.graph.followers_count(1), 2)
+
+    def test_is_following(self):
+        """ Test membership lookups """
+        self.assertTrue(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(99, 1))
+
+    def test_intersections(self):
+        """ Test mutual follows and followed-by-following """
+        self.assertEqual(self.graph.mutuals(1), [2])
+        self.assertEqual(self.graph.followed_by_following(3, 2), [1])
+        self.assertEqual(intersect([1, 5, 9], list(range(0, 100, 3))), [9])
+
+    def test_add_remove(self):
+        """ Test incremental updates keep the arrays sorted """
+        self.graph.add(1, 3)
+        self.graph.add(1, 3)
+        self.assertEqual(list(self.graph.following(1)), [2, 3, 4])
+        self.assertEqual(list(self.graph.followers(3)), [1])
+
+        self.graph.remove(1, 2)
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(list(self.graph.followers(2)), [3])
+
+    def test_save_load(self):
+        """ Test a saved snapshot memory-maps back to the same graph """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "follows.graph")
+            self.graph.save(path)
+            loaded = FollowGraph.load(path)
+
+            self.assertEqual(list(loaded.following(1)), [2, 4])
+            self.assertEqual(list(loaded.followers(2)), [1, 3])
+            self.assertEqual(loaded.mutuals(2), [1])
+            self.assertAlmostEqual(loaded.created_at, self.graph.created_at)
+
+            loaded.add(4, 1)
+            self.assertEqual(list(loaded.followers(1)), [2, 3, 4])
+
+    def test_replay_changes(self):
+        """ Test changes seen since a snapshot are replayed onto it """
+        changes = FollowChanges()
+        changes.record(4, [1, 2], True)
+        changes.record(3, [2], False)
+
+        since = self.graph.created_at
+        changes.replay(self.graph, since)
+
+        self.assertEqual(list(self.graph.following(4)), [1, 2])
+        self.assertEqual(list(self.graph.following(3)), [1])
+
+        changes.record(1, [3], True)
+        changes.replay(self.graph, since=time.time() + 1)
+        self.assertFalse(self.graph.is_following(1, 3))
@@ -0,0 +1,127 @@
+""" Health check tests """
+
+import json
+import os
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from breaker import CircuitBreaker
+from health import HealthChecks
+from models import db
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, CURR_USER_KEY
+
+
+def failing_app(environ, start_response):
+    raise AssertionError("health checks reached the app")
+
+
+def stub_app(environ, start_response):
+    status = 404 if environ['PATH_INFO'] == '/missing' else 200
+    return Response("page", status=status)(environ, start_response)
+
+
+class HealthChecksTestCase(TestCase):
+    """ Test the middleware around a stand-in app """
+    def setUp(self):
+        self.breaker = CircuitBreaker(failures=1)
+        self.checks = HealthChecks(
+            stub_app, {'main': sa.create_engine("sqlite://")},
+            breaker=self.breaker, ready_timeout=0.1)
+        self.client = Client(self.checks)
+
+    def get_json(self, path):
+        resp = self.client.get(path)
+        return resp.status_code, json.loads(resp.get_data())
+
+    def test_healthz(self):
+        """ Test /healthz answers without calling the app """
+        resp = Client(HealthChecks(failing_app, {})).get("/healthz")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.get_data()), {"status": "ok"})
+
+    def test_readyz(self):
+        """ Test /readyz reports the database, the breaker if asked to, and
+        slow pings """
+        self.assertEqual(self.get_json("/readyz"), (200, {"status": "ready"}))
+
+        self.breaker.failure()
+        self.assertEqual(self.get_json("/readyz"), (200, {"status": "ready"}))
+
+        self.checks.fail_on_breaker = True
+        status, body = self.get_json("/readyz")
+        self.assertEqual(status, 503)
+        self.assertEqual(body["reason"], "circuit breaker open")
+        self.breaker.reset()
+
+        with patch.object(HealthChecks, '_ping',
+                          lambda self: time.sleep(0.5)):
+            started = time.monotonic()
+            status, body = self.get_json("/readyz")
+
+        self.assertEqual(status, 503)
+        self.assertIn("didn't answer", body["reason"])
+        self.assertLess(time.monotonic() - started, 0.4)
+
+    def test_stats(self):
+        """ Test requests are counted by status, and pools described """
+        # the test client leaves closing the response to its caller
+        self.client.get("/").close()
+        self.client.get("/missing").close()
+        self.client.get("/healthz").close()
+
+        status, body = self.get_json("/stats")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["pid"], os.getpid())
+        self.assertEqual(body["requests"],
+                         {"total": 2, "in_flight": 0, "2xx": 1, "4xx": 1})
+        self.assertFalse(body["breaker_open"])
+        self.assertEqual(body["pools"]["main"]["class"],
+                         "SingletonThreadPool")
+        self.assertIsInstance(body["pools"]["main"]["size"], int)
+
+    def test_streamed_response_in_flight(self):
+        """ Test a response counts as in flight until it's closed """
+        resp = self.client.get("/", buffered=False)
+        self.assertEqual(self.checks._in_flight, 1)
+
+        resp.close()
+        self.assertEqual(self.checks._in_flight, 0)
+
+
+class AppHealthTestCase(TestCase):
+    """ Test the app's health endpoints skip its request hooks """
+    def test_no_database_work(self):
+        """ Test /healthz runs no SQL, even for a signed-in session """
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', count)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            resp = c.get("/healthz")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+        self.assertEqual(statements, [])
+
+    def test_readyz(self):
+        """ Test the app is ready with its database up """
+        resp = app.test_client().get("/readyz")
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,263 @@
+""" Image thumbnail tests """
+
+import os
+import tempfile
+import time
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from PIL import Image
+
+from models import db, User, Message
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, thumbnails, CURR_USER_KEY
+import images
+from images import ImageError, Thumbnails
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def fixture_image(size=(300, 200), image_format='PNG', color=(200, 30, 30)):
+    out = BytesIO()
+    Image.new('RGB', size, color).save(out, image_format)
+    return out.getvalue()
+
+
+def resolver(*answers):
+    """ A stand-in getaddrinfo giving each answer in turn, then the last """
+    answers = list(answers)
+
+    def getaddrinfo(host, port, **kwargs):
+        address = answers.pop(0) if len(answers) > 1 else answers[0]
+        return [(2, 1, 6, '', (address, port))]
+
+    return getaddrinfo
+
+
+class FakeConnection:
+    """ Records where it was told to connect; answers with `responses` """
+    connected = []
+    responses = []
+    sock = None
+
+    def __init__(self, host, port, address, timeout):
+        self.connected.append((host, address))
+
+    def request(self, method, path, headers):
+        pass
+
+    def getresponse(self):
+        status, headers, body = self.responses.pop(0)
+        read1 = body if callable(body) else BytesIO(body).read1
+        return Mock(status=status, getheader=headers.get, read1=read1)
+
+    def close(self):
+        pass
+
+
+class ThumbnailTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved_dir = thumbnails.dir
+        thumbnails.dir = self.tmp.name
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        thumbnails.dir = self.saved_dir
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def thumbnail_url(self, url, variant):
+        with app.test_request_context():
+            return thumbnails.thumbnail_url(url, variant)
+
+    def test_local_thumbnail(self):
+        """ Test a /static/ image is resized to WebP and cached """
+        url = self.thumbnail_url('/static/images/default-pic.png', 'avatar')
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+        self.assertNotIn('no-store', resp.headers['Cache-Control'])
+
+        image = Image.open(BytesIO(resp.data))
+        self.assertEqual((image.format, image.size), ('WEBP', (96, 96)))
+
+        with patch.object(Thumbnails, 'render', side_effect=AssertionError):
+            self.assertEqual(self.client.get(url).data, resp.data)
+
+    def test_remote_thumbnail_fetched_once(self):
+        """ Test a remote image is fetched once for all its variants """
+        url = "https://images.example.com/header.jpg"
+
+        with patch.object(Thumbnails, 'fetch',
+                          return_value=fixture_image((1280, 853), 'JPEG')
+                          ) as fetch:
+            hero = self.client.get(self.thumbnail_url(url, 'hero'))
+            card = self.client.get(self.thumbnail_url(url, 'card-hero'))
+
+        fetch.assert_called_once_with(url)
+        self.assertEqual(Image.open(BytesIO(hero.data)).size, (1600, 400))
+        self.assertEqual(Image.open(BytesIO(card.data)).size, (600, 200))
+
+    def test_changed_source_refetched(self):
+        """ Test a remote image is checked again once it's too old, and a
+        changed one gets new thumbnails """
+        url = "https://images.example.com/me.png"
+        red, blue = fixture_image(), fixture_image(color=(30, 30, 200))
+
+        with patch.object(Thumbnails, 'fetch', return_value=red):
+            first = self.client.get(self.thumbnail_url(url, 'profile')).data
+
+        later = time.time() + app.config['THUMBNAIL_MAX_AGE'] + 1
+        with patch.object(Thumbnails, 'fetch', return_value=blue), \
+                patch('images.time.time', return_value=later):
+            second = self.client.get(self.thumbnail_url(url, 'profile')).data
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(Image.open(BytesIO(second)).size, (400, 400))
+
+    def test_unavailable_source(self):
+        """ Test a source we can't fetch gets the default image, briefly
+        cached, and never a redirect to the source """
+        url = "https://images.example.com/gone.jpg"
+
+        with patch.object(Thumbnails, 'fetch', side_effect=ImageError("404")):
+            resp = self.client.get(self.thumbnail_url(url, 'avatar'))
+            hero = self.client.get(self.thumbnail_url(url, 'hero'))
+
+        default = self.client.get(
+            self.thumbnail_url('/static/images/default-pic.png', 'avatar'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, default.data)
+        self.assertEqual(resp.cache_control.max_age, images.FALLBACK_MAX_AGE)
+        self.assertEqual(Image.open(BytesIO(hero.data)).size, (1600, 400))
+
+    def test_bad_requests(self):
+        """ Test forged tokens and unknown variants 404 """
+        url = self.thumbnail_url('/static/images/default-pic.png', 'avatar')
+
+        self.assertEqual(self.client.get(url + "x").status_code, 404)
+        self.assertEqual(
+            self.client.get(url.replace('avatar', 'huge')).status_code, 404)
+
+    def test_fetch_refuses_private_addresses(self):
+        """ Test image URLs can't be used to reach our own network """
+        for url in ("http://127.0.0.1/x.png", "http://localhost/x.png",
+                    "file:///etc/passwd"):
+            with self.assertRaises(ImageError):
+                thumbnails.fetch(url)
+
+    def test_fetch_refuses_redirect_to_private_address(self):
+        """ Test a public URL can't redirect us into our own network """
+        FakeConnection.connected = []
+        FakeConnection.responses = [
+            (302, {"Location": "http://169.254.169.254/latest/"}, b""),
+            (200, {}, fixture_image()),
+        ]
+
+        with patch('images.socket.getaddrinfo',
+                   resolver("93.184.216.34", "169.254.169.254")), \
+                patch.object(images, 'PinnedHTTPConnection', FakeConnection):
+            with self.assertRaises(ImageError):
+                thumbnails.fetch("http://images.example.com/x.png")
+
+        self.assertEqual(FakeConnection.connected,
+                         [("images.example.com", "93.184.216.34")])
+
+    def test_fetch_connects_to_checked_address(self):
+        """ Test a host that resolves somewhere else the second time
+        (DNS rebinding) is still fetched from the address checked """
+        FakeConnection.connected = []
+        FakeConnection.responses = [
+            (301, {"Location": "/moved.png"}, b""),
+            (200, {}, fixture_image()),
+        ]
+
+        with patch('images.socket.getaddrinfo',
+                   resolver("93.184.216.34", "93.184.216.35", "10.0.0.5")), \
+                patch.object(images, 'PinnedHTTPConnection', FakeConnection):
+            thumbnails.fetch("http://images.example.com/x.png")
+
+            with self.assertRaises(ImageError):
+                FakeConnection.responses = [(200, {}, fixture_image())]
+                thumbnails.fetch("http://images.example.com/x.png")
+
+        self.assertEqual(FakeConnection.connected, [
+            ("images.example.com", "93.184.216.34"),
+            ("images.example.com", "93.184.216.35"),
+        ])
+
+    def test_fetch_deadline(self):
+        """ Test a source sending a byte at a time is given up on once the
+        fetch timeout has passed, however often bytes arrive """
+        def trickle(size):
+            time.sleep(0.02)
+            return b"x"
+
+        FakeConnection.connected = []
+        FakeConnection.responses = [(200, {}, trickle)]
+
+        with patch('images.socket.getaddrinfo', resolver("93.184.216.34")), \
+                patch.object(images, 'PinnedHTTPConnection', FakeConnection), \
+                patch.dict(app.config, {'THUMBNAIL_FETCH_TIMEOUT': 0.2}):
+            started = time.monotonic()
+            with self.assertRaises(ImageError):
+                thumbnails.fetch("http://images.example.com/x.png")
+
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_upload_profile_image(self):
+        """ Test an uploaded avatar is stored by content and used """
+        data = fixture_image()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/users/profile", data={
+                "username": "u1",
+                "email": "u1@email.com",
+                "password": "password",
+                "image_file": (BytesIO(data), "me.png"),
+            }, content_type="multipart/form-data")
+            self.assertEqual(resp.status_code, 302)
+
+            image_url = User.query.get(self.user_id).image_url
+            self.assertRegex(image_url, r"^/images/uploads/[0-9a-f]{64}\.png$")
+            self.assertEqual(c.get(image_url).data, data)
+
+            resp = c.get(self.thumbnail_url(image_url, 'profile'))
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (400, 400))
+
+    def test_upload_rejects_non_images(self):
+        """ Test uploads that aren't images are refused """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/users/profile", data={
+                "username": "u1",
+                "email": "u1@email.com",
+                "password": "password",
+                "image_file": (BytesIO(b"#!/bin/sh"), "me.png"),
+            }, content_type="multipart/form-data")
+
+            self.assertIn("t use that image", resp.get_data(as_text=True))
+            self.assertNotIn(
+                "/images/uploads/", User.query.get(self.user_id).image_url)
@@ -5,7 +5,7 @@ from unittest import TestCase
 
 from models import db, User, Message, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
 
 from app import app
 
@@ -6,20 +6,23 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
+from models import db, Message, User, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, tasks, CURR_USER_KEY
+from events import LocalBus
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -74,6 +77,64 @@ class MessageBaseViewTestCase(TestCase):
             html = resp.get_data(as_text = True)
             self.assertIn("m1-text", html)
 
+    def test_home_followed_messages(self):
+        """Test we see messages from users we follow once we follow them"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/").get_data(as_text = True)
+            self.assertNotIn("m2-text", html)
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            html = c.get("/").get_data(as_text = True)
+            self.assertIn("m2-text", html)
+
+    def test_new_messages_since(self):
+        """Test fetching only the feed items newer than a timestamp"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            after = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+            Message.query.get(self.m1_id).timestamp = datetime(2000, 1, 1)
+            db.session.add(Message(text="fresh", user_id=self.u1_id))
+            db.session.commit()
+
+            resp = c.get(f"/messages/since?after={after}")
+            html = resp.get_data(as_text = True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("fresh", html)
+            self.assertNotIn("m1-text", html)
+
+            resp = c.get("/messages/since?after=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_stream_new_messages(self):
+        """Test followers get a server-sent event when someone posts"""
+        with patch("app.warbles", LocalBus()):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                c.post(f"/users/follow/{self.u1_id}")
+                resp = c.get("/messages/stream")
+                self.assertEqual(resp.mimetype, "text/event-stream")
+                stream = resp.response
+
+                self.assertEqual(next(stream), b"retry: 10000\n\n")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/messages/new", data={"text": "Hello"})
+                tasks.drain()
+
+                self.assertEqual(
+                    next(stream), f"event: warble\ndata: {self.u1_id}\n\n".encode())
+                stream.close()
+
     def test_liked_messages(self):
         """Test we can see messages if user is logged in """
         with self.client as c:
@@ -99,6 +160,13 @@ class MessageBaseViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             html = resp.get_data(as_text = True)
             self.assertIn("m1-text", html)
+            self.assertIn(f'action="/{self.m1_id}/like"', html)
+
+            db.session.add(Like(user_id=self.u1_id, message_id=self.m1_id))
+            db.session.commit()
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text = True)
+            self.assertIn(f'action="/{self.m1_id}/unlike"', html)
 
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
@@ -132,6 +200,35 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn("Access unauthorized.", html)
 
 
+class MessageShowViewTestCase(MessageBaseViewTestCase):
+    """Test for showing a message"""
+    def test_show_likers(self):
+        """Test the message page counts its likes and pages its likers"""
+        app.config['LIKERS_PER_PAGE'] = 1
+        self.addCleanup(app.config.__setitem__, 'LIKERS_PER_PAGE', 24)
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all([Like(user_id=self.u2_id, message_id=self.m1_id),
+                            Like(user_id=u3.id, message_id=self.m1_id)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/messages/{self.m1_id}").get_data(as_text=True)
+            self.assertIn("2 likes", html)
+            self.assertIn('title="@u2"', html)
+            self.assertNotIn('title="@u3"', html)
+            self.assertIn(f'href="?after={self.u2_id}"', html)
+
+            html = c.get(f"/messages/{self.m1_id}?after={self.u2_id}"
+                         ).get_data(as_text=True)
+            self.assertIn('title="@u3"', html)
+            self.assertNotIn('href="?after=', html)
+
+
 class MessageDeleteViewTestCase(MessageBaseViewTestCase):
     """Test for message deleting"""
     def test_delete_message(self):
@@ -0,0 +1,136 @@
+""" Notification tests """
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, CURR_USER_KEY
+import notifications
+import readmodels
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NotificationsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+                 for n in range(5)]
+        db.session.flush()
+
+        message = Message(text="likeable", user_id=users[0].id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.message_id = message.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_likes_aggregate(self):
+        """ Test likes on one message while unread share a row """
+        owner, *likers = self.user_ids
+
+        with self.client as c:
+            for liker in likers:
+                self.login(c, liker)
+                c.post(f"/{self.message_id}/like")
+
+            [note] = readmodels.notifications(owner)
+            self.assertEqual(note.kind, notifications.LIKE)
+            self.assertEqual(note.subject_id, self.message_id)
+            self.assertEqual(note.actor_id, likers[-1])
+            self.assertEqual(note.actor_count, 4)
+            self.assertEqual(notifications.unread_count(owner), 1)
+
+            self.login(c, owner)
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn("@u4 </a> and 3 others liked",
+                          " ".join(html.split()))
+            self.assertEqual(notifications.unread_count(owner), 0)
+
+            self.login(c, likers[0])
+            c.post(f"/{self.message_id}/unlike")
+            c.post(f"/{self.message_id}/like")
+
+        # read rows are left be; the like after starts a new one
+        self.assertEqual(
+            [(n.actor_count, n.read)
+             for n in readmodels.notifications(owner)],
+            [(1, False), (4, True)])
+        self.assertEqual(notifications.unread_count(owner), 1)
+
+    def test_actors_count_once(self):
+        """ Test someone liking, unliking and liking again counts once """
+        owner, liker, other, *rest = self.user_ids
+
+        with self.client as c:
+            self.login(c, liker)
+            for n in range(3):
+                c.post(f"/{self.message_id}/like")
+                c.post(f"/{self.message_id}/unlike")
+            c.post(f"/{self.message_id}/like")
+
+            self.login(c, other)
+            c.post(f"/{self.message_id}/like")
+
+            self.login(c, liker)
+            c.post(f"/{self.message_id}/unlike")
+            c.post(f"/{self.message_id}/like")
+
+        [note] = readmodels.notifications(owner)
+        self.assertEqual((note.actor_count, note.actor_id), (2, other))
+
+    def test_follows(self):
+        """ Test new followers are one notification, not a like's """
+        owner, *followers = self.user_ids
+
+        with self.client as c:
+            for follower in followers[:2]:
+                self.login(c, follower)
+                c.post(f"/users/follow/{owner}")
+
+            self.login(c, owner)
+            resp = c.get("/")
+            self.assertIn('<span class="badge bg-danger">1</span>',
+                          resp.get_data(as_text=True))
+
+        [note] = readmodels.notifications(owner)
+        self.assertEqual((note.kind, note.actor_count),
+                         (notifications.FOLLOW, 2))
+
+    def test_storage_bounded(self):
+        """ Test only the newest rows are kept, and the count follows """
+        owner, *likers = self.user_ids
+
+        for n in range(5):
+            notifications.record(owner, notifications.LIKE, likers[0],
+                                 subject_id=1000 + n, keep=3)
+        db.session.commit()
+
+        rows = readmodels.notifications(owner)
+        self.assertEqual([n.subject_id for n in rows], [1004, 1003, 1002])
+        self.assertEqual(Notification.query.count(), 3)
+        self.assertEqual(notifications.unread_count(owner), 3)
+
+        page = readmodels.notifications(owner, before=rows[0].id, limit=5)
+        self.assertEqual([n.subject_id for n in page], [1003, 1002])
+
+    def test_self_not_notified(self):
+        """ Test following yourself doesn't notify you """
+        notifications.record(self.user_ids[0], notifications.FOLLOW,
+                             self.user_ids[0])
+        self.assertEqual(Notification.query.count(), 0)
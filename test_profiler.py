@@ -0,0 +1,151 @@
+""" Request profiler tests """
+
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, profiler, CURR_USER_KEY
+
+db.create_all()
+
+
+def slow_feed(*args, **kwargs):
+    time.sleep(0.05)
+    return []
+
+
+def waiting_on_io():
+    yield
+
+
+class FakeGreenlet:
+    """ Stands in for a gevent greenlet: `gr_frame` is None while it runs """
+    def __init__(self, frame=None):
+        self.gr_frame = frame
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.tmp.name
+        app.config['PROFILE_INTERVAL'] = 0.001
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+        app.config['PROFILE_INTERVAL'] = 0.005
+        app.config['PROFILE_MAX_FILES'] = 200
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def get_home(self, headers=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with patch("app.home_feed", side_effect=slow_feed):
+                resp = c.get("/", headers=headers or {})
+                resp.close()
+
+        return resp
+
+    def profiles(self):
+        return os.listdir(self.tmp.name)
+
+    def test_signed_header_profiles_request(self):
+        """ Test a request with a valid token leaves a collapsed stack file """
+        resp = self.get_home({"X-Profile": profiler.token()})
+
+        [name] = self.profiles()
+        self.assertIn("-homepage-", name)
+        self.assertIn(resp.headers["X-Profile-Id"], name)
+        self.assertTrue(name.endswith(".collapsed"))
+
+        with open(os.path.join(self.tmp.name, name)) as f:
+            lines = f.read().splitlines()
+
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertTrue(any("app:homepage;" in line for line in lines))
+        self.assertTrue(any("slow_feed" in line for line in lines))
+
+    def test_unprofiled_requests(self):
+        """ Test requests without a (valid) token aren't profiled """
+        resp = self.get_home()
+        self.assertNotIn("X-Profile-Id", resp.headers)
+
+        resp = self.get_home({"X-Profile": "forged.token"})
+        self.assertNotIn("X-Profile-Id", resp.headers)
+
+        self.assertEqual(self.profiles(), [])
+
+    def test_expired_token(self):
+        """ Test tokens stop working after PROFILE_TOKEN_MAX_AGE """
+        token = profiler.token()
+
+        with patch.object(profiler.signer, "get_timestamp",
+                          return_value=int(time.time()) + 3601):
+            self.get_home({"X-Profile": token})
+
+        self.assertEqual(self.profiles(), [])
+
+    def test_sample_rate(self):
+        """ Test PROFILE_SAMPLE_RATE profiles requests without a token """
+        app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.get_home()
+
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_oldest_profiles_deleted(self):
+        """ Test only the newest PROFILE_MAX_FILES profiles are kept """
+        app.config['PROFILE_MAX_FILES'] = 2
+        for i in range(3):
+            path = os.path.join(self.tmp.name, f"old-{i}.collapsed")
+            with open(path, "w") as f:
+                f.write("a;b 1\n")
+            os.utime(path, (1000 + i, 1000 + i))
+
+        resp = self.get_home({"X-Profile": profiler.token()})
+
+        [new] = [name for name in self.profiles()
+                 if resp.headers["X-Profile-Id"] in name]
+        self.assertCountEqual(self.profiles(), [new, "old-2.collapsed"])
+
+    def test_greenlets_sampled_apart(self):
+        """ Test requests sharing a thread under gevent keep their own
+        samples: a switched-out greenlet's stack is where it waits """
+        parked = waiting_on_io()
+        next(parked)
+        other = FakeGreenlet(parked.gi_frame)
+        other_samples = Counter()
+        profiler._active[other] = (threading.get_ident(), other,
+                                   other_samples)
+        self.addCleanup(profiler._active.pop, other, None)
+
+        with patch("profiler.running_greenlet", return_value=FakeGreenlet()):
+            self.get_home({"X-Profile": profiler.token()})
+
+        [name] = self.profiles()
+        with open(os.path.join(self.tmp.name, name)) as f:
+            profile = f.read()
+
+        self.assertIn("slow_feed", profile)
+        self.assertNotIn("waiting_on_io", profile)
+        self.assertEqual(list(other_samples),
+                         ["test_profiler:waiting_on_io"])
+        self.assertIn(other, profiler._active)
@@ -0,0 +1,105 @@
+""" Rate limiting tests """
+
+import os
+from unittest import TestCase
+
+from models import db
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, limiter
+from ratelimit import MemoryStore, SharedMemoryStore, DatabaseStore
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StoreTests:
+    """ Checks every bucket store must pass """
+    def test_burst_then_refill(self):
+        """ Test a bucket of 3 per 30s allows 3, then one every 10s """
+        for _ in range(3):
+            self.assertEqual(self.store.hit("k", 10, 30, now=1000), 0)
+
+        self.assertAlmostEqual(self.store.hit("k", 10, 30, now=1000), 10)
+        self.assertAlmostEqual(self.store.hit("k", 10, 30, now=1004), 6)
+        self.assertEqual(self.store.hit("k", 10, 30, now=1010), 0)
+
+    def test_keys_are_separate(self):
+        """ Test one client running dry doesn't limit another """
+        self.assertEqual(self.store.hit("a", 10, 10, now=1000), 0)
+        self.assertGreater(self.store.hit("a", 10, 10, now=1000), 0)
+        self.assertEqual(self.store.hit("b", 10, 10, now=1000), 0)
+
+    def test_all_or_nothing(self):
+        """ Test a dry bucket keeps the others' tokens from being spent """
+        self.assertEqual(self.store.hit("user", 10, 10, now=1000), 0)
+
+        buckets = [("ip", 10, 20), ("user", 10, 10)]
+        self.assertAlmostEqual(self.store.hit_all(buckets, now=1000), 10)
+        self.assertAlmostEqual(self.store.hit_all(buckets, now=1000), 10)
+
+        # both of ip's tokens are still there
+        self.assertEqual(self.store.hit("ip", 10, 20, now=1000), 0)
+        self.assertEqual(self.store.hit("ip", 10, 20, now=1000), 0)
+        self.assertGreater(self.store.hit("ip", 10, 20, now=1000), 0)
+
+
+class MemoryStoreTestCase(StoreTests, TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+
+
+class SharedMemoryStoreTestCase(StoreTests, TestCase):
+    def setUp(self):
+        self.store = SharedMemoryStore(slots=1024)
+
+
+class DatabaseStoreTestCase(StoreTests, TestCase):
+    def setUp(self):
+        self.store = DatabaseStore(app)
+        self.store.reset()
+
+
+class RateLimitViewTestCase(TestCase):
+    """ Test routes answer 429 once their bucket runs dry """
+    def setUp(self):
+        limiter.reset()
+        self.limits = app.config['RATELIMITS']
+        app.config['RATELIMITS'] = {'login': {'ip': (2, 60)}}
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['RATELIMITS'] = self.limits
+        limiter.reset()
+
+    def test_login_limited(self):
+        """ Test the third login attempt in a minute is refused """
+        data = {"username": "nobody", "password": "password"}
+
+        for _ in range(2):
+            resp = self.client.post("/login", data=data)
+            self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.post("/login", data=data)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "30")
+
+        # showing the form is free
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_clients_behind_proxy(self):
+        """ Test clients behind the load balancer get buckets of their own """
+        data = {"username": "nobody", "password": "password"}
+
+        def login(client_ip):
+            return self.client.post(
+                "/login", data=data,
+                headers={"X-Forwarded-For": client_ip},
+                environ_base={"REMOTE_ADDR": "10.0.0.1"})
+
+        for _ in range(2):
+            self.assertEqual(login("203.0.113.7").status_code, 200)
+        self.assertEqual(login("203.0.113.7").status_code, 429)
+        self.assertEqual(login("198.51.100.2").status_code, 200)
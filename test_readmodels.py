@@ -0,0 +1,126 @@
+""" Read model tests """
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Like, Follows
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app
+import readmodels
+from readmodels import MessageRow, UserCard
+
+db.create_all()
+
+
+class ReadModelTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        m1 = Message(text="old", user_id=u2.id, timestamp=now - timedelta(1))
+        m2 = Message(text="new", user_id=u2.id, timestamp=now)
+        db.session.add_all([m1, m2])
+        db.session.flush()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Like(user_id=u1.id, message_id=m1.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_feed(self):
+        """ Test feed rows are newest first, with authors and likes """
+        rows = readmodels.feed([self.u2_id], self.u1_id)
+
+        self.assertEqual([type(row) for row in rows], [MessageRow] * 2)
+        self.assertEqual([row.text for row in rows], ["new", "old"])
+        self.assertEqual([row.liked for row in rows], [False, True])
+        self.assertEqual(rows[0].username, "u2")
+
+        self.assertEqual(
+            readmodels.feed([self.u2_id], self.u1_id,
+                            after=rows[1].timestamp),
+            rows[:1])
+
+    def test_feed_parameters_not_cached(self):
+        """ Test the cached feed statement takes fresh values each call """
+        readmodels.feed([self.u2_id], self.u1_id)
+
+        rows = readmodels.feed([self.u2_id], self.u2_id, limit=1)
+        self.assertEqual([(row.text, row.liked) for row in rows],
+                         [("new", False)])
+        self.assertEqual(readmodels.feed([self.u1_id], self.u1_id), [])
+
+    def test_liked_messages(self):
+        """ Test a user's likes stream back as rows """
+        rows = list(readmodels.liked_messages(self.u1_id, self.u2_id, rows=1))
+
+        self.assertEqual([row.id for row in rows], [self.m1_id])
+        self.assertFalse(rows[0].liked)
+
+    def test_user_cards(self):
+        """ Test cards say whether the viewer follows each user """
+        cards = list(readmodels.search_users(self.u1_id, rows=1))
+
+        self.assertEqual([type(card) for card in cards], [UserCard] * 2)
+        self.assertEqual({card.username: card.is_followed for card in cards},
+                         {"u1": False, "u2": True})
+        self.assertFalse(hasattr(cards[0], "password"))
+
+        self.assertEqual(
+            [card.id for card in readmodels.followers(self.u2_id, self.u1_id)],
+            [self.u1_id])
+        self.assertEqual(
+            readmodels.following(self.u1_id, self.u1_id, after=self.u2_id), [])
+
+    def test_like_counts(self):
+        """ Test like counts follow likes added and removed in bulk """
+        self.assertEqual(readmodels.like_count(self.m1_id), 1)
+        self.assertEqual(readmodels.like_count(self.m2_id), 0)
+
+        db.session.add_all([Like(user_id=self.u1_id, message_id=self.m2_id),
+                            Like(user_id=self.u2_id, message_id=self.m2_id)])
+        db.session.commit()
+        self.assertEqual(readmodels.like_count(self.m2_id), 2)
+
+        Like.query.filter_by(user_id=self.u1_id).delete()
+        db.session.commit()
+        self.assertEqual(readmodels.like_count(self.m1_id), 0)
+        self.assertEqual(readmodels.like_count(self.m2_id), 1)
+
+        Message.query.filter_by(id=self.m2_id).delete()
+        db.session.commit()
+        self.assertEqual(readmodels.like_count(self.m2_id), 0)
+
+    def test_likers(self):
+        """ Test a message's likers page by user id """
+        more = [User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+                for n in range(3, 6)]
+        db.session.flush()
+        db.session.add_all(Like(user_id=user.id, message_id=self.m1_id)
+                           for user in more)
+        db.session.commit()
+
+        ids = sorted([self.u1_id] + [user.id for user in more])
+        page = readmodels.likers(self.m1_id, limit=2)
+        self.assertEqual([liker.id for liker in page], ids[:2])
+        self.assertEqual(
+            [liker.username
+             for liker in readmodels.likers(self.m1_id, after=page[-1].id)],
+            [User.query.get(id).username for id in ids[2:]])
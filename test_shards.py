@@ -0,0 +1,228 @@
+""" Sharded message storage tests """
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Follows, Message, Hashtag
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, db_guard, tasks, CURR_USER_KEY
+import shards
+from shards import ShardRouter
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ShardRouterTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follows(user_being_followed_id=u3.id, user_following_id=u1.id),
+        ])
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_SHARDS'] = [
+            f"sqlite:///{self.tmp.name}/shard{n}.db" for n in range(2)]
+        self.router = ShardRouter(app)
+        self.router.create_all()
+
+        patcher = patch("app.shards", self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['MESSAGE_SHARDS'] = []
+        for engine in self.router.engines:
+            engine.dispose()
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def post_at(self, user_id, text, minutes_ago):
+        message_id = self.router.add_message(user_id, text)
+        shard, local_id = self.router.locate(message_id)
+
+        with self.router.engines[shard].begin() as conn:
+            conn.execute(shards.messages.update()
+                         .where(shards.messages.c.local_id == local_id)
+                         .values(timestamp=datetime.utcnow()
+                                 - timedelta(minutes=minutes_ago)))
+        return message_id
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_placement(self):
+        """ Test messages go to their author's shard, ids say which """
+        m2 = self.router.add_message(self.u2_id, "by u2")
+        m3 = self.router.add_message(self.u3_id, "by u3")
+
+        self.assertNotEqual(self.router.shard_of_user(self.u2_id),
+                            self.router.shard_of_user(self.u3_id))
+        self.assertEqual(self.router.locate(m2)[0],
+                         self.router.shard_of_user(self.u2_id))
+        self.assertEqual(self.router.get_message(m3, self.u1_id).username,
+                         "u3")
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_feed_merges_shards(self):
+        """ Test the feed interleaves every shard's rows newest first """
+        ids = [self.post_at(self.u2_id, "a", 50),
+               self.post_at(self.u3_id, "b", 40),
+               self.post_at(self.u2_id, "c", 30),
+               self.post_at(self.u3_id, "d", 20),
+               self.post_at(self.u1_id, "e", 10)]
+        self.router.like(ids[1], self.u1_id)
+
+        rows = self.router.feed([self.u1_id, self.u2_id, self.u3_id],
+                                self.u1_id)
+        self.assertEqual([row.text for row in rows], ["e", "d", "c", "b", "a"])
+        self.assertEqual([row.liked for row in rows],
+                         [False, False, False, True, False])
+
+        rows = self.router.feed([self.u2_id, self.u3_id], self.u1_id, limit=3)
+        self.assertEqual([row.id for row in rows], ids[3:0:-1])
+
+        after = datetime.utcnow() - timedelta(minutes=35)
+        rows = self.router.feed([self.u2_id, self.u3_id], self.u1_id,
+                                after=after)
+        self.assertEqual([row.text for row in rows], ["d", "c"])
+
+    def test_likes(self):
+        """ Test likes are counted and listed across shards """
+        m2 = self.post_at(self.u2_id, "by u2", 20)
+        m3 = self.post_at(self.u3_id, "by u3", 10)
+        self.router.like(m2, self.u1_id)
+        self.router.like(m3, self.u1_id)
+        self.router.like(m3, self.u1_id)
+
+        self.assertEqual(self.router.likes_count(self.u1_id), 2)
+        self.assertEqual(self.router.like_count(m3), 1)
+        self.router.like(m3, self.u2_id)
+        self.assertEqual(self.router.like_count(m3), 2)
+        self.assertEqual(
+            [row.id for row in self.router.liked_messages(
+                self.u1_id, self.u2_id, rows=1)],
+            [m3, m2])
+
+        self.assertTrue(self.router.unlike(m3, self.u1_id))
+        self.assertFalse(self.router.unlike(m3, self.u1_id))
+        self.assertEqual(self.router.like_count(m3), 1)
+        self.router.delete_message(m2)
+        self.assertEqual(self.router.likes_count(self.u1_id), 0)
+
+    def test_likers_pages(self):
+        """ Test a liker whose account is gone doesn't end the paging """
+        m3 = self.post_at(self.u3_id, "by u3", 10)
+        for user_id in (self.u1_id, self.u2_id, self.u3_id):
+            self.router.like(m3, user_id)
+        User.query.filter_by(id=self.u2_id).delete()
+        db.session.commit()
+
+        likers, after = self.router.likers(m3, per_page=2)
+        self.assertEqual([liker.id for liker in likers], [self.u1_id])
+        self.assertEqual(after, self.u2_id)
+
+        likers, after = self.router.likers(m3, after=after, per_page=2)
+        self.assertEqual([liker.id for liker in likers], [self.u3_id])
+        self.assertIsNone(after)
+
+    def test_pool_fits_concurrent_requests(self):
+        """ Test the scatter pool has room for every request to fan out """
+        self.assertEqual(self.router._pool._max_workers,
+                         2 * app.config['SHARD_CONCURRENT_REQUESTS'])
+
+    def test_purge_user(self):
+        """ Test a deleted user's messages and likes leave every shard """
+        m2 = self.router.add_message(self.u2_id, "by u2")
+        m3 = self.router.add_message(self.u3_id, "by u3")
+        self.router.like(m3, self.u2_id)
+        self.router.like(m2, self.u3_id)
+
+        self.router.purge_user(self.u2_id)
+
+        self.assertEqual(self.router.message_count(self.u2_id), 0)
+        self.assertEqual(self.router.likes_count(self.u2_id), 0)
+        self.assertEqual(self.router.likes_count(self.u3_id), 0)
+        self.assertEqual(self.router.message_count(self.u3_id), 1)
+
+    def test_views(self):
+        """ Test posting, showing, liking and deleting go to the shards """
+        with self.client as c:
+            self.login(c, self.u2_id)
+            with patch.object(tasks, "defer"):
+                resp = c.post("/messages/new", data={"text": "sharded"})
+            self.assertEqual(resp.status_code, 302)
+
+            [row] = self.router.user_messages(self.u2_id, self.u2_id)
+            resp = c.get(f"/users/{self.u2_id}")
+            self.assertIn("sharded", resp.get_data(as_text=True))
+
+            self.login(c, self.u1_id)
+            c.post(f"/{row.id}/like")
+            resp = c.get(f"/messages/{row.id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@u2", html)
+            self.assertIn("bi-star-fill", html)
+
+            resp = c.get("/")
+            self.assertIn("sharded", resp.get_data(as_text=True))
+
+            resp = c.post(f"/messages/{row.id}/delete")
+            self.assertEqual(self.router.message_count(self.u2_id), 1)
+
+            self.login(c, self.u2_id)
+            c.post(f"/messages/{row.id}/delete")
+            self.assertEqual(self.router.message_count(self.u2_id), 0)
+            self.assertEqual(c.get(f"/messages/{row.id}").status_code, 404)
+
+    def test_tag_page(self):
+        """ Test tag pages find sharded messages through the index """
+        with self.client as c:
+            for user_id in self.u2_id, self.u3_id:
+                self.login(c, user_id)
+                with patch.object(tasks, "defer"):
+                    c.post("/messages/new",
+                           data={"text": f"#sharded by {user_id}"})
+
+            html = c.get("/tags/sharded").get_data(as_text=True)
+            self.assertLess(html.index(f"</a> by {self.u3_id}"),
+                            html.index(f"</a> by {self.u2_id}"))
+
+        [message_id] = [tag.message_id for tag in Hashtag.query.filter_by(
+            tag="sharded") if self.router.locate(tag.message_id)[0]
+            == self.router.shard_of_user(self.u2_id)]
+        self.router.delete_message(message_id)
+        self.assertEqual(Hashtag.query.filter_by(tag="sharded").count(), 1)
+
+        self.router.purge_user(self.u3_id)
+        self.assertEqual(Hashtag.query.filter_by(tag="sharded").count(), 0)
+
+    def test_scatter_carries_timeout(self):
+        """ Test shard queries on pool threads get the request's timeout """
+        self.router.guard = db_guard
+        seen = []
+
+        with app.test_request_context(f"/users/{self.u1_id}"):
+            self.router._scatter(
+                lambda shard: seen.append(db_guard.timeout_ms()), range(2))
+
+        timeout = app.config['STATEMENT_TIMEOUTS']['show_user']
+        self.assertEqual(seen, [timeout, timeout])
+        self.assertIsNone(db_guard.timeout_ms())
@@ -0,0 +1,125 @@
+""" Slow query log tests """
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, slow_queries
+import readmodels
+from slowlog import SlowQueryStore, fingerprint, normalize, redact
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.user_ids = [u1.id, u2.id]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = slow_queries.store
+        slow_queries.store = SlowQueryStore(
+            os.path.join(self.tmp.name, "slow.db"), max_entries=3)
+        slow_queries._explained.clear()
+
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+
+    def tearDown(self):
+        slow_queries.drain()
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 250
+        slow_queries.store = self.store
+        slow_queries._explained.clear()
+        self.tmp.cleanup()
+        db.session.rollback()
+
+    def test_fingerprint(self):
+        """ Test IN-lists and literals don't split one statement in two """
+        self.assertEqual(
+            normalize("SELECT * FROM t WHERE id IN (%(id_1)s, %(id_2)s) "
+                      "AND n = 5 AND s = 'x'"),
+            "SELECT * FROM t WHERE id IN (...) AND n = ? AND s = ?")
+        self.assertEqual(
+            fingerprint("SELECT a FROM t WHERE id IN (%(p_1)s)"),
+            fingerprint("SELECT a FROM t\n WHERE id IN (%(p_1)s, %(p_2)s)"))
+
+    def test_redact(self):
+        """ Test strings are replaced by their lengths """
+        self.assertEqual(
+            redact({"username": "secret", "id": 3, "ids": [1, 2]}),
+            {"username": "<str:6>", "id": 3, "ids": [1, 2]})
+
+    def test_records_slow_select_with_plan(self):
+        """ Test a slow feed query is logged once, with one plan """
+        readmodels.feed(self.user_ids[:1], self.user_ids[0])
+        readmodels.feed(self.user_ids, self.user_ids[0])
+        slow_queries.drain()
+
+        feeds = [query for query in slow_queries.store.top(100)
+                 if "messages.timestamp > ?" in query['statement']]
+        self.assertEqual(len(feeds), 1)
+        [feed] = feeds
+
+        self.assertEqual(feed['calls'], 2)
+        self.assertIn("IN (...)", feed['statement'])
+        if db.get_engine(app).dialect.name == 'postgresql':
+            self.assertIn("Execution Time", feed['plan'])
+        self.assertGreaterEqual(feed['total_ms'], feed['max_ms'])
+
+    def test_params_redacted(self):
+        """ Test logged parameters don't include the values looked up """
+        User.by_username("u1")
+
+        params = [query['params'] for query in slow_queries.store.top(100)]
+        self.assertTrue(params)
+        self.assertFalse(any('"u1"' in p for p in params))
+        self.assertTrue(any('<str:2>' in p for p in params))
+
+    def test_no_plan_for_writes(self):
+        """ Test EXPLAIN ANALYZE never re-runs an INSERT """
+        db.session.add(Message(text="once", user_id=self.user_ids[0]))
+        db.session.commit()
+
+        self.assertEqual(
+            Message.query.filter_by(text="once").count(), 1)
+        inserts = [query for query in slow_queries.store.top(100)
+                   if query['statement'].startswith("INSERT")]
+        self.assertTrue(inserts)
+        self.assertIsNone(inserts[0]['plan'])
+
+    def test_bounded(self):
+        """ Test only the statements with most total time are kept """
+        store = slow_queries.store
+        for n, ms in enumerate([5, 50, 1, 20]):
+            store.record(f"k{n}", f"SELECT {n}", {}, None, ms)
+
+        self.assertEqual([query['fingerprint'] for query in store.top()],
+                         ["k1", "k3", "k0"])
+
+    def test_threshold(self):
+        """ Test fast statements aren't logged """
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 10000
+        User.by_username("u1")
+
+        self.assertEqual(slow_queries.store.top(), [])
+
+    def test_report(self):
+        """ Test the CLI lists the worst statements """
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = None
+        slow_queries.store.record("k1", "SELECT ?", {"a": "<str:1>"},
+                                  "Seq Scan on t", 40)
+
+        result = app.test_cli_runner().invoke(
+            args=["slow-queries", "--plans", "--reset"])
+
+        self.assertIn("#1 40ms total, 1 calls", result.output)
+        self.assertIn("| Seq Scan on t", result.output)
+        self.assertIn(json.dumps({"a": "<str:1>"}), result.output)
+        self.assertEqual(slow_queries.store.top(), [])
@@ -0,0 +1,180 @@
+""" Hashtag and mention index tests """
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Hashtag, Mention
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, tasks, CURR_USER_KEY
+import readmodels
+import tags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TagsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, text, user_id=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id or self.u1_id
+            with patch.object(tasks, "defer"):
+                c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one().id
+
+    def test_parse(self):
+        """ Test tags are lowercased and emails aren't mentions """
+        self.assertEqual(
+            tags.parse("#Flask and #flask, @u2 (me@u1.com) #1 C#"),
+            ({"flask", "1"}, {"u2"}))
+
+    def test_linkify(self):
+        """ Test tags become links and the rest is escaped """
+        self.assertEqual(
+            tags.linkify("<b>'#Warbler'</b>"),
+            '&lt;b&gt;&#39;<a href="/tags/warbler">#Warbler</a>&#39;&lt;/b&gt;')
+
+    def test_indexed_on_write(self):
+        """ Test posting a message indexes its tags and mentions """
+        m1 = self.post("hi @u2 @nobody @u1 #Python #python #sql")
+
+        self.assertEqual(
+            sorted(db.session.execute(
+                db.select(Hashtag.tag).where(Hashtag.message_id == m1))
+                .scalars()),
+            ["python", "sql"])
+        self.assertEqual(
+            [mention.user_id for mention in Mention.query.all()],
+            [self.u2_id])
+
+        Message.query.filter_by(id=m1).delete()
+        db.session.commit()
+        self.assertEqual(Hashtag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_tag_pages(self):
+        """ Test /tags/<tag> pages through its messages newest first """
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE', 20)
+
+        for n in range(5):
+            self.post(f"#tagged {n}")
+        self.post("#other")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            texts, pages = [], 0
+            url = "/tags/Tagged"
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                texts += [n for n in "43210" if f"</a> {n}</p>" in html]
+                pages += 1
+
+                url = None
+                if 'href="?before=' in html:
+                    before = html.split('href="?before=')[1].split('"')[0]
+                    url = f"/tags/tagged?before={before}"
+
+            self.assertEqual(texts, ["4", "3", "2", "1", "0"])
+            self.assertEqual(pages, 3)
+
+    def test_pages_past_missing_messages(self):
+        """ Test index rows whose messages are gone don't end the paging """
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE', 20)
+
+        oldest = self.post("#tagged oldest")
+        # as left by a message moved out of the database
+        for n in range(2):
+            db.session.add(Hashtag(tag="tagged", timestamp=datetime.utcnow(),
+                                   message_id=10**6 + n))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get("/tags/tagged").get_data(as_text=True)
+            self.assertIn(f'href="?before={10**6}"', html)
+
+            html = c.get(f"/tags/tagged?before={10**6}").get_data(
+                as_text=True)
+            self.assertIn(f'href="/messages/{oldest}"', html)
+
+    def test_mentions_page(self):
+        """ Test /mentions lists messages mentioning the current user """
+        self.post("hello @u2")
+        self.post("hello @u1", user_id=self.u2_id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get("/mentions").get_data(as_text=True)
+            self.assertIn("hello @u2", html)
+            self.assertNotIn("hello @u1", html)
+
+    def test_keyset_ties(self):
+        """ Test messages sharing a timestamp aren't skipped or repeated """
+        when = datetime.utcnow() - timedelta(days=1)
+        messages = [Message(text=f"#same {n}", user_id=self.u1_id,
+                            timestamp=when)
+                    for n in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.assertEqual(tags.backfill(), 3)
+
+        seen, before = [], None
+        while True:
+            page = readmodels.indexed_messages(
+                db.session.execute(
+                    readmodels.index_page(Hashtag, Hashtag.tag == "same",
+                                          before, limit=1)).all(),
+                self.u2_id)
+            if not page:
+                break
+            seen += [row.id for row in page]
+            before = page[-1].id
+
+        self.assertEqual(seen, sorted((m.id for m in messages), reverse=True))
+
+    def test_backfill_shards(self):
+        """ Test shards of the backfill together index every message once """
+        db.session.add_all([
+            Message(text=f"#old {n} @u2", user_id=self.u1_id)
+            for n in range(7)])
+        db.session.commit()
+
+        counts = [tags.backfill(shard=shard, shards=3, batch_size=2)
+                  for shard in range(3)]
+        self.assertEqual(sum(counts), 7)
+
+        # running it again changes nothing
+        tags.backfill(batch_size=4)
+        self.assertEqual(Hashtag.query.filter_by(tag="old").count(), 7)
+        self.assertEqual(Mention.query.filter_by(user_id=self.u2_id).count(),
+                         7)
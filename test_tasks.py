@@ -0,0 +1,166 @@
+""" Background task tests """
+
+import os
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from models import db, User, Job
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+
+from app import app, tasks
+from tasks import TaskExecutor
+
+db.create_all()
+
+ON_POSTGRES = db.get_engine(app).dialect.name == 'postgresql'
+
+# Tasks record what they ran here
+
+calls = []
+
+
+class TaskExecutorTestCase(TestCase):
+    """ Test post-commit tasks and retries """
+    def setUp(self):
+        """ Make a private executor with a task that fails on demand """
+        Job.query.delete()
+        User.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        self.tasks = TaskExecutor(app, workers=1, retry_delay=0)
+
+        @self.tasks.task
+        def record(value):
+            if value == "boom":
+                raise ValueError(value)
+            calls.append(value)
+
+        self.record = record
+
+    def tearDown(self):
+        """ Stop listening for commits and clean up """
+        db.session.rollback()
+        db.event.remove(db.session, 'after_commit', self.tasks._after_commit)
+        db.event.remove(db.session, 'after_rollback',
+                        self.tasks._after_rollback)
+        app.extensions['tasks'] = tasks
+
+    def test_runs_after_commit(self):
+        """ Test a deferred task waits for the commit """
+        self.tasks.defer(self.record, "hello")
+        self.assertEqual(calls, [])
+
+        db.session.commit()
+        self.tasks.drain()
+
+        self.assertEqual(calls, ["hello"])
+        self.assertEqual(self.tasks.stats()['completed'], 1)
+
+    def test_saved_until_run(self):
+        """ Test a deferred task is in the jobs table until it has run """
+        self.tasks.defer(self.record, "hello")
+
+        job = Job.query.one()
+        self.assertEqual((job.task, job.args), ("record", ["hello"]))
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        db.session.commit()
+        self.tasks.drain()
+
+        self.assertEqual(calls, ["hello"])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_survives_lost_queue(self):
+        """ Test a task lost from memory is run from its row once its
+        lease is up """
+        self.tasks.defer(self.record, "hello")
+        # as if the process died between the commit and running it
+        db.session.info.pop(self.tasks._info_key)
+        db.session.commit()
+
+        self.assertEqual(self.tasks.run_due_jobs(), 0)
+
+        Job.query.update({"run_at": datetime.utcnow()})
+        db.session.commit()
+
+        self.assertEqual(self.tasks.run_due_jobs(), 1)
+        self.assertEqual(calls, ["hello"])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_on_commit(self):
+        """ Test commit hooks run at the commit, unsaved, and not at all
+        after a rollback """
+        User.query.count()
+        self.tasks.on_commit(calls.append, "dropped")
+        db.session.rollback()
+
+        self.tasks.on_commit(calls.append, "hello")
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(calls, [])
+
+        db.session.commit()
+        self.assertEqual(calls, ["hello"])
+
+    def test_jobs_leased_one_at_a_time(self):
+        """ Test a due job isn't leased until the ones before it have run """
+        db.session.add_all([Job(task="record", args=["first"], attempts=0),
+                            Job(task="record", args=["second"], attempts=0)])
+        db.session.commit()
+
+        @self.tasks.task
+        def record(value):
+            calls.append((value, Job.query.filter(
+                Job.run_at <= datetime.utcnow()).count()))
+
+        self.assertEqual(self.tasks.run_due_jobs(), 2)
+        self.assertEqual(calls, [("first", 1), ("second", 0)])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_dropped_on_rollback(self):
+        """ Test a deferred task never runs if the transaction rolls back """
+        User.query.count()
+        self.tasks.defer(self.record, "hello")
+        db.session.rollback()
+        db.session.commit()
+        self.tasks.drain()
+
+        self.assertEqual(calls, [])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_unregistered_task(self):
+        """ Test only registered tasks can be deferred """
+        with self.assertRaises(ValueError):
+            self.tasks.defer(print, "hello")
+
+    @skipUnless(ON_POSTGRES, "retries are saved from a second connection, "
+                "which SQLite locks out mid-test")
+    def test_failure_is_retried(self):
+        """ Test a failing task is parked in the jobs table and retried """
+        self.tasks.submit("record", ["boom"])
+        self.tasks.drain()
+
+        job = Job.query.one()
+        self.assertEqual(job.task, "record")
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("ValueError", job.last_error)
+
+        Job.query.update({"args": ["fixed"], "run_at": datetime.utcnow()})
+        db.session.commit()
+
+        self.assertEqual(self.tasks.run_due_jobs(), 1)
+        self.assertEqual(calls, ["fixed"])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_gives_up(self):
+        """ Test a job that keeps failing is marked failed """
+        self.tasks.max_attempts = 2
+        db.session.add(Job(task="record", args=["boom"], attempts=1))
+        db.session.commit()
+
+        self.tasks.run_due_jobs()
+
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.failed_at)
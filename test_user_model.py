@@ -9,14 +9,15 @@ import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User
+import readmodels
+from models import db, User, Message, Like, Follows, Recommendation
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
 
 # Now we can import app
 
@@ -128,4 +129,61 @@ class UserModelTestCase(TestCase):
         self.assertFalse(bad_user)
 
         bad_user = User.authenticate(user1.username, 'wrong password')
-        self.assertFalse(bad_user)
\ No newline at end of file
+        self.assertFalse(bad_user)
+
+    def test_by_username(self):
+        """ Test the cached username lookup takes each call's value """
+        self.assertEqual(User.by_username("u1").id, self.u1_id)
+        self.assertEqual(User.by_username("u2").id, self.u2_id)
+        self.assertIsNone(User.by_username("nobody"))
+
+    def test_recommendations(self):
+        """ Test friends-of-friends suggestions """
+        user1 = User.query.get_or_404(self.u1_id)
+        user2 = User.query.get_or_404(self.u2_id)
+        user3 = User.signup("u3", "u3@email.com", "password", None)
+
+        user1.following.append(user2)
+        user2.following.append(user3)
+        db.session.commit()
+
+        Recommendation.refresh(top_n=5)
+        db.session.commit()
+
+        self.assertEqual(
+            [card.id for card in readmodels.suggestions(self.u1_id)],
+            [user3.id])
+        self.assertEqual(readmodels.suggestions(user3.id), [])
+
+        user1.following.append(user3)
+        db.session.commit()
+
+        self.assertEqual(readmodels.suggestions(self.u1_id), [])
+
+    def test_purge(self):
+        """ Test purging a user in batches removes everything they own """
+        user1 = User.query.get_or_404(self.u1_id)
+        user2 = User.query.get_or_404(self.u2_id)
+
+        user1.messages = [Message(text=f"m{i}") for i in range(5)]
+        user2.messages = [Message(text="theirs")]
+        user1.following.append(user2)
+        user2.following.append(user1)
+        db.session.commit()
+
+        user1.likes.append(user2.messages[0])
+        user2.likes.extend(user1.messages)
+        db.session.commit()
+
+        self.assertTrue(User.is_heavy(self.u1_id, 4))
+        self.assertFalse(User.is_heavy(self.u1_id, 5))
+        # one message, but five likes
+        self.assertTrue(User.is_heavy(self.u2_id, 4))
+
+        User.purge(self.u1_id, batch_size=2)
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.count(), 1)
@@ -1,15 +1,16 @@
 """ User views tests """
 
+import gzip
 import os
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Recommendation
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, tasks, CURR_USER_KEY
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -19,6 +20,8 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 db.create_all()
 
+ON_POSTGRES = db.get_engine(app).dialect.name == 'postgresql'
+
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
@@ -85,6 +88,52 @@ class UserBaseViewTestCase(TestCase):
             self.assertIn(followers.username, html)
             self.assertEqual(resp.status_code, 200)
 
+    def test_followers_pages(self):
+        """Test that followers are paged and marked with the viewer's follows"""
+        app.config['USERS_PER_PAGE'] = 1
+        u3 = User.query.get_or_404(self.u3_id)
+        u3.following.append(User.query.get_or_404(self.u1_id))
+        db.session.commit()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.get(f"/users/{self.u1_id}/followers")
+                html = resp.get_data(as_text = True)
+                self.assertIn("@u2", html)
+                self.assertNotIn("@u3", html)
+                self.assertIn("Unfollow", html)
+                self.assertIn(f"?after={self.u2_id}", html)
+
+                resp = c.get(f"/users/{self.u1_id}/followers?after={self.u2_id}")
+                html = resp.get_data(as_text = True)
+                self.assertIn("@u3", html)
+                self.assertNotIn("Unfollow", html)
+                self.assertNotIn("Next page", html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
+    def test_followed_by_following(self):
+        """Test profiles show who else you follow follows them"""
+        u2 = User.query.get_or_404(self.u2_id)
+        u2.following.append(User.query.get_or_404(self.u3_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u3_id}").get_data(as_text = True)
+            self.assertIn("Followed by", html)
+            self.assertIn("@u2", html)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            html = c.get(f"/users/{self.u3_id}").get_data(as_text = True)
+            self.assertNotIn("Followed by", html)
+
     def test_unfollow_user(self):
         """Test that a user can unfollow another user"""
         with self.client as c:
@@ -140,6 +189,87 @@ class UserBaseViewTestCase(TestCase):
         # previous instance will become unbound if you make a transaction (updating relationship in database)
 
 
+    def test_who_to_follow(self):
+        """Test that suggestions from the batch job show on the homepage"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            u2 = User.query.get_or_404(self.u2_id)
+            u2.following.append(User.query.get_or_404(self.u3_id))
+            db.session.commit()
+
+            Recommendation.refresh()
+            db.session.commit()
+
+            resp = c.get("/")
+
+            html = resp.get_data(as_text = True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@u3", html)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_delete_user(self):
+        """Test that deleting a user cascades to their follows"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(User.query.get(self.u1_id))
+            self.assertEqual(Follows.query.count(), 0)
+
+    @skipUnless(ON_POSTGRES, "retries are saved from a second connection, "
+                "which SQLite locks out mid-test")
+    def test_delete_heavy_user(self):
+        """Test that big accounts are purged in the background"""
+        db.session.add(Message(text="m1-text", user_id=self.u1_id))
+        db.session.commit()
+        app.config['PURGE_THRESHOLD'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.post("/users/delete")
+                tasks.drain()
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertIsNone(User.query.get(self.u1_id))
+                self.assertEqual(Message.query.count(), 0)
+        finally:
+            app.config['PURGE_THRESHOLD'] = 5000
+
+    def test_list_users(self):
+        """Test the user list streams cards, marked with who we follow"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                sess['_flashes'] = [("success", "Welcome back")]
+
+            resp = c.get("/users", headers={"Accept-Encoding": "gzip"})
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+            html = gzip.decompress(resp.data).decode()
+            self.assertIn("@u2", html)
+            self.assertIn("@u3", html)
+            self.assertIn(f'action="/users/stop-following/{self.u2_id}"', html)
+            self.assertIn(f'action="/users/follow/{self.u3_id}"', html)
+            self.assertIn("Welcome back", html)
+
+            html = c.get("/users?q=u3").get_data(as_text = True)
+            self.assertIn("@u3", html)
+            self.assertNotIn("@u2", html)
+            # flashed messages shown on a streamed page are still used up
+            self.assertNotIn("Welcome back", html)
+
+            html = c.get("/users?q=nobody").get_data(as_text = True)
+            self.assertIn("Sorry, no users found", html)
+
     def test_following_logged_out(self):
         """Test that a user cannot see followers if logged out"""
         with self.client as c: